@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Compressed archive support. When util.ARCHIVE_COMPRESSION (LUCIDARCHIVE) is
+"gzip" or "zstd", loaded files are compressed into the archived directory as
+they are moved there ({name}.csv.gz or {name}.csv.zst) instead of being kept
+as plain csv. zstd needs the zstandard package; gzip is used if it is
+missing.
+
+The loader and the other readers open data files through open_data(), so
+compressed csv files can be loaded directly.
+
+Usage (compress the plain csv files already in the archive, in place):
+
+    python archive.py [gzip|zstd]
+"""
+
+import gzip
+import io
+import os
+import shutil
+import sys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import util
+
+EXTENSIONS = { "gzip": ".gz", "zstd": ".zst" }
+
+def compression(method=None):
+    """
+    Returns the compression method to archive with: METHOD, defaulting to
+    util.ARCHIVE_COMPRESSION, with zstd replaced by gzip if zstandard is not
+    installed. Returns None for no compression.
+    """
+
+    method = method or util.ARCHIVE_COMPRESSION
+    if not method or method == "none":
+        return None
+    if method not in EXTENSIONS:
+        raise ValueError("Unknown archive compression: %s" % method)
+    if method == "zstd" and zstandard is None:
+        return "gzip"
+    return method
+
+def is_data_file(filename):
+    """
+    Returns TRUE if FILENAME is a csv file, plain or compressed.
+    """
+
+    return strip(filename).lower().endswith(".csv")
+
+def strip(filepath):
+    """
+    Returns FILEPATH without its compression extension, if any.
+    """
+
+    for ext in EXTENSIONS.values():
+        if filepath.endswith(ext):
+            return filepath[:-len(ext)]
+    return filepath
+
+def open_data(filepath):
+    """
+    Opens the plain, gzip or zstd csv file FILEPATH for reading, in binary
+    mode. The result can be iterated over by line.
+    """
+
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, 'rb')
+    if filepath.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("reading %s requires zstandard" % filepath)
+        raw = open(filepath, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.BufferedReader(reader)
+    return open(filepath, 'rb')
+
+def compress(filepath, target, method):
+    """
+    Streams the file FILEPATH into the file TARGET compressed with METHOD.
+    The target is written under a temporary name and renamed when complete.
+    """
+
+    tmp_path = target + ".tmp"
+    with open(filepath, 'rb') as data:
+        if method == "zstd":
+            with open(tmp_path, 'wb') as raw:
+                compressor = zstandard.ZstdCompressor(level=util.ZSTD_LEVEL)
+                compressor.copy_stream(data, raw)
+        else:
+            output = gzip.open(tmp_path, 'wb', util.GZIP_LEVEL)
+            try:
+                shutil.copyfileobj(data, output)
+            finally:
+                output.close()
+    os.rename(tmp_path, target)
+
+def archive_file(filepath, directory=None, method=None):
+    """
+    Moves the data file FILEPATH into DIRECTORY (default util.ARCHIVED),
+    compressing it unless it is already compressed or compression is off.
+    Returns the archived path.
+    """
+
+    directory = directory or util.ARCHIVED
+    method = compression(method)
+    name = os.path.basename(filepath)
+    if method is None or strip(name) != name:
+        target = os.path.join(directory, name)
+        os.rename(filepath, target)
+        return target
+    target = os.path.join(directory, name + EXTENSIONS[method])
+    compress(filepath, target, method)
+    os.remove(filepath)
+    return target
+
+def main():
+    """
+    Compresses the plain csv files in the archived directory with the method
+    given on the command line (default util.ARCHIVE_COMPRESSION or gzip).
+    """
+
+    method = compression(sys.argv[1] if len(sys.argv) > 1 else
+                         util.ARCHIVE_COMPRESSION or "gzip")
+    before = after = 0
+    for filename in sorted(os.listdir(util.ARCHIVED)):
+        filepath = os.path.join(util.ARCHIVED, filename)
+        if os.path.isfile(filepath) and filename.lower().endswith(".csv"):
+            size = os.path.getsize(filepath)
+            target = archive_file(filepath, util.ARCHIVED, method)
+            before += size
+            after += os.path.getsize(target)
+            print("Compressed %s" % target)
+    print("Archive reduced from %d to %d bytes." % (before, after))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+End-to-end benchmark of the extract and load steps. Synthetic Lucid exports
+(see synth_export.py) are generated in a scratch working directory, then
+extract_data.extract_all, extract_data.process_all and load_data.load_all
+are timed in turn, loading into a fake sMAP server (fake_smap.py) that runs
+in its own process and only counts the readings it receives.
+
+The run's timings are printed, and appended as a JSON line to the file given
+with -j, so that splitter and loader changes can be compared at the scale
+used in production (e.g. -m 1000 -r 10000 for 1k meters and 10M readings).
+
+Usage:
+
+    python benchmark.py [-m METERS] [-r ROWS] [-f MEMBERS] [-z ZIPS]
+                        [-w [N]] [-p [N]] [-s] [--csv] [-k] [-v] [-j FILE]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+
+import fake_smap
+
+API_KEY = "benchmark"
+
+def start_smap():
+    """
+    Starts a counting fake sMAP server in a child process. Returns (server,
+    process); the server's socket is already bound in this process.
+    """
+
+    server = fake_smap.FakeSmapServer(0, API_KEY, keep=False)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    server.socket.close()
+    return server, process
+
+def smap_stats(server):
+    response = urllib2.urlopen("http://127.0.0.1:%d/stats"
+                               % server.server_address[1])
+    try:
+        return json.load(response)
+    finally:
+        response.close()
+
+def du(directory):
+    """
+    Returns the total size of the files under DIRECTORY.
+    """
+
+    total = 0
+    for root, _, files in os.walk(directory):
+        for filename in files:
+            total += os.path.getsize(os.path.join(root, filename))
+    return total
+
+class Quiet(object):
+    """
+    Swallows the stages' progress output unless VERBOSE is TRUE.
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+
+    def __enter__(self):
+        if not self.verbose:
+            self.stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        if not self.verbose:
+            sys.stdout.close()
+            sys.stdout = self.stdout
+
+def run(args, workdir):
+    """
+    Runs the benchmark described by the parsed ARGS in WORKDIR. Returns the
+    result dict.
+    """
+
+    server, process = start_smap()
+    # util builds its paths from the working directory and the sMAP settings
+    # from the environment when it is first imported.
+    os.chdir(workdir)
+    os.environ["SMAPPREFIX"] = server.url()
+    os.environ["SMAPAPI"] = API_KEY
+    import util
+    import extract_data
+    import load_data
+    import synth_export
+    for path in (util.DATA_PATH, util.FINISHED, util.ARCHIVED, util.INFO):
+        os.makedirs(path)
+    open(util.MAP, 'a').close()
+
+    result = { "meters": args.meters, "rows": args.rows,
+               "members": args.members, "zips": args.zips,
+               "workers": args.workers, "processes": args.processes,
+               "stream": args.stream,
+               "native": not args.csv }
+    timings = []
+
+    def timed(stage, function, *params):
+        start = time.time()
+        with Quiet(args.verbose):
+            value = function(*params)
+        seconds = time.time() - start
+        result[stage + "_seconds"] = round(seconds, 3)
+        timings.append((stage, seconds))
+        return value
+
+    try:
+        timed("generate", synth_export.generate, util.DATA_PATH, args.meters,
+              args.rows, args.members, args.zips)
+        result["zip_bytes"] = du(util.DATA_PATH)
+        timed("extract", extract_data.extract_all, args.stream)
+        timed("process", extract_data.process_all, args.processes)
+        result["csv_bytes"] = du(util.FINISHED)
+        results = timed("load", load_data.load_all, not args.csv, args.workers)
+        result["files"] = len(results)
+        result["failed"] = len([ path for path, ok in results if not ok ])
+        result.update(smap_stats(server))
+    finally:
+        process.terminate()
+        process.join()
+
+    readings = args.meters * args.rows
+    print("%d meters x %d rows (%d readings), %d zip(s) of %d member(s)"
+          % (args.meters, args.rows, readings, args.zips, args.members))
+    for stage, seconds in timings:
+        rate = readings / seconds if seconds else 0
+        print("  %-8s %9.2f s  %12.0f readings/s" % (stage, seconds, rate))
+    print("  zip %d bytes, csv %d bytes" % (result["zip_bytes"],
+                                            result["csv_bytes"]))
+    print("  loaded %d of %d files; server got %d readings in %d requests"
+          % (result["files"] - result["failed"], result["files"],
+             result["readings"], result["requests"]))
+    return result
+
+def main():
+    """
+    Main function.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--meters", type=int, default=100,
+        help="Number of meters (default 100).")
+    parser.add_argument("-r", "--rows", type=int, default=1000,
+        help="Readings per meter (default 1000).")
+    parser.add_argument("-f", "--members", type=int, default=1,
+        help="Csv members per zip file (default 1).")
+    parser.add_argument("-z", "--zips", type=int, default=1,
+        help="Number of zip files (default 1).")
+    parser.add_argument("-w", "--workers", type=int, nargs="?", const=4,
+        default=1, help="Files to load at once (default 4 with -w alone).")
+    parser.add_argument("-p", "--processes", type=int, nargs="?", const=4,
+        default=1, help="Files to split at once (default 4 with -p alone).")
+    parser.add_argument("-s", "--stream", action="store_true",
+        help="Split zip members while extracting.")
+    parser.add_argument("--csv", action="store_true",
+        help="Load with smap-load-csv instead of the native publisher.")
+    parser.add_argument("-k", "--keep", action="store_true",
+        help="Keep the working directory.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="Show the output of the stages.")
+    parser.add_argument("-j", "--json", help="Append the result as a JSON "
+        "line to this file.")
+    args = parser.parse_args()
+
+    json_path = args.json and os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix="lucid_benchmark_")
+    cwd = os.getcwd()
+    try:
+        result = run(args, workdir)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print("Working directory kept at %s" % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if json_path:
+        result["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        with open(json_path, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Compaction of the per-meter csv files before they are loaded. Exports have a
+row for every timestamp of every meter, so sparse meters produce long runs
+of blank readings and flat meters long runs of the same reading. Compaction
+rewrites a file without:
+
+    blank   rows without a reading, or whose reading is null or not a number
+    dupe    rows repeating the timestamp of an earlier row (the first is kept)
+    flat    with a tolerance, readings within TOLERANCE of the first reading
+            of their run. The last reading of each run is kept, so that the
+            series still steps where the value changed.
+
+The header rows are kept as they are. Compaction is enabled with LUCIDCOMPACT,
+and extract_data.py then compacts every file it has split; LUCIDCOMPACTTOL
+sets the tolerance (unset: unchanged readings are all kept). Rollup files
+(see rollup.py) are never compacted, since each of their rows is a bucket,
+and extract_data.py does not compact a file twice (see ledger.py).
+
+Usage (compact the csv files in the finished directory):
+
+    python compact.py [-t TOLERANCE]
+"""
+
+import argparse
+import csv
+import itertools
+import os
+
+import metrics
+import util
+
+REASONS = ("blank", "dupe", "flat")
+
+def reading(row):
+    """
+    Returns the reading of the data ROW as a float, None if it has none.
+    """
+
+    if len(row) < 2:
+        return None
+    try:
+        value = float(row[1])
+    except ValueError:
+        return None
+    if value != value or value in (float("inf"), float("-inf")):
+        return None
+    return value
+
+def compact_rows(rows, tolerance=None, dropped=None):
+    """
+    Returns a generator of the data ROWS ([timestamp, reading] lists, in
+    time order) that are kept, leaving out the rows described in the module
+    docstring. Unchanged runs are only collapsed if TOLERANCE is not None.
+    The dropped rows are counted by reason in the dict DROPPED.
+    """
+
+    dropped = dropped if dropped is not None else dict.fromkeys(REASONS, 0)
+    seen = set()
+    first = None                # First reading of the current run
+    held = None                 # Last row of the current run, not written yet
+    for row in rows:
+        value = reading(row)
+        if value is None:
+            dropped["blank"] += 1
+            continue
+        if row[0] in seen:
+            dropped["dupe"] += 1
+            continue
+        seen.add(row[0])
+        if tolerance is not None:
+            if first is not None and abs(value - first) <= tolerance:
+                if held is not None:
+                    dropped["flat"] += 1
+                held = row
+                continue
+            first = value
+        if held is not None:
+            yield held
+            held = None
+        yield row
+    if held is not None:
+        yield held
+
+def compact_file(filepath, tolerance=None):
+    """
+    Compacts the per-meter csv file FILEPATH in place. TOLERANCE defaults to
+    util.compact_tolerance(). Returns a dict of the rows kept, the rows
+    dropped by reason, and the file size before and after; None for a
+    rollup file, which is left alone. The file is only rewritten if rows
+    are dropped, so that its file stamp (see journal.py) is kept otherwise.
+    """
+
+    import rollup
+    if rollup.is_rollup(os.path.splitext(os.path.basename(filepath))[0]):
+        return None
+    if tolerance is None:
+        tolerance = util.compact_tolerance()
+    with metrics.timed("compact", filepath) as event:
+        result = dict.fromkeys(REASONS, 0)
+        result["before"] = os.path.getsize(filepath)
+        result["rows"] = 0
+        tmp_path = filepath + ".tmp"
+        with open(filepath, 'rb') as data:
+            with open(tmp_path, 'wb') as output:
+                rows = csv.reader(data)
+                writer = csv.writer(output)
+                writer.writerows(itertools.islice(rows, util.LINE_SKIP))
+                for row in compact_rows(rows, tolerance, result):
+                    writer.writerow(row)
+                    result["rows"] += 1
+        event["rows_dropped"] = sum(result[reason] for reason in REASONS)
+        if event["rows_dropped"]:
+            os.rename(tmp_path, filepath)
+        else:
+            os.remove(tmp_path)
+        result["after"] = os.path.getsize(filepath)
+        event["bytes_read"] = result["before"]
+        event["bytes_written"] = result["after"]
+        event["rows"] = result["rows"]
+    if event["rows_dropped"]:
+        print("Compacted [%s]: dropped %d blank, %d dupe, %d flat rows, "
+              "%d -> %d bytes" % (filepath, result["blank"], result["dupe"],
+              result["flat"], result["before"], result["after"]))
+    return result
+
+def summary():
+    """
+    Prints the rows and bytes saved by the compactions of this run, from
+    the run's metrics.
+    """
+
+    totals = metrics.TOTALS.get("compact")
+    if not totals:
+        return
+    saved = totals["bytes_read"] - totals["bytes_written"]
+    rows = totals["rows"] + totals["rows_dropped"]
+    print("Compaction of %d files saved %d of %d rows and %d of %d bytes "
+          "(%.1f%%)." % (totals["events"], totals["rows_dropped"], rows,
+          saved, totals["bytes_read"],
+          100.0 * saved / totals["bytes_read"] if totals["bytes_read"] else 0))
+
+def main():
+    """
+    Main function.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tolerance", type=float,
+        help="Collapse runs of readings within this tolerance (default "
+        "LUCIDCOMPACTTOL).")
+    args = parser.parse_args()
+    for filename in sorted(os.listdir(util.FINISHED)):
+        if os.path.splitext(filename)[1].lower() == ".csv":
+            compact_file(os.path.join(util.FINISHED, filename), args.tolerance)
+    summary()
+    metrics.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Scheduler daemon. Instead of prompting for meters and dates, the daemon reads
+job specs from a JSON file (util.JOBS, LUCIDJOBS) and runs each job on its
+own schedule: export the data from Lucid, extract it and load it into sMAP.
+
+One Lucid session (a headless browser, or an HTTP session with -b) is kept
+logged in across jobs, so a job does not pay for the browser startup and
+login; the daemon logs in again only when the session has expired. The jobs
+file is re-read whenever it changes. Credentials are taken from LUCIDUSER
+and LUCIDPASS.
+
+The jobs file holds a list of jobs:
+
+    [
+        { "name": "chillers", "meters": [ "Chiller 1", "Chiller 2" ],
+          "every": 60, "days": 2 },
+        { "name": "backfill", "meters": "all", "every": 1440,
+          "start": "01/01/2015", "end": "02/01/2015" }
+    ]
+
+    name    base name of the exports
+    meters  list of meter titles, or "all"
+    every   minutes between runs
+    days    export the last DAYS days up to today (default 1), or
+    start   start and end dates (MM/DD/YYYY) of a fixed range
+    end
+
+Date ranges are clipped to the watermarks (see watermark.py), so repeated
+runs only export and load new data.
+
+Usage:
+
+    python daemon.py [-b] [-s] [-j [N]] [-n] [-w [N]] [-c] [--once] [jobs.json]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+
+from query import valid_date, clean_up_file_name, export_name
+from lucid_client import LucidError, LucidSession
+import extract_data
+import load_data
+import metrics
+import util
+import watermark
+
+class Daemon(object):
+    """
+    Runs the jobs of the jobs file at PATH (default util.JOBS) on schedule.
+    BROWSERLESS selects the HTTP session instead of the browser, and STREAM,
+    SPLIT_WORKERS, NATIVE, WORKERS and CHECK select the extract and load
+    modes.
+    """
+
+    def __init__(self, path=None, browserless=False, stream=False,
+                 native=False, workers=1, check=False, split_workers=1):
+        self.path = path or util.JOBS
+        self.browserless = browserless
+        self.stream = stream
+        self.split_workers = split_workers
+        self.native = native
+        self.workers = workers
+        self.check = check
+        self.session = None
+        self.jobs = []
+        self.next_run = {}
+        self.stamp = None
+
+    def reload(self):
+        """
+        Re-reads the jobs file if it changed since it was last read. New jobs
+        are due at once; jobs that were already known keep their schedule.
+        If the file is invalid, the previous jobs are kept.
+        """
+
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+        try:
+            jobs = read_jobs(self.path) if stamp else []
+        except ValueError, e:
+            log("[ERROR] %s: %s" % (self.path, e))
+            return
+        now = time.time()
+        self.next_run = dict((job["name"], self.next_run.get(job["name"], now))
+                             for job in jobs)
+        self.jobs = jobs
+        log("Loaded %d jobs from %s" % (len(jobs), self.path))
+
+    def connect(self):
+        """
+        Returns the Lucid session, logging in if it is new or has expired.
+        """
+
+        if self.session is None:
+            if self.browserless:
+                self.session = LucidSession()
+            else:
+                # Imported here so that -b works without Selenium installed.
+                import get_data
+                self.session = get_data.BrowserSession()
+        elif self.session.logged_in():
+            return self.session
+        else:
+            log("Session expired, logging in again.")
+        if not self.session.login(util.USER, util.PASS):
+            raise LucidError("log in failed.")
+        log("Logged in as %s" % util.USER)
+        return self.session
+
+    def run_job(self, job):
+        """
+        Exports, extracts and loads the data of JOB. Returns TRUE on success.
+        """
+
+        log("Running job %s" % job["name"])
+        try:
+            session = self.connect()
+            meter_list = job["meters"]
+            if meter_list == "all":
+                meter_list = session.meter_titles()
+            start_date, end_date = job_dates(job)
+            start_date = watermark.clip_start(meter_list, start_date, end_date)
+            # The time keeps the names of repeated runs apart on the export
+            # list.
+            filename = "%s_%s" % (job["name"], time.strftime("%H%M%S"))
+            export_string = export_name(filename, start_date, end_date)
+            session.export(meter_list, start_date, end_date, export_string)
+        except LucidError, e:
+            log("[ERROR] job %s: %s" % (job["name"], e))
+            return False
+        extract_data.main(self.stream, self.split_workers)
+        results = load_data.load_all(self.native, self.workers, self.check)
+        return all(status for _, status in results)
+
+    def run_due(self):
+        """
+        Runs the jobs that are due and schedules their next runs. A failed
+        job is retried after util.DAEMON_RETRY minutes, or at its next run
+        if that comes first.
+        """
+
+        for job in self.jobs:
+            name = job["name"]
+            if self.next_run.get(name, 0) > time.time():
+                continue
+            try:
+                ok = self.run_job(job)
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            metrics.flush()
+            metrics.reset()
+            delay = job["every"] if ok else min(job["every"], util.DAEMON_RETRY)
+            self.next_run[name] = time.time() + delay * 60
+            log("Job %s %s, next run at %s"
+                % (name, "done" if ok else "failed",
+                   time.strftime("%Y-%m-%d %H:%M",
+                                 time.localtime(self.next_run[name]))))
+
+    def run(self, once=False):
+        """
+        Runs the jobs on schedule until interrupted. If ONCE is TRUE, runs
+        every job once and returns.
+        """
+
+        try:
+            self.reload()
+            if once:
+                self.run_due()
+                return
+            while True:
+                self.run_due()
+                time.sleep(util.DAEMON_TICK)
+                self.reload()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.session is not None and hasattr(self.session, "close"):
+            self.session.close()
+        self.session = None
+
+def log(msg):
+    print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg))
+    sys.stdout.flush()
+
+def read_jobs(path):
+    """
+    Returns the list of jobs in the jobs file at PATH. Raises ValueError if
+    a job is invalid.
+    """
+
+    with open(path, 'rb') as f:
+        jobs = json.load(f)
+    if not isinstance(jobs, list):
+        raise ValueError("expected a list of jobs")
+    names = set()
+    for job in jobs:
+        check_job(job)
+        job["name"] = clean_up_file_name(job["name"])
+        if job["name"] in names:
+            raise ValueError("duplicate job name %s" % job["name"])
+        names.add(job["name"])
+    return jobs
+
+def check_job(job):
+    """
+    Raises ValueError if the job spec JOB is invalid.
+    """
+
+    if not isinstance(job, dict) or not job.get("name"):
+        raise ValueError("every job needs a name")
+    name = job["name"]
+    meters = job.get("meters")
+    if meters != "all" and (not isinstance(meters, list) or not meters):
+        raise ValueError("job %s: meters must be a list or \"all\"" % name)
+    if not isinstance(job.get("every"), (int, float)) or job["every"] <= 0:
+        raise ValueError("job %s: every must be a number of minutes" % name)
+    if "start" in job or "end" in job:
+        if not (valid_date(job.get("start", "")) and
+                valid_date(job.get("end", ""))):
+            raise ValueError("job %s: start and end must be MM/DD/YYYY" % name)
+    elif not isinstance(job.get("days", 1), int) or job.get("days", 1) < 1:
+        raise ValueError("job %s: days must be a positive integer" % name)
+
+def job_dates(job):
+    """
+    Returns the (start, end) dates (MM/DD/YYYY) of the range JOB exports:
+    its fixed range, or its last DAYS days up to and including today.
+    """
+
+    if "start" in job:
+        return (job["start"], job["end"])
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=job.get("days", 1))
+    end = today + timedelta(days=1)
+    return (start.strftime("%m/%d/%Y"), end.strftime("%m/%d/%Y"))
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+def main(path=None, browserless=False, stream=False, native=False, workers=1,
+         check=False, once=False, split_workers=1):
+    """
+    Main function. Runs the jobs of the jobs file at PATH until the daemon
+    is stopped (or once each if ONCE is TRUE); see Daemon for the options.
+    """
+
+    if not (util.USER and util.PASS):
+        print("[ERROR] Environment variables for Lucid login incorrect.")
+        exit(1)
+    signal.signal(signal.SIGTERM, terminate)
+    daemon = Daemon(path, browserless, stream, native, workers, check,
+                    split_workers)
+    try:
+        daemon.run(once)
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("jobs", nargs="?", default=util.JOBS,
+        help="Jobs file (default %s)." % util.JOBS)
+    parser.add_argument("-b", "--browserless", help="Export data with plain "
+        "HTTP requests instead of a headless browser.", action="store_true")
+    parser.add_argument("-s", "--stream", help="Split zip members while "
+        "extracting instead of extracting them to disk first.",
+        action="store_true")
+    parser.add_argument("-j", "--jobs", dest="split_workers",
+        help="Number of processes splitting files at once (default %d with "
+        "-j alone)." % util.SPLIT_WORKERS, type=int, nargs="?",
+        const=util.SPLIT_WORKERS, default=1)
+    parser.add_argument("-n", "--native", help="Post data to sMAP directly "
+        "instead of running smap-load-csv.", action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of files to load at "
+        "once (default %d with -w alone)." % util.LOAD_WORKERS, type=int,
+        nargs="?", const=util.LOAD_WORKERS, default=1)
+    parser.add_argument("-c", "--check", help="Validate files before loading "
+        "them and skip invalid ones (needs NumPy).", action="store_true")
+    parser.add_argument("--once", help="Run every job once and exit.",
+        action="store_true")
+    args = parser.parse_args()
+    main(args.jobs, args.browserless, args.stream, args.native, args.workers,
+         args.check, args.once, args.split_workers)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Export planner for large requests. Lucid is slow to prepare exports for many
+meters or long date ranges, and one export that takes too long fails the
+whole request. The planner splits the selected meters into groups of at most
+util.SHARD_METERS and the date range into pieces of at most util.SHARD_DAYS
+days, submits up to util.SHARD_CONCURRENCY of these exports at once, and
+polls all pending download links together with one export list refresh per
+round. Exports that fail to submit or download, or are not ready by their
+deadline, are resubmitted, up to util.SHARD_ATTEMPTS times each, while the
+other exports carry on.
+
+The user is prompted for the same inputs as lucid_client.py.
+"""
+
+from datetime import timedelta
+import random
+import sys
+import time
+
+from query import get_dates, get_datetime, get_export_name, export_name
+import lucid_client
+import meter_catalog
+import metrics
+import util
+import watermark
+
+class Job(object):
+    """
+    One export: METERS (titles) from START to END (MM/DD/YYYY), named NAME.
+    """
+
+    def __init__(self, meters, start, end, name):
+        self.meters = meters
+        self.start = start
+        self.end = end
+        self.name = name
+        self.attempts = 0
+        self.deadline = None
+        self.filepath = None
+        self.event = metrics.new_event("fetch", name)
+
+    def __repr__(self):
+        return "<Job %s: %d meters>" % (self.name, len(self.meters))
+
+def split_dates(start_date, end_date, max_days):
+    """
+    Returns a list of (start, end) MM/DD/YYYY pairs covering START_DATE to
+    END_DATE in consecutive pieces of at most MAX_DAYS days.
+    """
+
+    start = get_datetime(start_date)
+    end = get_datetime(end_date)
+    ranges = []
+    while start < end:
+        stop = min(start + timedelta(days=max_days), end)
+        ranges.append((start.strftime("%m/%d/%Y"), stop.strftime("%m/%d/%Y")))
+        start = stop
+    return ranges
+
+def plan(meter_list, start_date, end_date, base_name, max_meters=None,
+         max_days=None):
+    """
+    Returns the list of Jobs that export the meters titled METER_LIST from
+    START_DATE to END_DATE, with at most MAX_METERS meters (default
+    util.SHARD_METERS) and MAX_DAYS days (default util.SHARD_DAYS) each.
+    Job names are built from BASE_NAME, a part number and the dates.
+    """
+
+    max_meters = max(1, max_meters or util.SHARD_METERS)
+    max_days = max(1, max_days or util.SHARD_DAYS)
+    groups = [ meter_list[i:i + max_meters]
+               for i in range(0, len(meter_list), max_meters) ]
+    jobs = []
+    for start, end in split_dates(start_date, end_date, max_days):
+        for group in groups:
+            name = export_name("%s_p%d" % (base_name, len(jobs) + 1),
+                               start, end)
+            jobs.append(Job(group, start, end, name))
+    return jobs
+
+def run(session, jobs, meters=None, concurrency=None, attempts=None):
+    """
+    Submits and downloads JOBS through the logged-in lucid_client SESSION.
+    At most CONCURRENCY (default util.SHARD_CONCURRENCY) exports are pending
+    at once; an export that fails to submit or download, or is not ready
+    within util.EXPORT_DEADLINE seconds, is resubmitted, up to ATTEMPTS
+    (default util.SHARD_ATTEMPTS) times.
+    METERS is the (value, title) list from session.list_meters(). Returns
+    the list of jobs that failed; the others have their FILEPATH set.
+    """
+
+    concurrency = max(1, concurrency or util.SHARD_CONCURRENCY)
+    attempts = attempts or util.SHARD_ATTEMPTS
+    if meters is None:
+        meters = session.list_meters()
+    queue = list(jobs)
+    pending = []
+    failed = []
+    delay = util.POLL_MIN
+    while queue or pending:
+        while queue and len(pending) < concurrency:
+            job = queue.pop(0)
+            job.attempts += 1
+            if job.attempts == 1:
+                job.event["start"] = time.time()
+            print("Submitting %s (attempt %d)" % (job.name, job.attempts))
+            try:
+                session.submit_export(job.meters, job.start, job.end,
+                                      job.name, meters)
+            except (lucid_client.LucidError, IOError), e:
+                retry(job, "failed to submit (%s)" % e, queue, failed,
+                      attempts)
+                continue
+            job.deadline = time.time() + util.EXPORT_DEADLINE
+            pending.append(job)
+            delay = util.POLL_MIN
+        jitter = 1 + random.uniform(-util.POLL_JITTER, util.POLL_JITTER)
+        time.sleep(delay * jitter)
+        delay = min(delay * util.POLL_BACKOFF, util.POLL_MAX)
+
+        try:
+            links = session.export_links()
+        except (lucid_client.LucidError, IOError), e:
+            # Polled again next round; the deadlines still apply.
+            print("Export list not available (%s)." % e)
+            links = {}
+        for job in list(pending):
+            job.event["polls"] = job.event.get("polls", 0) + 1
+            if job.name in links:
+                pending.remove(job)
+                try:
+                    job.filepath = session.download(links[job.name])
+                except (lucid_client.LucidError, IOError), e:
+                    retry(job, "failed to download (%s)" % e, queue, failed,
+                          attempts)
+                    continue
+                print("Downloaded file: %s" % job.filepath)
+                record(job)
+            elif time.time() > job.deadline:
+                pending.remove(job)
+                retry(job, "timed out", queue, failed, attempts)
+    return failed
+
+def retry(job, reason, queue, failed, attempts):
+    """
+    Puts JOB, which failed for REASON, back on QUEUE if it was submitted
+    fewer than ATTEMPTS times, and on the list FAILED otherwise.
+    """
+
+    if job.attempts < attempts:
+        print("%s %s, resubmitting." % (job.name, reason))
+        queue.append(job)
+    else:
+        print("[ERROR] %s %s, giving up." % (job.name, reason))
+        failed.append(job)
+        job.event["ok"] = False
+        record(job)
+
+def record(job):
+    """
+    Records the metrics event of the finished JOB.
+    """
+
+    event = job.event
+    event["meters"] = len(job.meters)
+    event["retries"] = job.attempts - 1
+    if job.filepath:
+        event["bytes_written"] = metrics.file_size(job.filepath)
+    event["seconds"] = round(time.time() - event["start"], 3)
+    metrics.add(event)
+
+def main(user_mode=True, base_url=None):
+    """
+    Main function. If USER_MODE is set to TRUE, prompt the user for Lucid
+    login credentials. Otherwise, get login credentials from environment
+    variables. Returns the list of jobs that failed.
+    """
+
+    try:
+        session = lucid_client.connect(user_mode, base_url)
+        meters = meter_catalog.get(session.list_meters)
+        meter_list = lucid_client.select_meters(meters)
+        start_date, end_date = get_dates()
+        start_date = watermark.clip_start(meter_list, start_date, end_date)
+        jobs = plan(meter_list, start_date, end_date, get_export_name())
+        print("Planned %d exports." % len(jobs))
+        failed = run(session, jobs, meters)
+    except lucid_client.LucidError, e:
+        print("[ERROR] %s" % e)
+        sys.exit(1)
+    finally:
+        metrics.flush()
+    print("%d of %d exports downloaded." % (len(jobs) - len(failed),
+                                            len(jobs)))
+    if failed:
+        sys.exit(1)
+    return failed
+
+if __name__ == "__main__":
+    main()
@@ -5,38 +5,140 @@ get_data.py script). The script will extract the downloaded zip files and
 split them if they contain more than one meter's data.
 """
 
+from contextlib import contextmanager
+from StringIO import StringIO
 import csv
+import multiprocessing
 import os
+import shutil
+import sys
 import zipfile
 
+import archive
+import compact
+import journal
+import ledger
+import metrics
 import util
+import watermark
+
+INHERITED = []              # Stores a worker process inherited from its parent
 
 def extract(filepath):
     """
-    Extracts the contents of FILEPATH to the finished directory.
+    Extracts the contents of FILEPATH to the finished directory. Returns the
+    paths of the extracted files, none if the ledger shows the same content
+    was extracted before. The caller deletes FILEPATH afterwards.
+    """
+
+    skip, digest = ledger.seen("extract", filepath)
+    if skip:
+        return []
+    with journaled(filepath, "extract", remove=True), \
+            metrics.timed("extract", filepath) as event:
+        event["bytes_read"] = metrics.file_size(filepath)
+        print("Extracting zip file: %s ..." % filepath),
+        zf = zipfile.ZipFile(filepath)
+        zf.extractall(path = util.FINISHED)
+        names = [ name for name in zf.namelist() if not name.endswith("/") ]
+        zf.close()
+        print(" done")
+        paths = [ os.path.join(util.FINISHED, name) for name in names ]
+        event["bytes_written"] = sum(map(metrics.file_size, paths))
+    ledger.record("extract", digest, filepath)
+    return paths
+
+def stream_extract(filepath):
+    """
+    Extracts the contents of FILEPATH to the finished directory, reading each
+    csv member straight out of the archive. Members with data for more than
+    one meter are split into per-meter csv files on the fly, so the
+    multi-meter file is never written to disk. Other members are extracted
+    unchanged. Returns the paths of the files written, none if the ledger
+    shows the same content was extracted before. The caller deletes FILEPATH
+    afterwards.
+    """
+
+    skip, digest = ledger.seen("extract", filepath)
+    if skip:
+        return []
+    with journaled(filepath, "extract", remove=True), \
+            metrics.timed("extract", filepath) as event:
+        event["bytes_read"] = metrics.file_size(filepath)
+        paths = stream_members(filepath)
+        event["bytes_written"] = sum(map(metrics.file_size, paths))
+    ledger.record("extract", digest, filepath)
+    return paths
+
+def stream_members(filepath):
+    """
+    Does the work of stream_extract() for the zip file FILEPATH. Returns the
+    paths of the files written.
     """
 
-    print("Extracting zip file: %s ..." % filepath),
+    print("Streaming zip file: %s ..." % filepath)
+    paths = []
     zf = zipfile.ZipFile(filepath)
-    zf.extractall(path = util.FINISHED)
-    print(" done")
+    try:
+        for info in zf.infolist():
+            name = os.path.basename(info.filename)
+            if not name:
+                continue
+            ext = os.path.splitext(name)[1]
+            meters = []
+            if ext.lower() == ".csv":
+                meters = header_ids(read_member_data(zf, info))
+            if len(meters) - 1 > 1:
+                meters = meters[1:]
+                metrics.incr("meters", len(meters))
+                print("[%s] has %d meters. Splitting ..." % (name, len(meters)))
+                base = os.path.join(util.FINISHED, os.path.splitext(name)[0])
+                for columns in batch_columns(meters):
+                    paths += write_columns(read_member_data(zf, info), base,
+                                           columns)
+            else:
+                path = os.path.join(util.FINISHED, name)
+                with open(path, 'wb') as output:
+                    shutil.copyfileobj(zf.open(info), output)
+                if len(meters) > 1:
+                    trim(path, meters[1])
+                paths.append(path)
+    finally:
+        zf.close()
+    print("done")
+    return paths
 
-def extract_all():
+def extract_all(stream=False):
     """
     Extracts all zip files in the data folder, moves the csv files to the
-    "finished" directory. The zip files are deleted.
+    "finished" directory. The zip files are deleted. If STREAM is TRUE,
+    multi-meter csv files are split while they are read from the archive.
     """
 
     print("Beginning zip file extraction.")
     for filename in os.listdir(util.DATA_PATH):
-	filepath = os.path.join(util.DATA_PATH, filename)
+        filepath = os.path.join(util.DATA_PATH, filename)
         if zipfile.is_zipfile(filepath):
-            extract(filepath)
+            if stream:
+                stream_extract(filepath)
+            else:
+                extract(filepath)
             os.remove(filepath)
         else:
             print("WARNING: %s not a zip file" % filepath)
     print("Ending zip file extraction.")
 
+def header_ids(rows):
+    """
+    Returns the meter id row from the csv rows ROWS, which come from a Lucid
+    export. The first two rows are the facility and the meter name.
+    """
+
+    rows = iter(rows)
+    next(rows)                  # Facility
+    next(rows)                  # Meter name
+    return next(rows)           # Meter id
+
 def get_meter_ids(filepath):
     """
     Returns a list of the internal meter names as used in Lucid's system.
@@ -44,19 +146,28 @@ def get_meter_ids(filepath):
     script.
     """
 
-    with open(filepath, 'rb') as f:
-        reader = csv.reader(f)
-        reader.next()           # Facility
-        reader.next()           # Meter name
-        ids = reader.next()     # Meter id
-        return ids
+    return header_ids(read_meter_data(filepath))
+
+def read_member_data(zf, member):
+    """
+    Returns a generator for the csv file MEMBER of the open zip file ZF.
+    """
+
+    data = zf.open(member)
+    try:
+        reader = csv.reader(data)
+        for row in reader:
+            yield row
+    finally:
+        data.close()
 
 def read_meter_data(filepath):
     """
-    Returns a generator for the csv file located at FILEPATH.
+    Returns a generator for the csv file located at FILEPATH, which may be
+    compressed.
     """
 
-    with open(filepath, 'rb') as data:
+    with archive.open_data(filepath) as data:
         reader = csv.reader(data)
         for row in reader:
             yield row
@@ -65,61 +176,309 @@ def process(filepath):
     """
     Cleans up the contents of the csv file at FILEPATH, if the file contains
     data for more than one meter. In this case, creates new csv files for each
-    meter and deletes the original file. Otherwise, does nothing.
+    meter and deletes the original file. Otherwise, does nothing. Returns the
+    paths of the resulting single-meter files, along with their rollup files
+    if util.ROLLUPS is set. The single-meter files are then compacted if
+    util.COMPACT is set, and all the files are added to the series cache if
+    util.SERIES_CACHE is set. A file the ledger shows was split before is
+    deleted instead. Rollup files, and single-meter files the ledger shows
+    were rolled up and compacted before (left behind by a failed load), are
+    returned as they are.
     """
 
-    meters = get_meter_ids(filepath)
-    if len(meters) - 1 > 1:
-        meters = meters[1:]
-        print("[%s] has %d meters. Splitting ..." % (filepath, len(meters)))
-        for i, name in enumerate(meters, 1):
-            split_write(filepath, name, i)
+    import rollup
+    if rollup.is_rollup(os.path.splitext(os.path.basename(filepath))[0]):
+        return [ filepath ]
+    skip, digest = ledger.seen("split", filepath)
+    if skip:
         os.remove(filepath)
-        print("done")
-    else:
-        print("[%s] has 1 meter. Skipping." % (filepath))
+        return []
+    with metrics.timed("split", filepath) as event:
+        event["bytes_read"] = metrics.file_size(filepath)
+        meters = get_meter_ids(filepath)
+        remove = len(meters) - 1 > 1
+        if remove:
+            meters = meters[1:]
+            event["meters"] = len(meters)
+            print("[%s] has %d meters. Splitting ..." % (filepath, len(meters)))
+            with journaled(filepath, "split", remove=True):
+                paths = split(filepath, meters)
+            print("done")
+        else:
+            event["meters"] = 1
+            print("[%s] has 1 meter. Skipping." % (filepath))
+            # Not journaled: trim() replaces the file in one rename, and a
+            # split record would replace the journal entry of an unfinished
+            # load of the file, along with its checkpoints.
+            if len(meters) > 1:
+                trim(filepath, meters[1])
+            paths = [ filepath ]
+        event["bytes_written"] = sum(map(metrics.file_size, paths))
+    if remove:
+        # Only split files are recorded: single-meter ones stay in place.
+        ledger.record("split", digest, filepath)
+        os.remove(filepath)
+    fresh = paths
+    if util.ROLLUPS or util.COMPACT:
+        # A file already compacted must not be rolled up or compacted again.
+        fresh = [ path for path in paths
+                  if not ledger.seen("finish", path)[0] ]
+    rollups = []
+    if util.ROLLUPS:
+        # From the single-meter files, so that only one meter's readings are
+        # held in memory at a time, and before compaction changes them.
+        for path in fresh:
+            rollups += rollup.write_rollups(path)
+    if util.COMPACT:
+        # Not the rollups: collapsing runs of aggregates would drop buckets.
+        for path in fresh:
+            compact.compact_file(path)
+    if util.ROLLUPS or util.COMPACT:
+        for path in fresh:
+            ledger.record("finish", ledger.digest(path), path)
+    paths += rollups
+    if util.SERIES_CACHE:
+        import series_cache
+        for path in paths:
+            series_cache.build(path)
+    return paths
 
-def split_write(filepath, name, index):
+@contextmanager
+def journaled(filepath, stage, **fields):
+    """
+    Records STAGE of FILEPATH in the journal: started before the block, and
+    done (with FIELDS and the fields the block sets on the yielded dict) or
+    failed after it.
     """
-    Called when the csv file at FILEPATH contains data for at least 2 meters.
-    Writes a new csv file for meter NAME, whose data column is at column
-    INDEX (zero-indexed). The new file name will be of form {FILEPATH}_{NAME}.
 
-    NOTE: A row of the file looks like:
-    timestamp | meter 1 | meter 2 | meter 3 | ...
+    journal.begin(filepath, stage)
+    try:
+        yield fields
+    except Exception, e:
+        journal.failed(filepath, stage, error=str(e))
+        raise
+    journal.done(filepath, stage, **fields)
+
+def trim(filepath, name):
+    """
+    Drops the rows of the single-meter csv file at FILEPATH for meter NAME
+    that are at or before the meter's watermark, i.e. that were already
+    loaded. Returns the number of rows dropped. The file is only rewritten
+    if rows are dropped, so that the checkpoints of an earlier load of it
+    still match its file stamp (see journal.py).
     """
 
-    new_filepath = os.path.splitext(filepath)[0] + "_" + name + ".csv"
-    with open(new_filepath, 'wb') as output:
-        print("Creating new file [%s]" % new_filepath)
+    since = watermark.since(name)
+    if not since:
+        return 0
+    tmp_path = filepath + ".tmp"
+    dropped = 0
+    with open(tmp_path, 'wb') as output:
         writer = csv.writer(output)
         for row in read_meter_data(filepath):
+            if row:
+                t = watermark.parse_time(row[0])
+                if t and t <= since:
+                    dropped += 1
+                    continue
+            writer.writerow(row)
+    if not dropped:
+        os.remove(tmp_path)
+        return 0
+    os.rename(tmp_path, filepath)
+    print("Trimmed %d rows already loaded from [%s]" % (dropped, filepath))
+    return dropped
+
+def batch_columns(meters):
+    """
+    Pairs each meter in METERS with its data column index (the timestamp is
+    column 0) and groups the pairs into batches of at most
+    util.MAX_OPEN_FILES, so that very wide exports never hold more than that
+    many output files open at once.
+    """
+
+    columns = list(enumerate(meters, 1))
+    step = max(1, util.MAX_OPEN_FILES)
+    return [ columns[i:i + step] for i in range(0, len(columns), step) ]
+
+def split(filepath, meters):
+    """
+    Called when the csv file at FILEPATH contains data for at least 2 meters,
+    whose names are listed in METERS in column order. Writes a new csv file
+    per meter, named {FILEPATH}_{NAME}. The file is read once per batch of
+    util.MAX_OPEN_FILES meters rather than once per meter. Returns the paths
+    of the new files.
+    """
+
+    base = os.path.splitext(filepath)[0]
+    paths = []
+    for columns in batch_columns(meters):
+        paths += write_columns(read_meter_data(filepath), base, columns)
+    return paths
+
+def write_columns(rows, base, columns):
+    """
+    Writes the csv rows from the iterable ROWS to one file per meter in a
+    single pass. COLUMNS is a list of (INDEX, NAME) pairs; the data for meter
+    NAME is at column INDEX (zero-indexed) and is written, along with the
+    timestamp, to {BASE}_{NAME}.csv. Returns the paths of the new files.
+    Rows at or before a meter's watermark (already loaded) are left out.
+
+    NOTE: A row of the file looks like:
+    timestamp | meter 1 | meter 2 | meter 3 | ...
+    """
+
+    outputs = []
+    paths = []
+    try:
+        for index, name in columns:
+            new_filepath = base + "_" + name + ".csv"
+            print("Creating new file [%s]" % new_filepath)
+            paths.append(new_filepath)
+            output = open(new_filepath, 'wb')
+            outputs.append((index, output, csv.writer(output),
+                            watermark.since(name)))
+        # Rows are in time order, so stop comparing once past all watermarks.
+        marks = [ since for _, _, _, since in outputs if since ]
+        last = max(marks) if marks else None
+        written = 0
+        for row in rows:
             if (row):
-                writer.writerow([ row[0], row[index] ])
+                timestamp = row[0]
+                t = None
+                if last:
+                    t = watermark.parse_time(timestamp)
+                    if t and t > last:
+                        last = None
+                for index, _, writer, since in outputs:
+                    if t and since and t <= since:
+                        continue
+                    writer.writerow([ timestamp, row[index] ])
+                    written += 1
             else:
-                writer.writerow([])
-             
-def process_all():
+                for _, _, writer, _ in outputs:
+                    writer.writerow([])
+    finally:
+        for _, output, _, _ in outputs:
+            output.close()
+    # Data rows written over all the files, not counting the header rows.
+    metrics.incr("rows", max(0, written - util.LINE_SKIP * len(outputs)))
+    return paths
+
+def split_write(filepath, name, index):
+    """
+    Writes a new csv file for meter NAME, whose data column is at column
+    INDEX (zero-indexed), from the csv file at FILEPATH. The new file name
+    will be of form {FILEPATH}_{NAME}. Prefer split(), which handles all
+    meters of a file in one pass.
+    """
+
+    base = os.path.splitext(filepath)[0]
+    write_columns(read_meter_data(filepath), base, [ (index, name) ])
+
+def process_file(filepath, capture=False):
+    """
+    Processes FILEPATH, catching any error so that the other files are still
+    processed. If CAPTURE is TRUE (in a worker process), the output is
+    captured instead of printed, and the metrics events recorded meanwhile
+    are handed back instead of kept. Returns a (FILEPATH, STATUS, OUTPUT,
+    EVENTS) tuple.
+    """
+
+    stdout = sys.stdout
+    if capture:
+        sys.stdout = StringIO()
+    status = True
+    try:
+        process(filepath)
+    except Exception, e:
+        print("[ERROR] %s: %s %s" % (filepath, e.__class__.__name__, e))
+        status = False
+    finally:
+        output = sys.stdout.getvalue() if capture else ""
+        sys.stdout = stdout
+    events = metrics.drain() if capture else []
+    return (filepath, status, output, events)
+
+def init_worker():
+    """
+    Initializes a worker process: the unflushed metrics events it inherited
+    belong to the parent, and so do the watermark and map stores, whose
+    SQLite connection must not be used across a fork. The worker opens its
+    own stores on first use; the inherited ones are kept, unused, so that
+    closing them cannot touch the parent's database handle.
+    """
+
+    metrics.drain()
+    INHERITED.extend((watermark.STORE, watermark.MAP))
+    watermark.STORE = None
+    watermark.MAP = None
+
+def process_all(workers=1):
     """
     Processes all csv files in the finished folder, splitting them if they
-    have data on more than one meter.
+    have data on more than one meter. With WORKERS > 1, files are processed
+    by a pool of that many processes; the output of each file is printed in
+    one piece, in file name order. Returns a list of (FILEPATH, STATUS)
+    tuples, one per file.
     """
 
     print("\nBegin processing ...\n")
-    for filename in os.listdir(util.FINISHED):
-        ext = os.path.splitext(filename)[1]
-        if ext.lower() == ".csv":
-	    filepath = os.path.join(util.FINISHED, filename)
-            process(filepath)
+    filepaths = [ os.path.join(util.FINISHED, filename)
+                  for filename in sorted(os.listdir(util.FINISHED))
+                  if os.path.splitext(filename)[1].lower() == ".csv" ]
+    if workers > 1 and len(filepaths) > 1:
+        pool = multiprocessing.Pool(min(workers, len(filepaths)), init_worker)
+        try:
+            outcomes = pool.imap(process_capture, filepaths, 1)
+            results = [ collect(outcome) for outcome in outcomes ]
+        finally:
+            pool.close()
+            pool.join()
+        # The workers appended to the journal and ledger behind this
+        # process's back.
+        journal.reload()
+        ledger.reload()
+    else:
+        results = [ collect(process_file(path)) for path in filepaths ]
+    failed = [ path for path, status in results if not status ]
+    if failed:
+        print("\nProcessed %d of %d files." % (len(results) - len(failed),
+                                              len(results)))
+        for path in failed:
+            print("  [FAIL] %s" % path)
     print("\nProcessing done.")
+    return results
+
+def process_capture(filepath):
+    return process_file(filepath, True)
+
+def collect(outcome):
+    """
+    Prints the captured output of a process_file OUTCOME and adds its
+    metrics events. Returns its (FILEPATH, STATUS).
+    """
+
+    filepath, status, output, events = outcome
+    sys.stdout.write(output)
+    for event in events:
+        metrics.add(event)
+    return (filepath, status)
 
-def main():
+def main(stream=False, workers=1):
     """
-    Main function.
+    Main function. If STREAM is TRUE, zip files are split while they are
+    extracted instead of after. Up to WORKERS files are split at once.
+    Raises util.ConfigError if util.COMPACT is set and the compaction
+    tolerance is not a number.
     """
 
-    extract_all()
-    process_all()
+    if util.COMPACT:
+        util.compact_tolerance()
+    extract_all(stream)
+    process_all(workers)
+    compact.summary()
+    metrics.flush()
 
 if __name__ == '__main__':
     main()
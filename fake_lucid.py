@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the BuildingOS website, for testing lucid_client.py
+without a Lucid account. It serves a login form, the data export form with a
+list of fake meters, an export list whose download links appear after a few
+polls, and zip files of Lucid-style csv exports.
+
+Usage:
+
+    python fake_lucid.py [port]
+
+then pass http://localhost:{port}/ as the base URL of the client.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import sys
+import threading
+import urlparse
+import uuid
+import zipfile
+
+import util
+
+LOGIN_PAGE = """<html><head><title>BuildingOS Login</title></head><body>
+<form method="post" action="/login/">
+<input type="hidden" name="csrfmiddlewaretoken" value="fake">
+<input type="text" id="id_username" name="username">
+<input type="password" id="id_password" name="password">
+<input type="submit" name="submit" value="Log in">
+</form></body></html>"""
+
+HOME_PAGE = "<html><head><title>Home</title></head><body></body></html>"
+
+def export_rows(meters, start, end):
+    """
+    Returns the rows of a Lucid csv export of the (id, title) pairs METERS
+    with hourly readings from START to END (MM/DD/YYYY).
+    """
+
+    rows = [ ["Facility"] + [ "LBNL" for _ in meters ],
+             ["Meter"] + [ title for _, title in meters ],
+             ["Timestamp"] + [ value for value, _ in meters ],
+             ["Units"] + [ "kWh" for _ in meters ] ]
+    t = datetime.strptime(start, "%m/%d/%Y")
+    stop = datetime.strptime(end, "%m/%d/%Y")
+    step = 0
+    while t < stop:
+        rows.append([ t.strftime(util.TIME_FORMAT) ] +
+                    [ "%.2f" % (step * (i + 1) % 97)
+                      for i in range(len(meters)) ])
+        t += timedelta(hours=1)
+        step += 1
+    return rows
+
+def export_zip(name, rows):
+    """
+    Returns the bytes of a zip file holding the csv file NAME.csv with ROWS.
+    """
+
+    data = StringIO()
+    csv.writer(data).writerows(rows)
+    archive = StringIO()
+    zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+    zf.writestr(name + ".csv", data.getvalue())
+    zf.close()
+    return archive.getvalue()
+
+class FakeLucidHandler(BaseHTTPRequestHandler):
+    """
+    Handles the BuildingOS pages used by the exporters.
+    """
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path
+        if path == "/":
+            return self.reply(200, LOGIN_PAGE)
+        if not self.session():
+            return self.redirect("/")
+        if path == "/home":
+            return self.reply(200, HOME_PAGE)
+        if path == util.EXPORT_PATH:
+            return self.reply(200, self.server.export_form())
+        if path.rstrip("/") == util.EXPORT_LIST_PATH.rstrip("/"):
+            return self.reply(200, self.server.export_list())
+        if path.startswith("/download/"):
+            export = self.server.exports.get(path[len("/download/"):])
+            if export and export["ready"]:
+                return self.reply(200, export["zip"], "application/zip",
+                    { "Content-Disposition":
+                      "attachment; filename=%s.zip" % export["name"] })
+        self.reply(404, "not found")
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        fields = urlparse.parse_qs(self.rfile.read(length))
+        path = urlparse.urlsplit(self.path).path
+        server = self.server
+        if path == "/login/":
+            user = fields.get("username", [""])[0]
+            passwd = fields.get("password", [""])[0]
+            if (user, passwd) != (server.user, server.passwd):
+                return self.reply(200, LOGIN_PAGE)
+            token = uuid.uuid4().hex
+            server.sessions.add(token)
+            return self.redirect("/home", "sessionid=%s; Path=/" % token)
+        if not self.session():
+            return self.redirect("/")
+        if path == util.EXPORT_PATH:
+            server.add_export(fields.get("name", [""])[0],
+                              fields.get(util.EXPORT_POINTS, []),
+                              fields.get("start", [""])[0],
+                              fields.get("end", [""])[0])
+            return self.redirect(util.EXPORT_LIST_PATH)
+        self.reply(404, "not found")
+
+    def session(self):
+        cookies = self.headers.getheader("cookie", "")
+        for cookie in cookies.split(";"):
+            key, _, value = cookie.strip().partition("=")
+            if key == "sessionid" and value in self.server.sessions:
+                return True
+        return False
+
+    def redirect(self, location, cookie=None):
+        self.send_response(302)
+        self.send_header("Location", location)
+        if cookie:
+            self.send_header("Set-Cookie", cookie)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def reply(self, status, body, content_type="text/html", headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FakeLucidServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded fake BuildingOS server with METERS fake meters. An export is
+    ready after READY_AFTER requests for the export list. USER and PASSWD
+    are the only accepted credentials.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, meters=10, ready_after=1, user="user",
+                 passwd="pass", verbose=False):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeLucidHandler)
+        self.meters = [ ("%d" % (1000 + i), "lbnl_meter_%03d" % i)
+                        for i in range(meters) ]
+        self.ready_after = ready_after
+        self.user = user
+        self.passwd = passwd
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.exports = {}
+        self.polls = 0
+
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def export_form(self):
+        options = "".join("<option value=%s>%s</option>" % (quoteattr(value),
+                                                            escape(title))
+                          for value, title in self.meters)
+        return ("""<html><head><title>Data Export</title></head><body>
+<form id="pointForm" method="post" action="%s">
+<input type="hidden" name="csrfmiddlewaretoken" value="fake">
+<select multiple name="%s">%s</select>
+<input type="text" id="id_name" name="name">
+<input type="text" id="id_start" name="start">
+<input type="text" id="id_end" name="end">
+<select id="id_resolution" name="resolution"><option value="1">Raw</option>
+<option value="2">Hourly</option></select>
+<div class="form-actions"><button type="submit">Export</button></div>
+</form></body></html>""" % (util.EXPORT_PATH, util.EXPORT_POINTS, options))
+
+    def export_list(self):
+        with self.lock:
+            self.polls += 1
+            links = []
+            for key, export in sorted(self.exports.items()):
+                export["polls"] += 1
+                if export["polls"] >= self.ready_after:
+                    export["ready"] = True
+                    links.append("<li><a href=\"/download/%s\">%s</a></li>"
+                                 % (key, escape(export["name"])))
+        return ("<html><head><title>Exports</title></head><body><ul>%s</ul>"
+                "</body></html>" % "".join(links))
+
+    def add_export(self, name, points, start, end):
+        meters = [ meter for meter in self.meters if meter[0] in points ]
+        with self.lock:
+            key = "%d" % (len(self.exports) + 1)
+            self.exports[key] = { "name": name, "ready": False, "polls": 0,
+                "zip": export_zip(name, export_rows(meters, start, end)) }
+
+    def start(self):
+        """
+        Serves requests in a background thread. Returns the server.
+        """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    """
+    Main function.
+    """
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    server = FakeLucidServer(port, verbose=True)
+    print("Fake BuildingOS listening at %s (login %s / %s)"
+          % (server.url(), server.user, server.passwd))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the sMAP server, for testing the loaders without
+touching the real archiver. It accepts JSON posts to /add/{API key} and keeps
+the posted streams in memory. GET /stats returns the number of streams and
+readings received as JSON.
+
+Usage:
+
+    python fake_smap.py [port]
+
+then point SMAPPREFIX at http://localhost:{port}/add/.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import sys
+import threading
+
+class FakeSmapHandler(BaseHTTPRequestHandler):
+    """
+    Handles sMAP add requests. Replies with the server's FAIL_STATUS, if
+    set, instead of storing the data.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self.reply(404, "not found")
+        self.reply(200, json.dumps(self.server.stats()))
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        body = self.rfile.read(length)
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            status = server.fail_status
+        if status:
+            return self.reply(status, "error")
+        if not self.path.startswith("/add/"):
+            return self.reply(404, "not found")
+        if server.api_key and self.path[len("/add/"):] != server.api_key:
+            return self.reply(403, "invalid api key")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self.reply(400, "invalid json")
+        with server.lock:
+            for path, stream in payload.items():
+                entry = server.streams.setdefault(stream["uuid"],
+                    { "path": path, "Readings": [], "count": 0 })
+                readings = stream.get("Readings", [])
+                entry["count"] += len(readings)
+                if server.keep:
+                    entry["Readings"].extend(readings)
+        self.reply(200, "")
+
+    def reply(self, status, text):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FakeSmapServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded fake sMAP server. STREAMS maps each posted UUID to its path,
+    readings and reading count. If API_KEY is set, posts to any other key
+    are refused. If KEEP is FALSE, readings are only counted, for loads too
+    large to hold in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, api_key=None, verbose=False, keep=True):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeSmapHandler)
+        self.api_key = api_key
+        self.verbose = verbose
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.requests = 0
+        self.fail_status = None
+
+    def url(self, api_key=""):
+        """
+        Returns the report destination for API_KEY on this server.
+        """
+
+        return "http://127.0.0.1:%d/add/%s" % (self.server_address[1], api_key)
+
+    def stats(self):
+        """
+        Returns a dict of the number of requests, streams and readings
+        received.
+        """
+
+        with self.lock:
+            return { "requests": self.requests, "streams": len(self.streams),
+                     "readings": sum(stream["count"]
+                                     for stream in self.streams.values()) }
+
+    def start(self):
+        """
+        Serves requests in a background thread. Returns the server.
+        """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    """
+    Main function.
+    """
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8079
+    server = FakeSmapServer(port, verbose=True)
+    print("Fake sMAP server listening at %s" % server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for uid, stream in sorted(server.streams.items()):
+        print("%s %s: %d readings" % (uid, stream["path"], stream["count"]))
+
+if __name__ == "__main__":
+    main()
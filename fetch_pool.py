@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""
+Parallel fetch over several Lucid sessions. A large selection is split into
+exports by the export planner (at most util.SHARD_METERS meters and
+util.SHARD_DAYS days each), and SESSIONS workers, each logged in with a
+session of its own, take the exports from a shared queue one at a time. An
+export that is slow to prepare then only holds up its own worker.
+
+Each worker downloads into a directory of its own under util.SCRATCH, so
+that downloads with the same file name cannot collide, and moves each
+finished download into util.DATA_PATH, where the extract step picks it up.
+An export that fails is retried by the next free worker, up to
+util.SHARD_ATTEMPTS times. Exports are handed on in the order they finish,
+not in date order; the pipeline trims them against the watermarks as they
+were when the run started, so that a later export loaded first cannot trim
+an earlier one away.
+
+The user is prompted for the same inputs as get_data.py.
+
+Usage (-b for HTTP sessions instead of headless browsers):
+
+    python fetch_pool.py [-a] [-b] [-f SESSIONS]
+"""
+
+import argparse
+import os
+import Queue
+import sys
+import threading
+import traceback
+import zipfile
+
+from query import get_dates, get_export_name, get_user_login
+import export_planner
+import lucid_client
+import meter_catalog
+import metrics
+import util
+import watermark
+
+MERGE_LOCK = threading.Lock()
+
+def worker_directory(number):
+    """
+    Returns the download directory of worker NUMBER, creating it if needed.
+    """
+
+    directory = os.path.join(util.SCRATCH, "fetch%d" % number)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return directory
+
+def merge(filepath):
+    """
+    Moves the finished download FILEPATH into util.DATA_PATH, adding a
+    number to its name if a file of that name is already there. Returns the
+    new path.
+    """
+
+    name, ext = os.path.splitext(os.path.basename(filepath))
+    with MERGE_LOCK:
+        target = os.path.join(util.DATA_PATH, name + ext)
+        n = 1
+        while os.path.exists(target):
+            n += 1
+            target = os.path.join(util.DATA_PATH, "%s_%d%s" % (name, n, ext))
+        os.rename(filepath, target)
+    return target
+
+def merge_leftovers(sessions, ready=None):
+    """
+    Moves the complete downloads a previous run left in the directories of
+    workers 1 to SESSIONS into util.DATA_PATH, calling READY with each new
+    path if given, and deletes partial ones.
+    """
+
+    for number in range(1, sessions + 1):
+        directory = worker_directory(number)
+        for filename in sorted(os.listdir(directory)):
+            filepath = os.path.join(directory, filename)
+            if zipfile.is_zipfile(filepath):
+                path = merge(filepath)
+                print("Merging leftover download %s" % path)
+                if ready:
+                    ready(path)
+            elif os.path.isfile(filepath):
+                os.remove(filepath)
+
+def new_session(browserless, directory, base_url=None):
+    """
+    Returns a new, not logged in session downloading into DIRECTORY: a
+    lucid_client.LucidSession if BROWSERLESS is TRUE, a get_data
+    BrowserSession otherwise.
+    """
+
+    if browserless:
+        return lucid_client.LucidSession(base_url, directory)
+    import get_data
+    return get_data.BrowserSession(directory)
+
+def close(session):
+    if hasattr(session, "close"):
+        session.close()
+
+def first_login(session, user_mode):
+    """
+    Logs SESSION in, prompting for credentials until the login succeeds if
+    USER_MODE is TRUE, with the environment credentials otherwise. Returns
+    the (user, password) that worked, for the other sessions.
+    """
+
+    while True:
+        if user_mode:
+            user, passwd = get_user_login()
+        else:
+            user, passwd = util.USER, util.PASS
+        if session.login(user, passwd):
+            print("Logged in as %s" % user)
+            return (user, passwd)
+        if not user_mode:
+            raise lucid_client.LucidError("log in failed.")
+        print("Incorrect email/password. Please try again.")
+
+class Worker(threading.Thread):
+    """
+    Worker NUMBER: logs SESSION in with CREDENTIALS if it is not already,
+    then exports the jobs of the shared JOBS queue until it is empty. Jobs
+    that fail are put back until they run out of attempts, then added to
+    the shared list FAILED. READY, if given, is called with the path of each
+    download once it is in util.DATA_PATH.
+    """
+
+    def __init__(self, number, session, credentials, jobs, failed, ready=None):
+        threading.Thread.__init__(self, name="fetch%d" % number)
+        self.daemon = True
+        self.number = number
+        self.session = session
+        self.credentials = credentials
+        self.jobs = jobs
+        self.failed = failed
+        self.ready = ready
+
+    def log(self, msg):
+        print("[worker %d] %s" % (self.number, msg))
+
+    def connect(self):
+        if self.session.logged_in():
+            return True
+        if self.session.login(*self.credentials):
+            return True
+        self.log("[ERROR] log in failed.")
+        return False
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                if not self.connect():
+                    self.jobs.put(job)
+                    return
+                self.export(job)
+        finally:
+            close(self.session)
+
+    def export(self, job):
+        """
+        Exports JOB and merges its download into util.DATA_PATH.
+        """
+
+        job.attempts += 1
+        self.log("Exporting %s (attempt %d)" % (job.name, job.attempts))
+        try:
+            filepath = self.session.export(job.meters, job.start, job.end,
+                                           job.name)
+            job.filepath = merge(filepath)
+            self.log("Downloaded %s" % job.filepath)
+            if self.ready:
+                self.ready(job.filepath)
+        except Exception, e:
+            if not isinstance(e, lucid_client.LucidError):
+                traceback.print_exc()
+            if job.attempts < util.SHARD_ATTEMPTS:
+                self.log("%s failed (%s), retrying." % (job.name, e))
+                self.jobs.put(job)
+            else:
+                self.log("[ERROR] %s failed (%s), giving up." % (job.name, e))
+                self.failed.append(job)
+
+def run(sessions, credentials, jobs, ready=None):
+    """
+    Exports JOBS with one Worker per session in the list SESSIONS, logging
+    in the ones that are not with CREDENTIALS, and calls READY (if given)
+    with the path of each download. Returns the list of jobs that failed;
+    the others have their FILEPATH set.
+    """
+
+    queue = Queue.Queue()
+    for job in jobs:
+        queue.put(job)
+    failed = []
+    workers = [ Worker(number, session, credentials, queue, failed, ready)
+                for number, session in enumerate(sessions, 1) ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        # Joined with a timeout so that Ctrl-C still reaches this thread.
+        while worker.is_alive():
+            worker.join(1)
+    # Jobs left over if every worker failed to log in.
+    while not queue.empty():
+        failed.append(queue.get_nowait())
+    return failed
+
+def main(user_mode=True, browserless=False, sessions=None, base_url=None,
+         ready=None):
+    """
+    Main function. If USER_MODE is set to TRUE, prompt the user for Lucid
+    login credentials. Otherwise, get login credentials from environment
+    variables. Up to SESSIONS (default util.FETCH_SESSIONS) sessions export
+    at once, over HTTP if BROWSERLESS is TRUE. READY, if given, is called
+    with the path of each download as soon as it is in util.DATA_PATH (by
+    the pipeline). Returns the list of jobs that failed.
+    """
+
+    sessions = max(1, sessions or util.FETCH_SESSIONS)
+    merge_leftovers(sessions, ready)
+    first = new_session(browserless, worker_directory(1), base_url)
+    try:
+        credentials = first_login(first, user_mode)
+        fetch = first.list_meters if browserless else first.scrape_meters
+        meters = meter_catalog.get(fetch)
+        meter_list = lucid_client.select_meters(meters)
+        start_date, end_date = get_dates()
+        start_date = watermark.clip_start(meter_list, start_date, end_date)
+        jobs = export_planner.plan(meter_list, start_date, end_date,
+                                   get_export_name())
+        count = min(sessions, len(jobs))
+        print("Planned %d exports over %d sessions." % (len(jobs), count))
+        pool = [ first ] + [ new_session(browserless, worker_directory(n),
+                                         base_url)
+                             for n in range(2, count + 1) ]
+        failed = run(pool, credentials, jobs, ready)
+    except lucid_client.LucidError, e:
+        close(first)
+        print("[ERROR] %s" % e)
+        sys.exit(1)
+    finally:
+        metrics.flush()
+    print("%d of %d exports downloaded." % (len(jobs) - len(failed),
+                                            len(jobs)))
+    if failed:
+        sys.exit(1)
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--auto", action="store_true",
+        help="Use stored environment variables.")
+    parser.add_argument("-b", "--browserless", action="store_true",
+        help="Export data with plain HTTP requests.")
+    parser.add_argument("-f", "--sessions", type=int,
+        default=util.FETCH_SESSIONS, help="Number of sessions (default %d)."
+        % util.FETCH_SESSIONS)
+    args = parser.parse_args()
+    main(not args.auto, args.browserless, args.sessions)
@@ -14,174 +14,54 @@ performance issues, as this script will not wait forever for the download to
 be ready.
 """
 
-from datetime import datetime
-from getpass import getpass
 from pyvirtualdisplay import Display
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-from time import sleep
-
+from selenium.common.exceptions import (NoSuchElementException,
+                                        TimeoutException, WebDriverException)
+from selenium.webdriver.support.ui import WebDriverWait
+import os
+import urlparse
+
+from query import (valid_date, get_datetime, convert_date, get_dates,
+                   valid_index, display_meters, get_meters, clean_up_file_name,
+                   get_user_login, get_export_name, export_name)
+from lucid_client import LucidError
+import meter_catalog
+import metrics
+import polling
 import util
+import watermark
+
+# Clicks the picker entries titled arguments[0] in the page, in one WebDriver
+# call. Returns the titles that are not in the picker.
+SELECT_SCRIPT = """
+var titles = arguments[0], wanted = {}, found = {}, missing = [];
+for (var i = 0; i < titles.length; i++) wanted[titles[i]] = true;
+var meters = document.getElementsByClassName('ms-elem-selectable');
+for (var i = 0; i < meters.length; i++) {
+    var title = meters[i].getAttribute('title');
+    if (wanted[title] && !found[title]) {
+        found[title] = true;
+        meters[i].getElementsByTagName('span')[0].click();
+    }
+}
+for (var i = 0; i < titles.length; i++)
+    if (!found[titles[i]]) missing.push(titles[i]);
+return missing;
+"""
 
-def valid_date(date):
-    """
-    Checks if DATE is of form MM/DD/YYYY. Does not check if YYYY is correct.
-    Also, does not check for edge cases, i.e. Feb 30.
-    """
-    mdy = date.split("/")
-    if (len(mdy) == 3):
-        try:
-            m = int(mdy[0])
-            d = int(mdy[1])
-            y = int(mdy[2])
-            datetime(y, m, d)
-            return True
-        except (TypeError, ValueError):
-            return False
-    return False
-
-def get_datetime(date):
-    """
-    Return the datetime object representing DATE. DATE must be valid.
-    """
-
-    mdy = date.split("/")
-    m = int(mdy[0])
-    d = int(mdy[1])
-    y = int(mdy[2])
-    return datetime(y, m, d)
-
-def convert_date(date):
-    """
-    Convert date of form MM/DD/YYYY into YYYY-MM-DD. Assumes date is correct
-    form.
-    """
-    
-    mdy = date.split("/")
-    m = mdy[0]
-    d = mdy[1]
-    y = mdy[2]
-    newDate = "%s-%s-%s" % (y, m, d)
-    return newDate
-
-def get_dates():
-    """
-    Prompt the user for a start and end date.
-    This function will keep prompting until valid dates are entered.
-    Returns a tuple of start date and end date strings.
-    """
-
-    hasValidStart = False
-    hasValidEnd = False
-    start = None
-    end = None
-    while True:
-        if not hasValidStart:
-            start = raw_input("Enter start date (MM/DD/YYYY): ") 
-            if not valid_date(start):
-                print("Invalid start date %s" % (start))
-                continue
-            else:
-                hasValidStart = True
-        if not hasValidEnd:
-            end = raw_input("Enter end date (MM/DD/YYYY): ")
-            if not valid_date(end):
-                print("Invalid end date %s" % (end))
-                continue
-            else:
-                hasValidEnd = True
-        if hasValidStart and hasValidEnd:
-            if get_datetime(start) < get_datetime(end):
-                accept_string = "Is range %s - %s acceptable? (Y/N) " % (start, end)
-                decision = raw_input(accept_string)
-                if decision.lower() == "y":
-                    break
-                else:
-                    hasValidStart = False
-                    hasValidEnd = False
-            else:
-                print("End date comes before start. Please enter a valid date.")
-                hasValidEnd = False
-    return (start, end)
-
-def valid_index(index, left, right):
-    """
-    Checks if INDEX is a valid number and is within the index range. If valid,
-    returns TRUE. Otherwise, returns FALSE.
-    """
-
-    try:
-        num = int(index)
-        return (num >= left and num <= right)
-    except (ValueError, TypeError):
-        return False
-
-def display_meters(all_meters):
-    """
-    Print meter names and their indices. Meters come from ALL_METERS list.
-    Note that indices begin at 1.
-    """
-    
-    for index, meter in enumerate(all_meters, 1):
-        if index < 10:
-            print("  %d:  %s" % (index, meter))
-        else:
-            print("  %d: %s" % (index, meter))
-    print("\n")
-
-def get_meters(meters):
-    """
-    Prompt user to enter indicies of the meters desired. At least one index must
-    be entered. Returns the selected indices.
-    """
-
-    user_list = []
-    atLeastOneMeter = False
-    minIndex = 1
-    maxIndex = len(meters)
-    display_meters(meters)
-    print("Please select the indices of the meters desired. Enter 'all' if all"
-          "meters are desired (not recommended, as performance will decrease)."
-          " Enter 'done' to end selection.")
-    while True:
-        index = raw_input("Enter a meter index: ") 
-        if index == "all":
-            return meters
-        if not atLeastOneMeter:
-            if index == "done":
-                print("No meters selected. Please try again.")
-                continue
-            if not valid_index(index, minIndex, maxIndex):
-                print("Invalid meter index.")
-                continue
-            num = int(index)
-            if not num in user_list:
-                user_list.append(num)
-                atLeastOneMeter = True
-            else:
-                print("Meter already selected. Please pick a different one")
-        else:
-            if index == "done":
-                return user_list
-            if not valid_index(index, minIndex, maxIndex):
-                print("Invalid meter index.")
-                continue
-            num = int(index)
-            if not num in user_list:
-                user_list.append(num)
-            else:
-                print("Meter already selected. Please pick a different one")
-
-def clean_up_file_name(filename):
-    """
-    If FILENAME has spaces in it, replaces them with underscores. Otherwise,
-    this function returns the filename unchanged.
-    """
-
-    words = filename.split()
-    if len(words) > 1:
-        filename = "_".join(words)
-    return filename
+# Returns the titles among arguments[0] whose picker entries are not marked
+# as selected.
+UNSELECTED_SCRIPT = """
+var titles = arguments[0], selected = {}, unselected = [];
+var meters = document.getElementsByClassName('ms-elem-selectable');
+for (var i = 0; i < meters.length; i++)
+    if ((' ' + meters[i].className + ' ').indexOf(' ms-selected ') >= 0)
+        selected[meters[i].getAttribute('title')] = true;
+for (var i = 0; i < titles.length; i++)
+    if (!selected[titles[i]]) unselected.push(titles[i]);
+return unselected;
+"""
 
 def err(msg, browser, display, code=1):
     """
@@ -194,21 +74,11 @@ def err(msg, browser, display, code=1):
     display.stop()
     exit(code)
 
-def get_user_login():
-    """
-    Prompt user for Lucid email (username) and password. The password will not
-    be visible to the user, but the username will be.
-    Returns (username, password) tuple.
-    """
-
-    user = raw_input("Email: ")
-    passwd = getpass("Password: ")
-    return (user, passwd)
-
-def setup():
+def setup(directory=None):
     """
     Sets up the display and browser for running Selenium with headless
-    Firefox. Returns a tuple of (browser, display) objects.
+    Firefox, downloading into DIRECTORY (default util.DATA_PATH). Returns a
+    tuple of (browser, display) objects.
     """
 
     print("\nSetting up browser, this may take a while..."),
@@ -217,7 +87,7 @@ def setup():
     p = webdriver.FirefoxProfile()
     p.set_preference("browser.download.folderList", 2)
     p.set_preference("browser.download.manager.showWhenStarting", False)
-    p.set_preference("browser.download.dir", util.DATA_PATH)
+    p.set_preference("browser.download.dir", directory or util.DATA_PATH)
     p.set_preference("browser.helperApps.neverAsk.saveToDisk", "application/zip")
     browser = webdriver.Firefox(firefox_profile=p)
     print("done")
@@ -237,19 +107,25 @@ def login(browser, display, user_mode):
 
     if user_mode:
         login_prompt(browser, display)
+    elif not log_in(browser, util.USER, util.PASS):
+        err("log in failed.", browser, display)
     else:
-        username_element = browser.find_element_by_id("id_username")
-        password_element = browser.find_element_by_id("id_password")
-        username_element.clear()
-        password_element.clear()
-        username_element.send_keys(util.USER)
-        password_element.send_keys(util.PASS)
-        browser.find_element_by_name("submit").click()
-
-        if not "home" in browser.title.lower():
-            err("log in failed.", browser, display)
-        else:
-            print("Logged in as %s" % util.USER)
+        print("Logged in as %s" % util.USER)
+
+def log_in(browser, user, passwd):
+    """
+    Fills in and submits the login form on the current page as USER with
+    password PASSWD. Returns TRUE if the login succeeded.
+    """
+
+    username_element = browser.find_element_by_id("id_username")
+    password_element = browser.find_element_by_id("id_password")
+    username_element.clear()
+    password_element.clear()
+    username_element.send_keys(user)
+    password_element.send_keys(passwd)
+    browser.find_element_by_name("submit").click()
+    return "home" in browser.title.lower()
 
 def login_prompt(browser, display):
     """
@@ -259,15 +135,7 @@ def login_prompt(browser, display):
 
     while True:
         user, passwd = get_user_login()
-        username_element = browser.find_element_by_id("id_username")
-        password_element = browser.find_element_by_id("id_password")
-        username_element.clear()
-        password_element.clear()
-        username_element.send_keys(user)
-        password_element.send_keys(passwd)
-        browser.find_element_by_name("submit").click()
-
-        if not "home" in browser.title.lower():
+        if not log_in(browser, user, passwd):
             print("Incorrect email/password. Please try again.")
             continue
         else:
@@ -279,46 +147,64 @@ def get_data_page(browser, display):
     Navigate to the data export page. If failure, exits the script.
     """
 
-    browser.get("https://buildingos.com/exports/create")
+    browser.get(urlparse.urljoin(util.URL, util.EXPORT_PATH))
     if not "export" in browser.title.lower():
         err("Export page not available.", browser, display)
     else:
         print("Export page found.")
 
-def interact(browser):
+def picker_open(browser):
     """
-    Get list of meters available in the Lucid system, get user response, and
-    forward response to Lucid system for meter download. Returns the string
-    that's the name of the link to click on for download.
+    Returns TRUE if the meter picker is open and its meters have loaded.
+    """
+
+    meters = browser.find_elements_by_class_name("ms-elem-selectable")
+    return bool(meters) and meters[0].is_displayed()
+
+def open_picker(browser):
+    """
+    Opens the meter picker of the export page, unless it is already open,
+    and waits up to util.PICKER_TIMEOUT seconds for its meters to load.
     """
 
+    if picker_open(browser):
+        return
     meter_xpath = "//*[@id=\"pointForm\"]/fieldset/div[2]/div/a"
-    meter_select = browser.find_element_by_xpath(meter_xpath)
-    meter_select.click()
-    # Let page load.
-    sleep(3)
+    browser.find_element_by_xpath(meter_xpath).click()
+    try:
+        WebDriverWait(browser, util.PICKER_TIMEOUT).until(picker_open)
+    except TimeoutException:
+        raise LucidError("Meter picker did not load.")
+
+def list_meters(browser):
+    """
+    Opens the meter picker of the export page and returns the titles of the
+    meters available in the Lucid system.
+    """
+
+    open_picker(browser)
     raw_meter_list = browser.find_elements_by_class_name("ms-elem-selectable")
-    all_meters = [ meter.get_attribute("title") for meter in raw_meter_list ]
+    return [ meter.get_attribute("title") for meter in raw_meter_list ]
 
-    meter_indices = sorted(get_meters(all_meters))
-    meter_list = [ all_meters[index - 1] for index in meter_indices ]
+def catalog_meters(browser):
+    """
+    Returns the titles of the meters available in the Lucid system from the
+    meter catalog, scraping the picker of the export page if it is stale.
+    """
 
-    print("Selecting meters...")
-    for meter in meter_list:
-        print("Selecting meter: %s" % (meter))
-        elem = browser.find_element_by_xpath("//*[@title=\"%s\"]/span" % (meter))
-        elem.click()
-    print("Selection done.")
+    pairs = meter_catalog.get(lambda: [ (None, title)
+                                        for title in list_meters(browser) ])
+    return meter_catalog.titles(pairs)
 
-    add_button_xpath = "//*[@id=\"addPoints\"]/form/fieldset/div[3]/button"
-    browser.find_element_by_xpath(add_button_xpath).click()
-    count = browser.find_element_by_id("numPoints")
-    print("Number of points selected: %s" % (count.text))
+def submit_export(browser, meter_list, start_date, end_date, export_string):
+    """
+    Selects the meters titled METER_LIST in the open meter picker and submits
+    an export of them from START_DATE to END_DATE (MM/DD/YYYY) at the finest
+    resolution, named EXPORT_STRING.
+    """
 
-    start_date, end_date = get_dates()
-    filename = raw_input("Enter a base file name (spaces will be replaced with"
-                         " an underscore): ")
-    filename = clean_up_file_name(filename)
+    open_picker(browser)
+    select_meters(browser, meter_list)
 
     browser.find_element_by_id("id_start").clear()
     browser.find_element_by_id("id_end").clear()
@@ -327,8 +213,6 @@ def interact(browser):
     browser.execute_script(start_script)
     browser.execute_script(end_script)
 
-    export_string = "%s_%s_%s" % (filename, convert_date(start_date),
-                                  convert_date(end_date))
     export_name_box = browser.find_element_by_id("id_name")
     export_name_box.clear()
     export_name_box.send_keys(export_string)
@@ -338,53 +222,238 @@ def interact(browser):
     submit_div = browser.find_element_by_class_name("form-actions")
     submit_div.find_element_by_tag_name("button").click()
 
+def select_meters(browser, meter_list):
+    """
+    Selects the meters titled METER_LIST in the open meter picker and adds
+    them to the export. All of them are clicked by one script in the page.
+    Only the meters whose click did not register in the picker are then
+    clicked one by one through WebDriver, before the points are added once,
+    so that no meter is added twice.
+    """
+
+    print("Selecting %d meters..." % len(meter_list))
+    missing = browser.execute_script(SELECT_SCRIPT, meter_list)
+    if missing:
+        raise LucidError("meters not in the picker: %s; refresh the meter "
+                         "catalog (run.py -r)" % ", ".join(missing))
+    for meter in browser.execute_script(UNSELECTED_SCRIPT, meter_list):
+        print("Selecting meter: %s" % (meter))
+        elem = browser.find_element_by_xpath("//*[@title=\"%s\"]/span"
+                                             % (meter))
+        elem.click()
+    unselected = browser.execute_script(UNSELECTED_SCRIPT, meter_list)
+    if unselected:
+        raise LucidError("meters could not be selected: %s"
+                         % ", ".join(unselected))
+    count = add_points(browser)
+    if count is not None and count != len(meter_list):
+        raise LucidError("%d of %d meters were selected"
+                         % (count, len(meter_list)))
+    print("Selection done.")
+
+def add_points(browser):
+    """
+    Adds the meters selected in the picker to the export. Returns the number
+    of points selected, None if it cannot be read.
+    """
+
+    add_button_xpath = "//*[@id=\"addPoints\"]/form/fieldset/div[3]/button"
+    browser.find_element_by_xpath(add_button_xpath).click()
+    count = browser.find_element_by_id("numPoints").text.strip()
+    print("Number of points selected: %s" % (count))
+    if count.isdigit():
+        return int(count)
+    return None
+
+def interact(browser):
+    """
+    Get list of meters available in the Lucid system, get user response, and
+    forward response to Lucid system for meter download. Returns the string
+    that's the name of the link to click on for download.
+    """
+
+    all_meters = catalog_meters(browser)
+    meter_indices = sorted(get_meters(all_meters))
+    meter_list = [ all_meters[index - 1] for index in meter_indices ]
+
+    start_date, end_date = get_dates()
+    start_date = watermark.clip_start(meter_list, start_date, end_date)
+    filename = get_export_name()
+    export_string = export_name(filename, start_date, end_date)
+
+    submit_export(browser, meter_list, start_date, end_date, export_string)
     return export_string
 
+def find_link(export_string, browser):
+    """
+    Refreshes the page and returns the link whose name is EXPORT_STRING, None
+    if it is not there yet.
+    """
+
+    browser.refresh()
+    try:
+        return browser.find_element_by_link_text(export_string)
+    except NoSuchElementException:
+        return None
+
 def download(export_string, browser, display):
     """
-    Downloads the data from the link whose name is EXPORT_STRING. On error,
-    quits the script.
+    Downloads the data from the link whose name is EXPORT_STRING and waits
+    for the download to complete. Returns the path of the downloaded file.
+    On error, quits the script.
     """
 
-    print("Waiting for download to be ready.")
-    waitCount = 0
-    link = None
-    while waitCount < util.MAX_RETRIES:
-        sleep(util.DATA_WAIT_PERIOD)
-        browser.refresh()
-        waitCount += 1
-        try:
-            link = browser.find_element_by_link_text(export_string)
-            print("Link found.")
-            break
-        except NoSuchElementException:
-            continue
-    if link:
+    try:
+        return fetch(export_string, browser)
+    except LucidError, e:
+        err(e, browser, display)
+
+def fetch(export_string, browser, directory=None):
+    """
+    Waits for the link whose name is EXPORT_STRING, downloads it and waits
+    for the download to complete in DIRECTORY, the browser's download
+    directory (default util.DATA_PATH). Returns the path of the downloaded
+    file. Raises LucidError if the link never appears or the download does
+    not complete.
+    """
+
+    directory = directory or util.DATA_PATH
+    with metrics.timed("fetch", export_string) as event:
+        print("Waiting for download to be ready.")
+        link = polling.poll(lambda: find_link(export_string, browser))
+        if not link:
+            raise LucidError("Link not found")
+        print("Link found.")
+        before = set(os.listdir(directory))
         try:
             url = link.get_attribute("href")
-            browser.get(url)
             print("Downloading file: %s" % link.text)
+            browser.get(url)
         except NoSuchElementException:
-            err("Link not found", browser, display)
-    else:
-        err("Link not found", browser, display)
+            raise LucidError("Link not found")
+        filepath = polling.wait_for_download(directory, before)
+        if not filepath:
+            raise LucidError("Download did not complete")
+        print("Downloaded file: %s" % filepath)
+        event["bytes_written"] = metrics.file_size(filepath)
+        return filepath
+
+class BrowserSession(object):
+    """
+    A headless browser that is kept open and logged in across exports, for
+    the scheduler daemon (daemon.py) and parallel fetches (fetch_pool.py).
+    Exports are downloaded into DIRECTORY (default util.DATA_PATH). The
+    browser is started on first login and restarted if it dies. Failures
+    raise LucidError instead of exiting.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or util.DATA_PATH
+        self.browser = None
+        self.display = None
+
+    def login(self, user, passwd):
+        """
+        Logs in as USER with password PASSWD, starting the browser if it is
+        not running. Returns TRUE on success.
+        """
+
+        if self.browser is None:
+            self.browser, self.display = setup(self.directory)
+        self.browser.get(util.URL)
+        return log_in(self.browser, user, passwd)
+
+    def logged_in(self):
+        """
+        Returns TRUE if the browser is running and its session is still
+        logged in, leaving the browser on the export page.
+        """
+
+        if self.browser is None:
+            return False
+        try:
+            return self.export_page()
+        except WebDriverException:
+            self.close()
+            return False
+
+    def export_page(self):
+        """
+        Loads the data export page. Returns TRUE if it is available.
+        """
+
+        self.browser.get(urlparse.urljoin(util.URL, util.EXPORT_PATH))
+        return "export" in self.browser.title.lower()
+
+    def meter_titles(self):
+        """
+        Returns the titles of the meters available for export, from the meter
+        catalog.
+        """
+
+        return meter_catalog.titles(meter_catalog.get(self.scrape_meters))
+
+    def scrape_meters(self):
+        if not self.export_page():
+            raise LucidError("Export page not available.")
+        return [ (None, title) for title in list_meters(self.browser) ]
+
+    def export(self, meter_list, start_date, end_date, export_string):
+        """
+        Exports the meters titled METER_LIST from START_DATE to END_DATE,
+        named EXPORT_STRING, and downloads the export. Returns the path of
+        the downloaded file.
+        """
+
+        try:
+            meters = set(self.meter_titles())
+            missing = [ title for title in meter_list if title not in meters ]
+            if missing:
+                raise LucidError("unknown meters: %s" % ", ".join(missing))
+            if not self.export_page():
+                raise LucidError("Export page not available.")
+            submit_export(self.browser, meter_list, start_date, end_date,
+                          export_string)
+            return fetch(export_string, self.browser, self.directory)
+        except WebDriverException, e:
+            self.close()
+            raise LucidError("browser failed: %s" % e)
+
+    def close(self):
+        """
+        Quits the browser and stops the display.
+        """
+
+        if self.browser is not None:
+            try:
+                self.browser.quit()
+            except WebDriverException:
+                pass
+            self.display.stop()
+        self.browser = None
+        self.display = None
 
 def main(user_mode=True):
     """
     Main function. If USER_MODE is set to TRUE, prompt the user for
     Lucid login credentials. Otherwise, get login credentials from
-    environment variables.
+    environment variables. Returns the path of the downloaded file.
     """
 
     browser, display = setup()
     login(browser, display, user_mode)
     get_data_page(browser, display)
-    export_string = interact(browser)
-    download(export_string, browser, display)
+    try:
+        export_string = interact(browser)
+    except LucidError, e:
+        err(e, browser, display)
+    filepath = download(export_string, browser, display)
+    metrics.flush()
 
     print("Exiting...")
     browser.quit()
     display.stop()
+    return filepath
 
 if __name__ == "__main__":
     main()
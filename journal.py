@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Write-ahead journal of the files moving through the extract and load steps,
+so that an interrupted run can be resumed from where it stopped.
+
+Each step appends a record to util.JOURNAL (JSON lines, fsynced) before it
+starts on a file and when it is done with it or fails:
+
+    extract a zip file in the data directory; deleted once done
+    split   an extracted csv file with more than one meter; deleted once
+            done
+    load    a per-meter csv file; archived once done
+
+The native loader also records a checkpoint after every batch the sMAP
+server acknowledges, with the number of readings sent so far. A retried load
+of the same (unchanged) file skips those readings, so only the batches that
+were not acknowledged are sent again.
+
+Usage (show the files whose last step did not finish, or finish them):
+
+    python journal.py [resume [-s] [-n] [-w [N]]]
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+import util
+
+STAGES = ("extract", "split", "load")
+LOCK = threading.Lock()
+STATE = None                # Current entries, read from the journal once
+
+def file_stamp(filepath):
+    """
+    Returns [size, mtime] of FILEPATH, to tell whether a checkpoint still
+    applies to it, or None if it does not exist.
+    """
+
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return [ st.st_size, int(st.st_mtime) ]
+
+def append(record):
+    """
+    Appends RECORD to the journal and syncs it to disk.
+    """
+
+    record["time"] = round(time.time(), 3)
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with LOCK:
+        with util.file_lock(util.JOURNAL):
+            with open(util.JOURNAL, 'a') as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+        if STATE is not None:
+            fold(STATE, record)
+
+def begin(filepath, stage, **fields):
+    append(dict(fields, path=filepath, stage=stage, status="started"))
+
+def done(filepath, stage, **fields):
+    append(dict(fields, path=filepath, stage=stage, status="done"))
+
+def failed(filepath, stage, **fields):
+    append(dict(fields, path=filepath, stage=stage, status="failed"))
+
+def checkpoint(filepath, offset, stamp):
+    """
+    Records that the first OFFSET readings of FILEPATH, whose file stamp is
+    STAMP, have been acknowledged by the sMAP server.
+    """
+
+    append({ "path": filepath, "stage": "load", "status": "checkpoint",
+             "offset": offset, "stamp": stamp })
+
+def read():
+    """
+    Returns the journal records. A torn last line, left by a crash while it
+    was written, is ignored.
+    """
+
+    records = []
+    if not os.path.exists(util.JOURNAL):
+        return records
+    with open(util.JOURNAL, 'rb') as journal:
+        for line in journal:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def state():
+    """
+    Returns a dict of file path to the current entry of the file: its last
+    record, merged with the earlier records of the same step of the same
+    file (e.g. the checkpoint offset of a load that was then started again).
+    The journal is read on first use and then kept up to date in memory.
+    """
+
+    with LOCK:
+        return dict(current())
+
+def current():
+    """
+    Returns the in-memory entries, reading the journal on first use. The
+    caller holds LOCK.
+    """
+
+    global STATE
+    if STATE is None:
+        STATE = {}
+        for record in read():
+            fold(STATE, record)
+    return STATE
+
+def reload():
+    """
+    Drops the in-memory entries, so that the journal is read again on next
+    use, e.g. after other processes appended to it.
+    """
+
+    global STATE
+    with LOCK:
+        STATE = None
+
+def fold(entries, record):
+    """
+    Applies RECORD to the dict of current ENTRIES.
+    """
+
+    entry = entries.get(record["path"])
+    if continues(entry, record):
+        entry.update(record)
+    else:
+        entries[record["path"]] = dict(record)
+
+def continues(entry, record):
+    """
+    Returns TRUE if RECORD continues the unfinished step of ENTRY: same
+    step, and same file stamp if both have one.
+    """
+
+    if entry is None or entry["status"] == "done":
+        return False
+    if entry["stage"] != record["stage"]:
+        return False
+    stamps = (entry.get("stamp"), record.get("stamp"))
+    return None in stamps or stamps[0] == stamps[1]
+
+def unfinished():
+    """
+    Returns the entries of the files whose last step did not finish, in
+    step order.
+    """
+
+    entries = [ entry for entry in state().values()
+                if entry["status"] != "done" ]
+    return sorted(entries, key=lambda e: (STAGES.index(e["stage"]), e["path"]))
+
+def load_offset(filepath, stamp):
+    """
+    Returns the number of readings of FILEPATH already acknowledged by an
+    earlier, unfinished load of the same file contents (file stamp STAMP).
+    """
+
+    with LOCK:
+        entry = current().get(filepath)
+    if entry is None or entry["stage"] != "load" or \
+            entry["status"] == "done" or entry.get("stamp") != stamp:
+        return 0
+    return entry.get("offset", 0)
+
+def compact():
+    """
+    Rewrites the journal with only the current entries of the unfinished
+    files, and of the finished ones that are still to be deleted.
+    """
+
+    global STATE
+    with LOCK:
+        with util.file_lock(util.JOURNAL):
+            entries = {}
+            for record in read():
+                fold(entries, record)
+            for path, entry in list(entries.items()):
+                if entry["status"] == "done" and not (entry.get("remove") and
+                                                      os.path.exists(path)):
+                    del entries[path]
+            records = sorted(entries.values(), key=lambda e: e["time"])
+            util.atomic_write(util.JOURNAL, lambda f: f.writelines(
+                json.dumps(record, sort_keys=True) + "\n"
+                for record in records))
+            STATE = entries
+
+def resume(stream=False, native=False, workers=1):
+    """
+    Finishes the work of an interrupted run. Zip files and split csv files
+    that were done but not deleted yet are deleted; everything else is
+    redone by the normal extract and load steps, which overwrite partial
+    outputs and resume loads from their checkpoints.
+    """
+
+    import extract_data
+    import load_data
+
+    for entry in unfinished():
+        print("[%s %s] %s" % (entry["stage"], entry["status"], entry["path"]))
+    for path, entry in state().items():
+        if entry["status"] == "done" and entry["stage"] in ("extract", "split") \
+                and entry.get("remove") and os.path.exists(path):
+            print("Removing %s" % path)
+            os.remove(path)
+    extract_data.main(stream)
+    load_data.main(native, workers)
+
+def main():
+    """
+    Main function.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", nargs="?", choices=[ "status", "resume" ],
+        default="status")
+    parser.add_argument("-s", "--stream", action="store_true",
+        help="Split zip members while extracting.")
+    parser.add_argument("-n", "--native", action="store_true",
+        help="Post data to sMAP directly (needed to resume from checkpoints).")
+    parser.add_argument("-w", "--workers", type=int, nargs="?",
+        const=util.LOAD_WORKERS, default=1, help="Files to load at once.")
+    args = parser.parse_args()
+    if args.command == "resume":
+        resume(args.stream, args.native, args.workers)
+        return
+    entries = unfinished()
+    for entry in entries:
+        line = "[%s %s] %s" % (entry["stage"], entry["status"], entry["path"])
+        if entry.get("offset"):
+            line += " (%d readings sent)" % entry["offset"]
+        print(line)
+    print("%d unfinished files." % len(entries))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed ledger of the files the pipeline has already handled, so
+that re-exporting a range that was already loaded costs a hash check instead
+of a full extract, split and upload. util.LEDGER holds one JSON line per
+file handled:
+
+    extract a zip file that was extracted
+    split   an extracted csv file that was split into per-meter files
+    load    a per-meter csv file that was loaded
+    finish  a per-meter csv file that was rolled up and compacted, as set
+            by LUCIDROLLUPS and LUCIDCOMPACT (its digest after compaction)
+
+with the file's digest, name and time. A file whose digest is already in the
+ledger for its step is skipped: a zip or split csv file is deleted, since its
+outputs were written before, a per-meter file is deleted as already loaded,
+and a finished file is loaded as it is, without writing its rollups from
+its compacted readings or compacting it again. Setting LUCIDFORCE (or run.py
+-F) handles every file regardless.
+
+The digest of a csv file is the SHA-1 of its (decompressed) contents. The
+digest of a zip file is the SHA-1 of its members' CRC-32s and sizes, read
+from the zip directory without decompressing anything, so that exports of
+the same data match even though the zip entries carry their creation time.
+
+Usage (show the number of files recorded per step):
+
+    python ledger.py
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+
+import archive
+import util
+
+STEPS = ("extract", "split", "load", "finish")
+CHUNK_SIZE = 1024 * 1024
+LOCK = threading.Lock()
+INDEX = None                # (step, digest) to record, read from the ledger once
+
+def zip_digest(filepath):
+    """
+    Returns the digest of the zip file FILEPATH: the SHA-1 of the sorted
+    CRC-32s and sizes of its members.
+    """
+
+    zf = zipfile.ZipFile(filepath)
+    try:
+        members = sorted((info.CRC, info.file_size) for info in zf.infolist())
+    finally:
+        zf.close()
+    return hashlib.sha1(json.dumps(members)).hexdigest()
+
+def file_digest(filepath):
+    """
+    Returns the SHA-1 of the contents of FILEPATH, which may be compressed.
+    """
+
+    digest = hashlib.sha1()
+    with archive.open_data(filepath) as data:
+        for chunk in iter(lambda: data.read(CHUNK_SIZE), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def digest(filepath):
+    if zipfile.is_zipfile(filepath):
+        return zip_digest(filepath)
+    return file_digest(filepath)
+
+def read():
+    """
+    Returns the ledger records. A torn last line is ignored.
+    """
+
+    records = []
+    if not os.path.exists(util.LEDGER):
+        return records
+    with open(util.LEDGER, 'rb') as ledger:
+        for line in ledger:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+def index():
+    """
+    Returns the in-memory index, reading the ledger on first use. The caller
+    holds LOCK.
+    """
+
+    global INDEX
+    if INDEX is None:
+        INDEX = dict(((r["step"], r["digest"]), r) for r in read())
+    return INDEX
+
+def reload():
+    """
+    Drops the in-memory index, so that the ledger is read again on next use,
+    e.g. after other processes appended to it.
+    """
+
+    global INDEX
+    with LOCK:
+        INDEX = None
+
+def lookup(step, file_digest):
+    """
+    Returns the record of the file with digest FILE_DIGEST handled by STEP,
+    None if there is none.
+    """
+
+    with LOCK:
+        return index().get((step, file_digest))
+
+def record(step, file_digest, filepath):
+    """
+    Records that STEP handled FILEPATH, whose digest is FILE_DIGEST.
+    """
+
+    entry = { "step": step, "digest": file_digest,
+              "name": os.path.basename(filepath),
+              "time": round(time.time(), 3) }
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    with LOCK:
+        with util.file_lock(util.LEDGER):
+            with open(util.LEDGER, 'a') as ledger:
+                ledger.write(line)
+        if INDEX is not None:
+            INDEX[(step, file_digest)] = entry
+
+def seen(step, filepath):
+    """
+    Returns (SEEN, DIGEST) for FILEPATH: the file's digest, and TRUE if STEP
+    already handled a file with that digest and util.LEDGER_FORCE is not
+    set, in which case the skip is printed.
+    """
+
+    file_digest = digest(filepath)
+    entry = None if util.LEDGER_FORCE else lookup(step, file_digest)
+    if entry is not None:
+        print("Skipping [%s]: same content as %s (%s %s)"
+              % (filepath, entry["name"], step, time.strftime(
+                 "%Y-%m-%d %H:%M", time.localtime(entry["time"]))))
+    return (entry is not None, file_digest)
+
+def main():
+    """
+    Main function.
+    """
+
+    records = read()
+    for step in STEPS:
+        print("%-8s %d files" % (step, len([ r for r in records
+                                             if r["step"] == step ])))
+
+if __name__ == "__main__":
+    main()
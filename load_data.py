@@ -1,17 +1,33 @@
 """
 This script loads already processed building energy data (processing done by
-by extract_data.py) into an sMAP server, with the help of smap-load-csv.
+by extract_data.py) into an sMAP server, with the help of smap-load-csv, or
+by posting the data directly with the native publisher in smap_publish.py.
+Files can be loaded by several workers at once.
 
-Dependencies: sMAP library (smap-load-csv)
+Dependencies: sMAP library (smap-load-csv), unless the native publisher is used
 """
 
+from multiprocessing.pool import ThreadPool
 import csv
 import os
 import shutil
 import subprocess
-import uuid
+import tempfile
+import threading
 
+import archive
+import journal
+import ledger
+import map_store
+import meter_catalog
+import metrics
+import smap_publish
 import util
+import watermark
+
+STORE = None
+STORE_LOCK = threading.Lock()
+LOCAL = threading.local()
 
 def get_meter_id(filepath):
     """
@@ -19,38 +35,63 @@ def get_meter_id(filepath):
     is to be used as the source name argument in the smap-load-csv script.
     """
 
-    with open(filepath, 'rb') as f:
+    with archive.open_data(filepath) as f:
         reader = csv.reader(f)
         reader.next()
         reader.next()
         ids = reader.next()
         return ids[1]
 
+def get_meter_title(filepath):
+    """
+    Returns the title of the meter of data file FILEPATH, as listed in
+    Lucid's meter picker.
+    """
+
+    with archive.open_data(filepath) as f:
+        reader = csv.reader(f)
+        reader.next()
+        titles = reader.next()
+        return titles[1]
+
+def get_store():
+    """
+    Returns the meter name - UUID map store, opening it on first use.
+    """
+
+    global STORE
+    with STORE_LOCK:
+        if STORE is None:
+            STORE = map_store.open_store()
+    return STORE
+
 def get_uuid(source_name):
     """
-    Returns the UUID if SOURCE_NAME has a UUID assigned to it in the map.csv
-    file located in the info directory, None otherwise. The map file is
-    assumed to exist.
+    Returns the UUID if SOURCE_NAME has a UUID assigned to it in the map
+    store (by default the map.csv file located in the info directory), None
+    otherwise.
     """
 
-    with open(util.MAP, "rb") as mapfile:
-        reader = csv.reader(mapfile)
-        for row in reader:
-            if source_name.lower() == row[0].lower():
-                return row[1]
-        return None
+    return get_store().get(source_name)
 
 def assign_uuid(source_name):
     """
-    Generates a UUID for SOURCE_NAME and writes a new entry in the map.csv
-    file. Returns the generated UUID.
+    Generates a UUID for SOURCE_NAME and writes a new entry in the map
+    store. Returns the generated UUID, or the existing one if another process
+    assigned it first.
     """
 
-    new_id = uuid.uuid4()
-    with open(util.MAP, 'a') as mapfile:
-        writer = csv.writer(mapfile)
-        writer.writerow([source_name, new_id])
-        return str(new_id)
+    return get_store().assign(source_name)
+
+def assign_uuids(filepaths):
+    """
+    Assigns a UUID to the meter of each data file in FILEPATHS that has none
+    yet, writing the map once.
+    """
+
+    with get_store().batch() as store:
+        for filepath in filepaths:
+            store.assign(get_meter_id(filepath))
 
 def build_input_string(source_name, uid, filepath):
     """
@@ -63,82 +104,224 @@ def build_input_string(source_name, uid, filepath):
     base.append("--source-name=" + source_name)
     base.append("--skip-lines=" + str(util.LINE_SKIP))
     base.append("--time-format=" + util.TIME_FORMAT)
-    base.append("--report-dest=" + util.REPORT_DEST)
+    base.append("--report-dest=" + util.report_dest())
     base.append(filepath)
     return base
 
-def cleanup(uid):
+def make_scratch(uid):
+    """
+    Creates and returns a new scratch directory in util.SCRATCH for one
+    smap-load-csv run for stream UID.
+    """
+
+    if not os.path.isdir(util.SCRATCH):
+        try:
+            os.makedirs(util.SCRATCH)
+        except OSError:
+            if not os.path.isdir(util.SCRATCH):
+                raise
+    return tempfile.mkdtemp(prefix=uid + "_", dir=util.SCRATCH)
+
+def cleanup(scratch):
     """
     The smap-load-csv script generates files for buffering when it runs.
-    These files are located in the same directory as this script.
-    If the load is successful, we no longer need those files. The created
-    files are prefixed with UID.
+    These files are located in its working directory, the scratch directory
+    SCRATCH of the load. Once the load is over, whether it succeeded or not,
+    we no longer need those files: a retry runs in a new scratch directory.
     """
 
-    cwd = os.getcwd()
     print("Cleaning up ..."),
-    for filename in os.listdir(cwd):
-        if uid in filename:
-	    path = os.path.join(cwd, filename)
-            if os.path.isfile(path):
-                os.remove(path)
-            else:
-                shutil.rmtree(path, ignore_errors = True)
+    shutil.rmtree(scratch, ignore_errors = True)
     print("done")
 
-def load(filepath):
+def get_publisher():
+    """
+    Returns the native sMAP publisher of the calling thread, creating it on
+    first use so that its connection is shared by all files the thread loads.
+    """
+
+    publisher = getattr(LOCAL, "publisher", None)
+    if publisher is None:
+        publisher = LOCAL.publisher = smap_publish.Publisher()
+    return publisher
+
+def publish(source_name, uid, filepath):
+    """
+    Posts the data file FILEPATH to the sMAP server with the native
+    publisher. Each acknowledged batch is checkpointed in the journal, and
+    the readings an earlier attempt already sent are skipped. Returns TRUE
+    if the load succeeded, FALSE otherwise.
+    """
+
+    stamp = journal.file_stamp(filepath)
+    start = journal.load_offset(filepath, stamp)
+    if start:
+        print("Resuming after %d readings already sent" % (start))
+    acked = lambda sent: journal.checkpoint(filepath, sent, stamp)
+    try:
+        count = get_publisher().publish_file(filepath, source_name, uid,
+                                             start, acked)
+    except smap_publish.PublishError, e:
+        print("[ERROR] %s" % (e))
+        return False
+    print("Posted %d readings" % (count))
+    metrics.put("rows", count)
+    return True
+
+def load(filepath, native=False):
     """
     Loads the data file FILEPATH into the sMAP server. Assumes that FILEPATH
     has already been processed by the extract_data script. Returns TRUE if
-    the load succeeded, FALSE otherwise.
+    the load succeeded, FALSE otherwise. If NATIVE is TRUE, the data is
+    posted in-process instead of with smap-load-csv.
+    """
+
+    with metrics.timed("load", filepath) as event:
+        event["bytes_read"] = metrics.file_size(filepath)
+        source_name = get_meter_id(filepath)
+        print("Handling %s" % filepath)
+        uid = get_uuid(source_name)
+        if not uid:
+            uid = assign_uuid(source_name)
+        if native:
+            status = publish(source_name, uid, filepath)
+        else:
+            status = load_csv(source_name, uid, filepath)
+        if status:
+            watermark.record(uid, filepath)
+            meter_catalog.learn(get_meter_title(filepath), source_name)
+        event["ok"] = bool(status)
+        return status
+
+def load_csv(source_name, uid, filepath):
+    """
+    Loads the data file FILEPATH into stream UID of SOURCE_NAME with
+    smap-load-csv. Returns TRUE if the load succeeded, FALSE otherwise.
+    A compressed file is decompressed into the scratch directory first.
     """
 
-    source_name = get_meter_id(filepath)
-    print("Handling %s" % filepath)
-    uid = get_uuid(source_name)
-    if not uid:
-        uid = assign_uuid(source_name)
     status = ""
+    scratch = make_scratch(uid)
     try:
-        cmd = build_input_string(source_name, uid, filepath)
-        status = subprocess.check_output(cmd)
-    except subprocess.CalledProcessError, e:
-        print("[ERROR] code %d" % (e.returncode))
-        print("[ERROR] %s" % (e.output))
-        return False
-    # Server error -- command can have 0 exit code but not actually work.
-    if "reply" in status.lower():
-        return False
+        if archive.strip(filepath) != filepath:
+            plain = os.path.join(scratch,
+                                 os.path.basename(archive.strip(filepath)))
+            with archive.open_data(filepath) as data:
+                with open(plain, 'wb') as output:
+                    shutil.copyfileobj(data, output)
+            filepath = plain
+        try:
+            cmd = build_input_string(source_name, uid, filepath)
+            status = subprocess.check_output(cmd, cwd=scratch)
+        except subprocess.CalledProcessError, e:
+            print("[ERROR] code %d" % (e.returncode))
+            print("[ERROR] %s" % (e.output))
+            return False
+        # Server error -- command can have 0 exit code but not actually work.
+        return "reply" not in status.lower()
+    finally:
+        cleanup(scratch)
 
-    cleanup(uid)
-    return True
+def sidecar_paths(filepath):
+    """
+    Returns the paths of the files kept next to the data file FILEPATH (its
+    cached series and validation report), which are archived along with it.
+    """
+
+    base = os.path.splitext(archive.strip(filepath))[0]
+    return [ base + suffix
+             for suffix in util.CACHE_SUFFIXES + (util.REPORT_SUFFIX,) ]
+
+def load_archive(filepath, native=False, check=False):
+    """
+    Loads the data file FILEPATH and moves it to the archived directory if
+    the load succeeded, compressing it if util.ARCHIVE_COMPRESSION is set.
+    If CHECK is TRUE, the file is validated first and not loaded if it is
+    invalid. A file the ledger shows was loaded before is deleted instead.
+    Returns a (FILEPATH, STATUS) tuple.
+    """
 
-def load_all():
+    skip, digest = ledger.seen("load", filepath)
+    if skip:
+        for path in [ filepath ] + sidecar_paths(filepath):
+            if os.path.exists(path):
+                os.remove(path)
+        print("[SKIP] %s" % filepath)
+        return (filepath, True)
+    journal.begin(filepath, "load", stamp=journal.file_stamp(filepath))
+    valid = True
+    if check:
+        import validate
+        valid = validate.validate(filepath)["ok"]
+    status = load(filepath, native) if valid else False
+    if not status:
+        journal.failed(filepath, "load")
+        print("[FAIL] %s" % filepath)
+    else:
+        archive.archive_file(filepath)
+        for path in sidecar_paths(filepath):
+            if os.path.exists(path):
+                os.rename(path,
+                          os.path.join(util.ARCHIVED, os.path.basename(path)))
+        journal.done(filepath, "load")
+        ledger.record("load", digest, filepath)
+        print("[OK] %s" % filepath)
+    return (filepath, status)
+
+def load_all(native=False, workers=1, check=False):
     """
     Loads all processed data files in the finished directory into the sMAP
-    server. Loaded files are then moved to the archived directory.
+    server. Loaded files are then moved to the archived directory. If NATIVE
+    is TRUE, the native publisher is used instead of smap-load-csv. Up to
+    WORKERS files are loaded at once. If CHECK is TRUE, invalid files are
+    not loaded. Returns a list of (FILEPATH, STATUS) tuples, one per file.
+    Raises util.ConfigError if the sMAP server is not configured.
     """
 
+    util.report_dest()
     print("Begin loading ...\n")
+    filepaths = []
     for filename in os.listdir(util.FINISHED):
-	filepath = os.path.join(util.FINISHED, filename)
-        if os.path.isfile(filepath):
-            ext = os.path.splitext(filename)[1]
-            if ext.lower() == ".csv":
-                status = load(filepath)
-                if not status:
-                    print("[FAIL]")
-                else:
-		    os.rename(filepath, os.path.join(util.ARCHIVED, filename))
-                    print("[OK]")
+        filepath = os.path.join(util.FINISHED, filename)
+        if os.path.isfile(filepath) and archive.is_data_file(filename):
+            filepaths.append(filepath)
+    # Assign any missing UUIDs up front so the map is written once.
+    assign_uuids(filepaths)
+    if workers > 1 and len(filepaths) > 1:
+        pool = ThreadPool(min(workers, len(filepaths)))
+        try:
+            results = pool.map(lambda path: load_archive(path, native, check),
+                               filepaths, 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [ load_archive(path, native, check) for path in filepaths ]
+    print_summary(results)
     print("\nLoading done.")
+    return results
+
+def print_summary(results):
+    """
+    Prints the outcome of each (FILEPATH, STATUS) tuple in RESULTS.
+    """
+
+    failed = [ path for path, status in results if not status ]
+    print("\nLoaded %d of %d files." % (len(results) - len(failed),
+                                       len(results)))
+    for path in failed:
+        print("  [FAIL] %s" % path)
 
-def main():
+def main(native=False, workers=1, check=False):
     """
-    Main function.
+    Main function. If NATIVE is TRUE, data is posted with the native
+    publisher instead of smap-load-csv. Up to WORKERS files are loaded at
+    once. If CHECK is TRUE, files are validated before they are loaded.
     """
 
-    load_all()
+    load_all(native, workers, check)
+    journal.compact()
+    metrics.flush()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+"""
+Browserless alternative to get_data.py. Instead of driving Firefox through
+Selenium, this script talks to BuildingOS with plain HTTP requests: it logs
+in with the login form, reads the meter list from the export form, submits
+the export and downloads the resulting zip file once its link appears.
+
+The user is prompted for the same inputs as get_data.py (meters, date range
+and export file name).
+"""
+
+from HTMLParser import HTMLParser
+import cookielib
+import os
+import shutil
+import sys
+import urllib
+import urllib2
+import urlparse
+
+from query import (get_dates, get_meters, get_user_login, get_export_name,
+                   export_name)
+import meter_catalog
+import metrics
+import polling
+import util
+import watermark
+
+class LucidError(Exception):
+    """
+    Raised when BuildingOS does not respond as expected.
+    """
+
+class PageParser(HTMLParser):
+    """
+    Collects the title, the links and the forms of an HTML page. Each form is
+    a dict with its attributes, its "fields" (a list of (name, value) pairs
+    of the inputs that are submitted by default) and its "selects" (a dict of
+    select name to a list of (value, label) options).
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.title = ""
+        self.links = []
+        self.forms = []
+        self.form = None
+        self.select = None
+        self.option = None
+        self.link = None
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "title":
+            self.in_title = True
+        elif tag == "a":
+            self.link = [ attrs.get("href"), "" ]
+        elif tag == "form":
+            self.form = dict(attrs, fields=[], selects={})
+            self.forms.append(self.form)
+        elif self.form is None:
+            return
+        elif tag == "input" and attrs.get("name"):
+            kind = attrs.get("type", "text").lower()
+            if kind not in ("submit", "button", "checkbox", "radio") or \
+                    "checked" in attrs:
+                self.form["fields"].append((attrs["name"],
+                                            attrs.get("value", "")))
+        elif tag == "select" and attrs.get("name"):
+            self.select = self.form["selects"].setdefault(attrs["name"], [])
+        elif tag == "option" and self.select is not None:
+            self.option = [ attrs.get("value"), "" ]
+            self.select.append(self.option)
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag == "a" and self.link:
+            self.links.append((self.link[0], self.link[1].strip()))
+            self.link = None
+        elif tag == "form":
+            self.form = None
+        elif tag == "select":
+            self.select = None
+        elif tag == "option":
+            self.option = None
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        if self.link:
+            self.link[1] += data
+        if self.option:
+            self.option[1] += data
+
+def parse_page(html):
+    """
+    Returns a PageParser fed with HTML.
+    """
+
+    parser = PageParser()
+    parser.feed(html.decode("utf-8", "replace"))
+    parser.close()
+    return parser
+
+class LucidSession(object):
+    """
+    A logged-in (once login() succeeds) HTTP session with BuildingOS at
+    BASE_URL, downloading exports into DIRECTORY (default util.DATA_PATH).
+    """
+
+    def __init__(self, base_url=None, directory=None):
+        self.base_url = base_url or util.URL
+        self.directory = directory or util.DATA_PATH
+        self.jar = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.jar))
+        self.opener.addheaders = [ ("User-Agent", "LBNL-lucid") ]
+        self.export_list_url = None
+
+    def url(self, path):
+        return urlparse.urljoin(self.base_url, path)
+
+    def open(self, url, fields=None, referer=None):
+        """
+        Requests URL, posting the (name, value) pairs FIELDS if given.
+        Returns the response object.
+        """
+
+        data = None
+        if fields is not None:
+            data = urllib.urlencode([ (name, unicode(value).encode("utf-8"))
+                                      for name, value in fields ])
+        request = urllib2.Request(url, data)
+        if referer:
+            request.add_header("Referer", referer)
+        try:
+            return self.opener.open(request, timeout=util.HTTP_TIMEOUT)
+        except urllib2.URLError, e:
+            raise LucidError("request to %s failed: %s" % (url, e))
+
+    def page(self, url, fields=None, referer=None):
+        """
+        Requests URL like open() and returns (final url, parsed page).
+        """
+
+        response = self.open(url, fields, referer)
+        try:
+            return (response.geturl(), parse_page(response.read()))
+        finally:
+            response.close()
+
+    def submit(self, url, page, form, fields):
+        """
+        Submits FORM of PAGE, loaded from URL, with its default fields
+        overridden by the (name, value) pairs FIELDS. Returns (final url,
+        parsed page) of the response.
+        """
+
+        names = set(name for name, _ in fields)
+        data = [ (name, value) for name, value in form["fields"]
+                 if name not in names ]
+        data += fields
+        action = urlparse.urljoin(url, form.get("action") or url)
+        return self.page(action, data, url)
+
+    def login(self, user, passwd):
+        """
+        Logs in as USER with password PASSWD. Returns TRUE on success.
+        """
+
+        url, page = self.page(self.base_url)
+        form = find_form(page, "username")
+        if form is None:
+            raise LucidError("login form not found")
+        _, home = self.submit(url, page, form, [ ("username", user),
+                                                 ("password", passwd) ])
+        return "home" in home.title.lower()
+
+    def logged_in(self):
+        """
+        Returns TRUE if the session is still logged in, i.e. the export page
+        is served instead of the login form.
+        """
+
+        try:
+            self.export_page()
+            return True
+        except LucidError:
+            return False
+
+    def export_page(self):
+        """
+        Returns (url, parsed page) of the data export page.
+        """
+
+        url, page = self.page(self.url(util.EXPORT_PATH))
+        if not "export" in page.title.lower():
+            raise LucidError("Export page not available.")
+        return url, page
+
+    def list_meters(self):
+        """
+        Returns the meters available for export as (value, title) pairs, in
+        the order of the meter picker.
+        """
+
+        _, page = self.export_page()
+        form = find_form(page, "name")
+        if form is None or util.EXPORT_POINTS not in form["selects"]:
+            raise LucidError("meter list not found on export page")
+        return [ (value, title.strip())
+                 for value, title in form["selects"][util.EXPORT_POINTS] ]
+
+    def meter_titles(self):
+        """
+        Returns the titles of the meters available for export, from the meter
+        catalog.
+        """
+
+        return meter_catalog.titles(meter_catalog.get(self.list_meters))
+
+    def submit_export(self, meter_list, start_date, end_date, name,
+                      meters=None):
+        """
+        Submits an export of the meters titled METER_LIST from START_DATE to
+        END_DATE (MM/DD/YYYY) at the finest resolution, named NAME. METERS
+        is the (value, title) list from list_meters(), read from the form if
+        not given or if it lacks the values (e.g. a catalog scraped by the
+        browser). Returns the number of meters submitted.
+        """
+
+        url, page = self.export_page()
+        form = find_form(page, "name")
+        if meters is None or None in [ value for value, _ in meters ]:
+            meters = [ (value, title.strip()) for value, title in
+                       form["selects"].get(util.EXPORT_POINTS, []) ]
+        values = dict((title, value) for value, title in meters)
+        missing = [ title for title in meter_list if title not in values ]
+        if missing:
+            raise LucidError("unknown meters: %s" % ", ".join(missing))
+        fields = [ ("name", name), ("start", start_date), ("end", end_date),
+                   ("resolution", "1") ]
+        fields += [ (util.EXPORT_POINTS, values[title])
+                    for title in meter_list ]
+        self.export_list_url, _ = self.submit(url, page, form, fields)
+        return len(meter_list)
+
+    def export_links(self):
+        """
+        Returns a dict of the names of the ready exports to their download
+        URLs, from one load of the export list.
+        """
+
+        url, page = self.page(self.export_list_url or
+                              self.url(util.EXPORT_LIST_PATH))
+        return dict((text, urlparse.urljoin(url, href))
+                    for href, text in page.links if href)
+
+    def find_export(self, export_string):
+        """
+        Returns the download URL of the export named EXPORT_STRING, None if
+        it is not ready yet.
+        """
+
+        return self.export_links().get(export_string)
+
+    def wait_for_export(self, export_string, timeout=None):
+        """
+        Polls for the download link of EXPORT_STRING with backoff until
+        TIMEOUT seconds (default util.EXPORT_DEADLINE) have passed. Returns
+        the URL, or None if it never appeared.
+        """
+
+        return polling.poll(lambda: self.find_export(export_string), timeout)
+
+    def download(self, url, directory=None):
+        """
+        Downloads URL into DIRECTORY (default the session's directory). The
+        file is written under a .part name and renamed once complete. Returns
+        the path of the downloaded file.
+        """
+
+        directory = directory or self.directory
+        response = self.open(url)
+        try:
+            filename = response_filename(response)
+            filepath = os.path.join(directory, filename)
+            with open(filepath + ".part", 'wb') as output:
+                shutil.copyfileobj(response, output)
+        finally:
+            response.close()
+        os.rename(filepath + ".part", filepath)
+        return filepath
+
+    def export(self, meter_list, start_date, end_date, export_string,
+               meters=None):
+        """
+        Submits an export of the meters titled METER_LIST from START_DATE to
+        END_DATE named EXPORT_STRING, waits for it and downloads it. METERS
+        is as for submit_export(). Returns the path of the downloaded file.
+        """
+
+        with metrics.timed("fetch", export_string) as event:
+            count = self.submit_export(meter_list, start_date, end_date,
+                                       export_string, meters)
+            event["meters"] = count
+            print("Number of points selected: %d" % count)
+            print("Waiting for download to be ready.")
+            link = self.wait_for_export(export_string)
+            if not link:
+                raise LucidError("Link not found")
+            print("Link found.")
+            filepath = self.download(link)
+            print("Downloaded file: %s" % filepath)
+            event["bytes_written"] = metrics.file_size(filepath)
+            return filepath
+
+def find_form(page, field):
+    """
+    Returns the first form of PAGE with an input or select named FIELD.
+    """
+
+    for form in page.forms:
+        names = [ name for name, _ in form["fields"] ] + form["selects"].keys()
+        if field in names:
+            return form
+    return None
+
+def response_filename(response):
+    """
+    Returns the file name of the download RESPONSE, from its
+    Content-Disposition header or else its URL.
+    """
+
+    disposition = response.info().getheader("content-disposition", "")
+    for part in disposition.split(";"):
+        key, _, value = part.strip().partition("=")
+        if key.lower() == "filename" and value:
+            return os.path.basename(value.strip('"'))
+    path = urlparse.urlsplit(response.geturl()).path
+    return os.path.basename(path) or "export.zip"
+
+def connect(user_mode=True, base_url=None):
+    """
+    Returns a new session logged in to BuildingOS at BASE_URL. If USER_MODE
+    is TRUE, prompts the user for credentials until the login succeeds.
+    Otherwise, uses the credentials from the environment variables and
+    raises LucidError if they are refused.
+    """
+
+    session = LucidSession(base_url)
+    while True:
+        if user_mode:
+            user, passwd = get_user_login()
+        else:
+            user, passwd = util.USER, util.PASS
+        if session.login(user, passwd):
+            print("Logged in as %s" % user)
+            return session
+        if not user_mode:
+            raise LucidError("log in failed.")
+        print("Incorrect email/password. Please try again.")
+
+def select_meters(meters):
+    """
+    Prompts the user to pick from METERS, a list of (value, title) pairs.
+    Returns the titles of the picked meters.
+    """
+
+    all_meters = [ title for _, title in meters ]
+    meter_indices = sorted(get_meters(all_meters))
+    return [ all_meters[index - 1] for index in meter_indices ]
+
+def main(user_mode=True, base_url=None):
+    """
+    Main function. If USER_MODE is set to TRUE, prompt the user for Lucid
+    login credentials. Otherwise, get login credentials from environment
+    variables. Returns the path of the downloaded file.
+    """
+
+    try:
+        session = connect(user_mode, base_url)
+        meters = meter_catalog.get(session.list_meters)
+        meter_list = select_meters(meters)
+        start_date, end_date = get_dates()
+        start_date = watermark.clip_start(meter_list, start_date, end_date)
+        export_string = export_name(get_export_name(), start_date, end_date)
+
+        return session.export(meter_list, start_date, end_date,
+                              export_string, meters)
+    except LucidError, e:
+        print("[ERROR] %s" % e)
+        sys.exit(1)
+    finally:
+        metrics.flush()
+
+if __name__ == "__main__":
+    main()
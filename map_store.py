@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Storage for the meter name - UUID mapping used by load_data.py.
+
+Two backends are available, selected by util.MAP_BACKEND:
+
+    csv     the info/map.csv file, indexed in memory. New entries are written
+            by atomically replacing the file while holding an exclusive lock,
+            so concurrent runs cannot lose each other's assignments.
+    sqlite  an SQLite database (util.MAP_DB). SQLite does its own locking.
+            On creation the database is seeded from the existing map.csv.
+
+Source names are matched case-insensitively by both backends. Assignments
+made inside a batch() block are written out together when the block ends.
+A store can be shared by several threads: a batch() block holds the store's
+lock, so the other threads wait for it to end.
+
+Usage (one-shot import of map.csv into the SQLite database):
+
+    python map_store.py [map.csv]
+"""
+
+from contextlib import contextmanager
+import csv
+import fcntl
+import os
+import sqlite3
+import sys
+import threading
+import uuid
+
+import util
+
+class CSVMapStore(object):
+    """
+    Meter name - UUID mapping kept in a two column csv file at PATH.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.rows = []
+        self.index = {}
+        self.stamp = None
+        self.lock = threading.RLock()
+        self.depth = 0              # batch() nesting of the LOCK holder
+
+    def reload(self):
+        """
+        Re-reads the map file if it changed since it was last read.
+        """
+
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.rows = []
+        self.index = {}
+        if stamp:
+            with open(self.path, 'rb') as mapfile:
+                for row in csv.reader(mapfile):
+                    if len(row) >= 2:
+                        self.add(row[0], row[1])
+        self.stamp = stamp
+
+    def add(self, source_name, uid):
+        """
+        Adds the SOURCE_NAME to UID entry to the in-memory index, unless the
+        name already has one.
+        """
+
+        key = source_name.lower()
+        if key not in self.index:
+            self.index[key] = uid
+            self.rows.append([source_name, uid])
+
+    def get(self, source_name):
+        """
+        Returns the UUID assigned to SOURCE_NAME, None if there is none.
+        """
+
+        with self.lock:
+            if not self.depth:
+                self.reload()
+            return self.index.get(source_name.lower())
+
+    def assign(self, source_name):
+        """
+        Returns the UUID of SOURCE_NAME, generating and recording a new one
+        if the name has none yet.
+        """
+
+        with self.batch():
+            uid = self.index.get(source_name.lower())
+            if not uid:
+                uid = str(uuid.uuid4())
+                self.add(source_name, uid)
+            return uid
+
+    @contextmanager
+    def batch(self):
+        """
+        Holds the map file lock for the duration of the block. New entries
+        are written out in one atomic replace when the outermost block ends.
+        """
+
+        with self.lock:
+            if self.depth:
+                yield self
+                return
+            lock_file = open(self.lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.depth += 1
+            try:
+                self.reload()
+                count = len(self.rows)
+                yield self
+                if len(self.rows) > count:
+                    self.write()
+            finally:
+                self.depth -= 1
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def write(self):
+        """
+        Atomically replaces the map file with the in-memory entries.
+        """
+
+        util.atomic_write(self.path,
+                          lambda f: csv.writer(f).writerows(self.rows))
+        self.stamp = None
+        self.reload()
+
+    def close(self):
+        pass
+
+class SQLiteMapStore(object):
+    """
+    Meter name - UUID mapping kept in the SQLite database at PATH.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The connection is shared by the threads using the store, one at a
+        # time under LOCK.
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS map ("
+                          "source_name TEXT PRIMARY KEY COLLATE NOCASE, "
+                          "uuid TEXT NOT NULL)")
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def get(self, source_name):
+        """
+        Returns the UUID assigned to SOURCE_NAME, None if there is none.
+        """
+
+        with self.lock:
+            row = self.conn.execute("SELECT uuid FROM map "
+                                    "WHERE source_name = ?",
+                                    (source_name,)).fetchone()
+        if row:
+            return str(row[0])
+        return None
+
+    def assign(self, source_name):
+        """
+        Returns the UUID of SOURCE_NAME, generating and recording a new one
+        if the name has none yet.
+        """
+
+        with self.batch():
+            uid = self.get(source_name)
+            if not uid:
+                uid = str(uuid.uuid4())
+                self.conn.execute("INSERT INTO map VALUES (?, ?)",
+                                  (source_name, uid))
+            return uid
+
+    @contextmanager
+    def batch(self):
+        """
+        Runs the block in one write transaction.
+        """
+
+        with self.lock:
+            if self.depth:
+                yield self
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield self
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+            finally:
+                self.depth -= 1
+
+    def import_csv(self, path):
+        """
+        Adds the entries of the csv map file at PATH that are not in the
+        database yet. Returns the number of entries added.
+        """
+
+        added = 0
+        with open(path, 'rb') as mapfile:
+            with self.batch():
+                for row in csv.reader(mapfile):
+                    if len(row) >= 2 and not self.get(row[0]):
+                        self.conn.execute("INSERT INTO map VALUES (?, ?)",
+                                          (row[0], row[1]))
+                        added += 1
+        return added
+
+    def close(self):
+        self.conn.close()
+
+def open_store(backend=None):
+    """
+    Returns the map store for BACKEND ("csv" or "sqlite"), defaulting to
+    util.MAP_BACKEND. A new SQLite database is seeded from util.MAP.
+    """
+
+    backend = backend or util.MAP_BACKEND
+    if backend == "csv":
+        return CSVMapStore(util.MAP)
+    elif backend == "sqlite":
+        is_new = not os.path.exists(util.MAP_DB)
+        store = SQLiteMapStore(util.MAP_DB)
+        if is_new and os.path.exists(util.MAP):
+            store.import_csv(util.MAP)
+        return store
+    raise ValueError("Unknown map backend: %s" % backend)
+
+def main():
+    """
+    Imports the csv map file given on the command line (default util.MAP)
+    into the SQLite database.
+    """
+
+    path = sys.argv[1] if len(sys.argv) > 1 else util.MAP
+    store = SQLiteMapStore(util.MAP_DB)
+    added = store.import_csv(path)
+    store.close()
+    print("Imported %d entries from %s into %s" % (added, path, util.MAP_DB))
+
+if __name__ == "__main__":
+    main()
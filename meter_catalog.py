@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Cached catalog of the meters available in Lucid. Scraping the meter picker
+(or parsing the export form) for thousands of meters is a large part of a
+run, so the meter list is kept in util.CATALOG and only fetched again once it
+is older than util.CATALOG_TTL seconds (LUCIDCATALOGTTL), or when the cache
+has been expired with run.py -r. Meter selection and validation run against
+the cached list.
+
+The catalog is a JSON object:
+
+    refreshed   time of the last refresh (epoch seconds)
+    meters      list of [value, title] pairs, in picker order. The value is
+                the export form's option value, null if the list was
+                scraped from the browser's picker.
+    added       titles that appeared at the last refresh
+    removed     titles that disappeared at the last refresh
+    ids         title to Lucid meter id of the meters listed without a value,
+                learned from the header rows of the files loaded since
+                (see learn()) and kept across refreshes
+
+Usage (show the catalog, or refresh it over HTTP with -r):
+
+    python meter_catalog.py [-r]
+"""
+
+import json
+import os
+import sys
+import time
+
+import util
+
+MAX_LISTED = 20                     # Added/removed meters printed per refresh
+
+def read():
+    """
+    Returns the catalog dict, None if there is no catalog yet.
+    """
+
+    if not os.path.exists(util.CATALOG):
+        return None
+    with open(util.CATALOG, 'rb') as f:
+        return json.load(f)
+
+def is_fresh(catalog, ttl=None):
+    """
+    Returns TRUE if CATALOG was refreshed less than TTL seconds (default
+    util.CATALOG_TTL) ago.
+    """
+
+    ttl = util.CATALOG_TTL if ttl is None else ttl
+    return catalog is not None and time.time() - catalog["refreshed"] < ttl
+
+def meters(catalog):
+    return [ (value, title) for value, title in catalog["meters"] ]
+
+def titles(meter_pairs):
+    """
+    Returns the titles of the (value, title) pairs METER_PAIRS.
+    """
+
+    return [ title for _, title in meter_pairs ]
+
+def ids(meter_titles, catalog=None):
+    """
+    Returns the Lucid meter ids (the export form's option values, which are
+    the source names of the streams) of the meters titled METER_TITLES, from
+    CATALOG (default the cached catalog). A title the catalog has no value
+    for, e.g. because it was scraped from the browser, is looked up in the
+    ids learned from loaded files, and returned as is if it is not there.
+    """
+
+    catalog = read() if catalog is None else catalog
+    values = {}
+    if catalog is not None:
+        values = dict(catalog.get("ids", {}))
+        values.update((title, value) for value, title in catalog["meters"]
+                      if value)
+    return [ values.get(title) or title for title in meter_titles ]
+
+def unknown(catalog, title, meter_id):
+    """
+    Returns TRUE if CATALOG lists the meter titled TITLE without a value and
+    has not learned METER_ID as its id yet.
+    """
+
+    if catalog is None or catalog.get("ids", {}).get(title) == meter_id:
+        return False
+    return [ None, title ] in catalog["meters"]
+
+def learn(title, meter_id):
+    """
+    Records METER_ID, read from the header rows of a loaded file, as the id
+    of the meter titled TITLE if the catalog lists it without a value, so
+    that exports selecting meters by title can find their watermarks.
+    """
+
+    if not unknown(read(), title, meter_id):
+        return
+    with util.file_lock(util.CATALOG):
+        catalog = read()
+        if unknown(catalog, title, meter_id):
+            catalog.setdefault("ids", {})[title] = meter_id
+            write(catalog)
+
+def expire():
+    """
+    Marks the catalog as stale, so that the next run refreshes it. The meter
+    list is kept to report the changes against.
+    """
+
+    with util.file_lock(util.CATALOG):
+        catalog = read()
+        if catalog is not None:
+            catalog["refreshed"] = 0
+            write(catalog)
+
+def write(catalog):
+    util.atomic_write(util.CATALOG, lambda f: json.dump(catalog, f,
+                      sort_keys=True))
+
+def refresh(fetch):
+    """
+    Replaces the catalog with the (value, title) pairs returned by FETCH and
+    reports the meters that were added or removed since the last refresh.
+    Returns the pairs.
+    """
+
+    print("Refreshing meter catalog...")
+    new = [ [ value, title ] for value, title in fetch() ]
+    with util.file_lock(util.CATALOG):
+        old = read()
+        catalog = { "refreshed": time.time(), "meters": new,
+                    "added": [], "removed": [] }
+        if old is not None:
+            old_titles = set(titles(old["meters"]))
+            new_titles = set(titles(new))
+            catalog["added"] = sorted(new_titles - old_titles)
+            catalog["removed"] = sorted(old_titles - new_titles)
+            if "ids" in old:
+                catalog["ids"] = old["ids"]
+        write(catalog)
+    report(catalog)
+    return meters(catalog)
+
+def report(catalog):
+    """
+    Prints the size of CATALOG and the changes of its last refresh.
+    """
+
+    print("Meter catalog: %d meters, %d added, %d removed."
+          % (len(catalog["meters"]), len(catalog["added"]),
+             len(catalog["removed"])))
+    for key, sign in (("added", "+"), ("removed", "-")):
+        for title in catalog[key][:MAX_LISTED]:
+            print("  %s %s" % (sign, title))
+        if len(catalog[key]) > MAX_LISTED:
+            print("  ... and %d more" % (len(catalog[key]) - MAX_LISTED))
+
+def get(fetch, refresh_now=False):
+    """
+    Returns the (value, title) pairs of the meters available in Lucid from
+    the catalog, refreshing it with FETCH if it is stale, missing, or
+    REFRESH_NOW is TRUE. FETCH returns (value, title) pairs.
+    """
+
+    catalog = read()
+    if refresh_now or not is_fresh(catalog):
+        return refresh(fetch)
+    return meters(catalog)
+
+def main():
+    """
+    Prints the catalog status. With -r, logs in with the environment
+    credentials and refreshes it over HTTP first.
+    """
+
+    if "-r" in sys.argv[1:]:
+        import lucid_client
+        session = lucid_client.connect(False)
+        refresh(session.list_meters)
+        return
+    catalog = read()
+    if catalog is None:
+        print("No meter catalog yet.")
+        return
+    if catalog["refreshed"]:
+        print("Refreshed %s (%s)." % (time.strftime("%Y-%m-%d %H:%M",
+              time.localtime(catalog["refreshed"])),
+              "fresh" if is_fresh(catalog) else "stale"))
+    else:
+        print("Expired.")
+    report(catalog)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Per-stage run metrics. Each stage records one event per file it handles
+(per export for the fetch stage) with its wall time and, where they apply,
+the bytes read and written, rows, rows dropped, meters, retries and polls:
+
+    fetch   export polling and download
+    extract zip extraction (or streamed extraction and splitting with -s)
+    split   splitting and trimming of csv files
+    rollup  hourly, daily and monthly rollups (see rollup.py)
+    compact compaction of split files (see compact.py)
+    load    upload to sMAP
+
+flush() appends the events recorded since the last flush to util.METRICS_LOG
+as JSON lines, and rewrites the Prometheus textfile collector file
+util.METRICS_PROM with the per-stage totals of the run. The scripts flush at
+the end of their main functions.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+import util
+
+FIELDS = ("bytes_read", "bytes_written", "rows", "rows_dropped", "meters",
+          "retries", "polls")
+
+RUN_ID = "%s-%d" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+STARTED = time.time()
+LOCK = threading.Lock()
+EVENTS = []                 # Events not flushed yet
+TOTALS = {}                 # Stage name to the totals of its events
+LOCAL = threading.local()   # Stack of the open events of each thread
+
+@contextmanager
+def timed(stage, name=None):
+    """
+    Records the block as one event of STAGE for file or export NAME. Counts
+    are added to the event with incr() and put() from within the block, on
+    the same thread. The event is marked failed if the block raises.
+    """
+
+    event = new_event(stage, name)
+    stack = current_stack()
+    stack.append(event)
+    try:
+        yield event
+    except:
+        event["ok"] = False
+        raise
+    finally:
+        stack.remove(event)
+        event["seconds"] = round(time.time() - event["start"], 3)
+        add(event)
+
+def new_event(stage, name=None):
+    return { "run": RUN_ID, "stage": stage, "name": name,
+             "start": time.time(), "ok": True }
+
+def current_stack():
+    stack = getattr(LOCAL, "stack", None)
+    if stack is None:
+        stack = LOCAL.stack = []
+    return stack
+
+def incr(field, n=1):
+    """
+    Adds N to FIELD of the innermost open event of the calling thread, if
+    there is one.
+    """
+
+    stack = current_stack()
+    if stack:
+        stack[-1][field] = stack[-1].get(field, 0) + n
+
+def put(field, value):
+    """
+    Sets FIELD of the innermost open event of the calling thread to VALUE.
+    """
+
+    stack = current_stack()
+    if stack:
+        stack[-1][field] = value
+
+def drain():
+    """
+    Removes the unflushed events and returns them, e.g. to hand the events
+    of a worker process over to its parent, which add()s them.
+    """
+
+    with LOCK:
+        events = EVENTS[:]
+        del EVENTS[:]
+    return events
+
+def file_size(filepath):
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+def reset():
+    """
+    Starts a new run, for long-running processes such as the daemon: the
+    totals are cleared, so flush() before calling this.
+    """
+
+    global RUN_ID, STARTED
+    with LOCK:
+        RUN_ID = "%s-%d" % (time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+        STARTED = time.time()
+        TOTALS.clear()
+
+def add(event):
+    """
+    Records the finished EVENT (see new_event) and adds it to the totals of
+    its stage. EVENT must have its "seconds" set.
+    """
+
+    with LOCK:
+        EVENTS.append(event)
+        totals = TOTALS.setdefault(event["stage"],
+            dict.fromkeys(("events", "failures", "seconds") + FIELDS, 0))
+        totals["events"] += 1
+        totals["failures"] += not event["ok"]
+        totals["seconds"] += event["seconds"]
+        for field in FIELDS:
+            totals[field] += event.get(field, 0)
+
+def flush():
+    """
+    Appends the unflushed events to util.METRICS_LOG and rewrites
+    util.METRICS_PROM with the totals of the run so far.
+    """
+
+    events = drain()
+    with LOCK:
+        totals = dict((stage, dict(t)) for stage, t in TOTALS.items())
+    if events:
+        with util.file_lock(util.METRICS_LOG):
+            with open(util.METRICS_LOG, 'a') as log:
+                for event in events:
+                    log.write(json.dumps(event, sort_keys=True) + "\n")
+    if totals:
+        util.atomic_write(util.METRICS_PROM,
+                          lambda f: f.write(prometheus(totals)))
+
+def prometheus(totals):
+    """
+    Returns the Prometheus text exposition of the stage TOTALS.
+    """
+
+    lines = []
+    for field in ("events", "failures", "seconds") + FIELDS:
+        metric = "lucid_stage_%s" % field
+        lines.append("# HELP %s Stage %s in the last run." % (metric, field))
+        lines.append("# TYPE %s gauge" % metric)
+        for stage in sorted(totals):
+            value = totals[stage][field]
+            if isinstance(value, float):
+                value = round(value, 3)
+            lines.append("%s{stage=\"%s\"} %s" % (metric, stage, value))
+    lines.append("# HELP lucid_last_run_start_seconds Start time of the last "
+                 "run.")
+    lines.append("# TYPE lucid_last_run_start_seconds gauge")
+    lines.append("lucid_last_run_start_seconds %d" % STARTED)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,237 @@
+"""
+Pipelined version of run.py. Instead of running get_data, extract_data and
+load_data one after the other, the three stages run at the same time:
+
+    fetch   get_data (or fetch_pool with several sessions) downloads zip
+            files into the data directory.
+    extract each zip file is extracted as soon as the fetch stage has
+            finished downloading it. Zip files already in the data directory
+            when the pipeline starts are extracted first.
+    split   each extracted csv file is split into per-meter files, and their
+            meters are assigned UUIDs.
+    load    each per-meter file is loaded into sMAP (and archived) as soon
+            as it is ready, by one or more load workers.
+
+The stages are connected by queues, bounded (util.PIPELINE_QUEUE_SIZE) after
+the extract stage. The extract stage only takes the files the fetch stage
+hands it, never files it finds in the data directory while downloads are
+running, so that it cannot remove a download the fetch stage is still
+watching. Exports can then be split and loaded out of date order, so rows
+are trimmed against the watermarks frozen when the run starts (see
+watermark.py). If a stage fails, the other stages stop taking new work and
+the pipeline shuts down.
+"""
+
+import os
+import Queue
+import threading
+import traceback
+import zipfile
+
+import extract_data
+import load_data
+import metrics
+import polling
+import util
+import watermark
+
+DONE = None                 # Queue sentinel marking the end of the input
+
+class Pipeline(object):
+    """
+    One pipelined run. If FETCH is FALSE, only the zip files already in the
+    data directory are processed. USER_MODE is passed to get_data.main (or
+    lucid_client.main if BROWSERLESS is TRUE, or fetch_pool.main with
+    FETCHERS sessions if FETCHERS is more than 1), and STREAM, NATIVE,
+    WORKERS and CHECK select the extract and load modes.
+    """
+
+    def __init__(self, user_mode=True, fetch=True, stream=False, native=False,
+                 workers=1, browserless=False, check=False, fetchers=1):
+        self.user_mode = user_mode
+        self.fetch = fetch
+        self.fetchers = fetchers
+        self.browserless = browserless
+        self.stream = stream
+        self.native = native
+        self.check = check
+        self.workers = max(1, workers)
+        self.failed = threading.Event()
+        self.extract_queue = Queue.Queue()
+        self.split_queue = Queue.Queue(util.PIPELINE_QUEUE_SIZE)
+        self.load_queue = Queue.Queue(util.PIPELINE_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.results = []
+
+    def put(self, queue, item):
+        """
+        Puts ITEM on QUEUE, waiting for room. Returns FALSE without putting
+        the item if the pipeline failed in the meantime.
+        """
+
+        while not self.failed.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def get(self, queue):
+        """
+        Returns the next item from QUEUE, or DONE if the pipeline failed.
+        """
+
+        while not self.failed.is_set():
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+        return DONE
+
+    def stage(self, name, target, *args):
+        """
+        Returns a thread running the stage TARGET(*ARGS). An exception in
+        the stage marks the pipeline as failed.
+        """
+
+        def run():
+            try:
+                target(*args)
+            except BaseException, e:
+                if not isinstance(e, SystemExit):
+                    traceback.print_exc()
+                print("[ERROR] %s stage failed, shutting down." % name)
+                self.failed.set()
+        return threading.Thread(target=run, name=name)
+
+    def fetch_stage(self):
+        try:
+            if self.fetchers > 1:
+                import fetch_pool
+                fetch_pool.main(self.user_mode, self.browserless,
+                                self.fetchers, ready=self.downloaded)
+            elif self.browserless:
+                import lucid_client
+                self.downloaded(lucid_client.main(self.user_mode))
+            else:
+                import get_data
+                self.downloaded(get_data.main(self.user_mode))
+        finally:
+            self.put(self.extract_queue, DONE)
+
+    def downloaded(self, filepath):
+        """
+        Hands the finished download FILEPATH to the extract stage.
+        """
+
+        if filepath:
+            self.put(self.extract_queue, filepath)
+
+    def ready_zips(self):
+        """
+        Returns the zip files in the data directory that are completely
+        downloaded.
+        """
+
+        ready = []
+        for filename in sorted(os.listdir(util.DATA_PATH)):
+            filepath = os.path.join(util.DATA_PATH, filename)
+            if not polling.is_partial(filename) and \
+                    zipfile.is_zipfile(filepath):
+                ready.append(filepath)
+        return ready
+
+    def extract_stage(self):
+        try:
+            while True:
+                filepath = self.get(self.extract_queue)
+                if filepath is DONE:
+                    break
+                if self.stream:
+                    paths = extract_data.stream_extract(filepath)
+                else:
+                    paths = extract_data.extract(filepath)
+                os.remove(filepath)
+                for path in paths:
+                    if os.path.splitext(path)[1].lower() == ".csv":
+                        if not self.put(self.split_queue, path):
+                            return
+        finally:
+            self.put(self.split_queue, DONE)
+
+    def split_stage(self):
+        try:
+            while True:
+                filepath = self.get(self.split_queue)
+                if filepath is DONE:
+                    break
+                paths = extract_data.process(filepath)
+                # Assigned here, in one thread, so that the load workers
+                # only look UUIDs up.
+                load_data.assign_uuids(paths)
+                for path in paths:
+                    if not self.put(self.load_queue, path):
+                        return
+        finally:
+            for _ in range(self.workers):
+                self.put(self.load_queue, DONE)
+
+    def load_stage(self):
+        while True:
+            filepath = self.get(self.load_queue)
+            if filepath is DONE:
+                break
+            result = load_data.load_archive(filepath, self.native,
+                                              self.check)
+            with self.lock:
+                self.results.append(result)
+
+    def run(self):
+        """
+        Runs the pipeline. Returns TRUE if every stage finished and every
+        file was loaded.
+        """
+
+        # Taken before the fetch stage starts, so that no download of this
+        # run can be among them.
+        for filepath in self.ready_zips():
+            self.extract_queue.put(filepath)
+        if self.fetch:
+            fetcher = self.stage("fetch", self.fetch_stage)
+            # The fetch stage may be blocked on user input; do not wait for
+            # it when shutting down after a failure.
+            fetcher.daemon = True
+            fetcher.start()
+        else:
+            self.extract_queue.put(DONE)
+        threads = [ self.stage("extract", self.extract_stage),
+                    self.stage("split", self.split_stage) ]
+        threads += [ self.stage("load", self.load_stage)
+                     for _ in range(self.workers) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        load_data.print_summary(self.results)
+        if self.failed.is_set():
+            return False
+        return all(status for _, status in self.results)
+
+def main(user_mode=True, fetch=True, stream=False, native=False, workers=1,
+         browserless=False, check=False, fetchers=1):
+    """
+    Main function. Returns TRUE if the pipelined run succeeded.
+    """
+
+    watermark.freeze()
+    try:
+        return Pipeline(user_mode, fetch, stream, native, workers, browserless,
+                        check, fetchers).run()
+    finally:
+        watermark.thaw()
+        metrics.flush()
+
+if __name__ == "__main__":
+    main(fetch=False)
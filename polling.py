@@ -0,0 +1,87 @@
+"""
+Waiting helpers for the exporters (get_data.py and lucid_client.py).
+
+Export links are polled with exponential backoff and jitter until a deadline
+instead of at a fixed period, so small exports are picked up quickly and
+large ones do not hammer the site. Downloads are watched in the download
+directory until the final file exists, its size is stable and it is a valid
+zip file, so the next stage never sees a half-written download.
+"""
+
+import os
+import random
+import time
+import zipfile
+
+import metrics
+import util
+
+def backoff_delays(deadline):
+    """
+    Returns a generator of delays (in seconds) between polls. The delays
+    start at util.POLL_MIN, grow by util.POLL_BACKOFF up to util.POLL_MAX,
+    are randomized by +/- util.POLL_JITTER and stop at the time DEADLINE.
+    """
+
+    delay = util.POLL_MIN
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        jitter = 1 + random.uniform(-util.POLL_JITTER, util.POLL_JITTER)
+        yield min(delay * jitter, remaining)
+        delay = min(delay * util.POLL_BACKOFF, util.POLL_MAX)
+
+def poll(check, timeout=None):
+    """
+    Calls CHECK after each backoff delay until it returns a true value, which
+    is returned, or until TIMEOUT seconds (default util.EXPORT_DEADLINE) have
+    passed, in which case None is returned.
+    """
+
+    if timeout is None:
+        timeout = util.EXPORT_DEADLINE
+    for delay in backoff_delays(time.time() + timeout):
+        time.sleep(delay)
+        metrics.incr("polls")
+        result = check()
+        if result:
+            return result
+    return None
+
+def is_partial(filename):
+    """
+    Returns TRUE if FILENAME is an in-progress download.
+    """
+
+    return filename.endswith(".part") or filename.endswith(".crdownload")
+
+def wait_for_download(directory, before, timeout=None):
+    """
+    Waits for a new file, one not in the set of file names BEFORE, to finish
+    downloading into DIRECTORY: no partial download is left, its size has
+    not changed for util.DOWNLOAD_STABLE_CHECKS checks and it is a valid zip
+    file. Returns the path of the file, or None if that did not happen within
+    TIMEOUT seconds (default util.DOWNLOAD_DEADLINE).
+    """
+
+    if timeout is None:
+        timeout = util.DOWNLOAD_DEADLINE
+    deadline = time.time() + timeout
+    sizes = {}
+    while time.time() < deadline:
+        names = set(os.listdir(directory)) - set(before)
+        partial = any(is_partial(name) for name in names)
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if is_partial(name) or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            last, count = sizes.get(name, (None, 0))
+            count = count + 1 if size == last else 1
+            sizes[name] = (size, count)
+            if not partial and count >= util.DOWNLOAD_STABLE_CHECKS and \
+                    zipfile.is_zipfile(path):
+                return path
+        time.sleep(util.DOWNLOAD_CHECK_PERIOD)
+    return None
@@ -0,0 +1,199 @@
+"""
+Prompts for the export query shared by the BuildingOS exporters (get_data.py
+and lucid_client.py): login credentials, meters, date range and export file
+name, plus the date helpers they rely on.
+"""
+
+from datetime import datetime
+from getpass import getpass
+
+def valid_date(date):
+    """
+    Checks if DATE is of form MM/DD/YYYY. Does not check if YYYY is correct.
+    Also, does not check for edge cases, i.e. Feb 30.
+    """
+    mdy = date.split("/")
+    if (len(mdy) == 3):
+        try:
+            m = int(mdy[0])
+            d = int(mdy[1])
+            y = int(mdy[2])
+            datetime(y, m, d)
+            return True
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def get_datetime(date):
+    """
+    Return the datetime object representing DATE. DATE must be valid.
+    """
+
+    mdy = date.split("/")
+    m = int(mdy[0])
+    d = int(mdy[1])
+    y = int(mdy[2])
+    return datetime(y, m, d)
+
+def convert_date(date):
+    """
+    Convert date of form MM/DD/YYYY into YYYY-MM-DD. Assumes date is correct
+    form.
+    """
+    
+    mdy = date.split("/")
+    m = mdy[0]
+    d = mdy[1]
+    y = mdy[2]
+    newDate = "%s-%s-%s" % (y, m, d)
+    return newDate
+
+def get_dates():
+    """
+    Prompt the user for a start and end date.
+    This function will keep prompting until valid dates are entered.
+    Returns a tuple of start date and end date strings.
+    """
+
+    hasValidStart = False
+    hasValidEnd = False
+    start = None
+    end = None
+    while True:
+        if not hasValidStart:
+            start = raw_input("Enter start date (MM/DD/YYYY): ") 
+            if not valid_date(start):
+                print("Invalid start date %s" % (start))
+                continue
+            else:
+                hasValidStart = True
+        if not hasValidEnd:
+            end = raw_input("Enter end date (MM/DD/YYYY): ")
+            if not valid_date(end):
+                print("Invalid end date %s" % (end))
+                continue
+            else:
+                hasValidEnd = True
+        if hasValidStart and hasValidEnd:
+            if get_datetime(start) < get_datetime(end):
+                accept_string = "Is range %s - %s acceptable? (Y/N) " % (start, end)
+                decision = raw_input(accept_string)
+                if decision.lower() == "y":
+                    break
+                else:
+                    hasValidStart = False
+                    hasValidEnd = False
+            else:
+                print("End date comes before start. Please enter a valid date.")
+                hasValidEnd = False
+    return (start, end)
+
+def valid_index(index, left, right):
+    """
+    Checks if INDEX is a valid number and is within the index range. If valid,
+    returns TRUE. Otherwise, returns FALSE.
+    """
+
+    try:
+        num = int(index)
+        return (num >= left and num <= right)
+    except (ValueError, TypeError):
+        return False
+
+def display_meters(all_meters):
+    """
+    Print meter names and their indices. Meters come from ALL_METERS list.
+    Note that indices begin at 1.
+    """
+    
+    for index, meter in enumerate(all_meters, 1):
+        if index < 10:
+            print("  %d:  %s" % (index, meter))
+        else:
+            print("  %d: %s" % (index, meter))
+    print("\n")
+
+def get_meters(meters):
+    """
+    Prompt user to enter indicies of the meters desired. At least one index must
+    be entered. Returns the selected indices.
+    """
+
+    user_list = []
+    atLeastOneMeter = False
+    minIndex = 1
+    maxIndex = len(meters)
+    display_meters(meters)
+    print("Please select the indices of the meters desired. Enter 'all' if all"
+          "meters are desired (not recommended, as performance will decrease)."
+          " Enter 'done' to end selection.")
+    while True:
+        index = raw_input("Enter a meter index: ") 
+        if index == "all":
+            return range(minIndex, maxIndex + 1)
+        if not atLeastOneMeter:
+            if index == "done":
+                print("No meters selected. Please try again.")
+                continue
+            if not valid_index(index, minIndex, maxIndex):
+                print("Invalid meter index.")
+                continue
+            num = int(index)
+            if not num in user_list:
+                user_list.append(num)
+                atLeastOneMeter = True
+            else:
+                print("Meter already selected. Please pick a different one")
+        else:
+            if index == "done":
+                return user_list
+            if not valid_index(index, minIndex, maxIndex):
+                print("Invalid meter index.")
+                continue
+            num = int(index)
+            if not num in user_list:
+                user_list.append(num)
+            else:
+                print("Meter already selected. Please pick a different one")
+
+def clean_up_file_name(filename):
+    """
+    If FILENAME has spaces in it, replaces them with underscores. Otherwise,
+    this function returns the filename unchanged.
+    """
+
+    words = filename.split()
+    if len(words) > 1:
+        filename = "_".join(words)
+    return filename
+
+def get_user_login():
+    """
+    Prompt user for Lucid email (username) and password. The password will not
+    be visible to the user, but the username will be.
+    Returns (username, password) tuple.
+    """
+
+    user = raw_input("Email: ")
+    passwd = getpass("Password: ")
+    return (user, passwd)
+
+
+def get_export_name():
+    """
+    Prompt the user for a base file name for the export. Spaces are replaced
+    with underscores.
+    """
+
+    filename = raw_input("Enter a base file name (spaces will be replaced with"
+                         " an underscore): ")
+    return clean_up_file_name(filename)
+
+def export_name(filename, start_date, end_date):
+    """
+    Returns the export name for base file name FILENAME and the MM/DD/YYYY
+    dates START_DATE and END_DATE. Lucid names the download link after it.
+    """
+
+    return "%s_%s_%s" % (filename, convert_date(start_date),
+                         convert_date(end_date))
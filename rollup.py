@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+Hourly, daily and monthly rollups of the exported readings. Exports are
+always requested at the finest resolution, so dashboards querying months of
+data read every raw point; publishing rollups as streams of their own lets
+them read one point per hour, day or month instead.
+
+For every meter of an export and every resolution in util.ROLLUPS
+(LUCIDROLLUPS), the sum, mean, min and max of the readings in each bucket
+are computed from the meter's split file, one meter at a time, and written
+to one csv file per statistic, {BASE}_{ID}_{RESOLUTION}_{STAT}.csv, whose
+meter id {ID}_{RESOLUTION}_{STAT} is the source name of its stream, with
+its own UUID in the map. Buckets are labeled with their start time in
+util.TIME_FORMAT (local time, like the exports).
+
+Buckets the export does not cover entirely (e.g. the current month of a
+daily export) are left out, so a rollup is never published from part of
+its readings. Blank readings are ignored; buckets with no readings are
+left blank. Requires NumPy.
+
+Usage (write the rollups of the csv files in the finished directory):
+
+    python rollup.py [-r hourly,daily,monthly]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import archive
+import extract_data
+import metrics
+import util
+
+RESOLUTIONS = ("hourly", "daily", "monthly")
+STATS = ("sum", "mean", "min", "max")
+
+# Length of the util.TIME_FORMAT prefix shared by the timestamps of a bucket,
+# and what completes that prefix into the bucket's start time.
+KEY_LENGTH = { "hourly": 13, "daily": 10, "monthly": 7 }
+KEY_SUFFIX = { "hourly": ":00", "daily": " 00:00", "monthly": "-01 00:00" }
+
+def is_rollup(meter_id):
+    """
+    Returns TRUE if METER_ID is the source name of a rollup stream.
+    """
+
+    parts = meter_id.rsplit("_", 2)
+    return len(parts) == 3 and parts[1] in RESOLUTIONS and parts[2] in STATS
+
+def read_table(filepath):
+    """
+    Reads the csv export FILEPATH. Returns (HEADER, TIMES, VALUES): its
+    util.LINE_SKIP header rows, an array of its timestamps, and a float
+    array of its readings (one row per timestamp, one column per meter),
+    with NaN for blank readings.
+    """
+
+    header = []
+    times = []
+    rows = []
+    for i, row in enumerate(extract_data.read_meter_data(filepath)):
+        if i < util.LINE_SKIP:
+            header.append(row)
+        elif row:
+            times.append(row[0])
+            rows.append(row[1:])
+    width = len(header[-1]) - 1
+    rows = [ (row + [ "" ] * width)[:width] for row in rows ]
+    return header, np.array(times), to_floats(np.array(rows, ndmin=2))
+
+def to_floats(cells):
+    """
+    Returns the string array CELLS as floats, with NaN for blank, null and
+    other non-numeric cells.
+    """
+
+    blank = (cells == "") | (np.char.lower(cells) == "null")
+    cells = np.where(blank, "nan", cells)
+    try:
+        return cells.astype(np.float64)
+    except ValueError:
+        return np.vectorize(parse_float, otypes=[ np.float64 ])(cells)
+
+def parse_float(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return float("nan")
+
+def aggregate(values, starts):
+    """
+    Returns a dict of statistic name to the array of that statistic of each
+    column of VALUES over each bucket, the buckets starting at the row
+    indices STARTS. NaN readings are ignored; empty buckets are NaN.
+    """
+
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    sums = np.add.reduceat(np.where(valid, values, 0.0), starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    sums[counts == 0] = np.nan
+    return { "sum": sums, "mean": means,
+             "min": np.fmin.reduceat(values, starts, axis=0),
+             "max": np.fmax.reduceat(values, starts, axis=0) }
+
+def bucket_end(label, resolution):
+    """
+    Returns the datetime at which the bucket starting at LABEL ends.
+    """
+
+    start = datetime.strptime(label, util.TIME_FORMAT)
+    if resolution == "hourly":
+        return start + timedelta(hours=1)
+    if resolution == "daily":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+def covered(times, labels, resolution):
+    """
+    Returns a boolean array, TRUE for each bucket (starting at LABELS) that
+    the timestamps TIMES cover entirely. Only the first and last buckets can
+    fall short: the first if the readings start after it does, the last if
+    they end more than one reading interval before it does.
+    """
+
+    ok = np.ones(len(labels), dtype=bool)
+    if times[0] != labels[0]:
+        ok[0] = False
+    minutes = times.astype("datetime64[m]").astype(np.int64)
+    step = int(np.median(np.diff(minutes))) if len(minutes) > 1 else 0
+    last = datetime.strptime(times[-1], util.TIME_FORMAT)
+    if last + timedelta(minutes=step) < bucket_end(labels[-1], resolution):
+        ok[-1] = False
+    return ok
+
+def rollup_rows(header, times, values, resolution):
+    """
+    Returns the csv rows of the rollups of the export read by read_table()
+    at RESOLUTION: the header rows, with one column per meter and statistic,
+    then one row per bucket the export covers.
+    """
+
+    keys = times.astype("S%d" % KEY_LENGTH[resolution])
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    labels = [ key + KEY_SUFFIX[resolution] for key in keys[starts] ]
+    stats = aggregate(values, starts)
+    ok = covered(times, labels, resolution)
+    meters = len(header[-1]) - 1
+    rows = [ [ head[0] ] for head in header ]
+    for m in range(meters):
+        for stat in STATS:
+            for i, head in enumerate(header):
+                cell = head[m + 1] if m + 1 < len(head) else ""
+                if i == 2:
+                    cell = "%s_%s_%s" % (cell, resolution, stat)
+                elif i == 1:
+                    cell = "%s (%s %s)" % (cell, resolution, stat)
+                rows[i].append(cell)
+    columns = np.column_stack([ stats[stat][:, m] for m in range(meters)
+                                for stat in STATS ])
+    for b in np.flatnonzero(ok):
+        rows.append([ labels[b] ] + [ "" if np.isnan(v) else "%.10g" % v
+                                      for v in columns[b] ])
+    return rows
+
+def write_rollups(filepath, resolutions=None):
+    """
+    Writes the rollups of the csv export FILEPATH at each of RESOLUTIONS
+    (default util.ROLLUPS), one file per meter, resolution and statistic
+    next to it. Rows at or before a rollup stream's watermark are left out.
+    Returns the paths of the files written.
+    """
+
+    if np is None:
+        raise ImportError("rollups require NumPy")
+    resolutions = util.ROLLUPS if resolutions is None else resolutions
+    with metrics.timed("rollup", filepath) as event:
+        event["bytes_read"] = metrics.file_size(filepath)
+        header, times, values = read_table(filepath)
+        ids = header[2][1:]
+        if not len(times) or any(is_rollup(i) for i in ids):
+            return []
+        event["meters"] = len(ids)
+        base = os.path.splitext(archive.strip(filepath))[0]
+        if len(ids) == 1 and base.endswith("_" + ids[0]):
+            base = base[:-len(ids[0]) - 1]
+        paths = []
+        for resolution in resolutions:
+            if resolution not in RESOLUTIONS:
+                raise ValueError("unknown rollup resolution: %s" % resolution)
+            rows = rollup_rows(header, times, values, resolution)
+            if len(rows) == len(header):
+                continue
+            names = rows[2][1:]
+            paths += extract_data.write_columns(rows, base,
+                                                list(enumerate(names, 1)))
+        event["bytes_written"] = sum(map(metrics.file_size, paths))
+    return paths
+
+def main():
+    """
+    Main function.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--resolutions", default=",".join(util.ROLLUPS
+        or RESOLUTIONS), help="Comma-separated rollup resolutions (default "
+        "%(default)s).")
+    args = parser.parse_args()
+    resolutions = [ r for r in args.resolutions.split(",") if r ]
+    for filename in sorted(os.listdir(util.FINISHED)):
+        if os.path.splitext(filename)[1].lower() == ".csv":
+            write_rollups(os.path.join(util.FINISHED, filename), resolutions)
+    metrics.flush()
+
+if __name__ == "__main__":
+    main()
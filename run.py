@@ -7,15 +7,29 @@ The process is as follows:
 	2. Send query to Lucid and get resulting data dump
 	3. Extract dumped .zip files and split them if necessary
 	4. Upload .csv files into sMAP server.
+
+Each step can also be run on its own with a subcommand:
+
+    fetch   steps 1 and 2
+    extract step 3
+    load    step 4
+    run     all of them (the default)
+    status  show the files waiting for each step
+
+Modules are imported by the subcommands that need them, so that extract,
+load and status runs do not load the browser stack (or NumPy, unless a
+feature that needs it is enabled).
 """
 
 import argparse
+import os
+import sys
+import time
 
-import get_data
-import extract_data
-import load_data
 import util
 
+COMMANDS = ("fetch", "extract", "load", "run", "status")
+
 def epilog():
 	"""
 	Returns the text that is displayed after the argument help.
@@ -25,27 +39,207 @@ def epilog():
 	string += "credentials."
 	return string
 
+def fetch_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-a", "--auto", help="Use stored environment variables.",
+    	action="store_true")
+    parser.add_argument("-b", "--browserless", help="Export data with plain "
+        "HTTP requests instead of a headless browser.", action="store_true")
+    parser.add_argument("-r", "--refresh", help="Refresh the cached meter "
+        "catalog instead of using it until it expires.", action="store_true")
+    parser.add_argument("-f", "--fetchers", help="Number of logged-in "
+        "sessions exporting at once (default %d with -f alone)."
+        % util.FETCH_SESSIONS, type=int, nargs="?",
+        const=util.FETCH_SESSIONS, default=1)
+    return parser
+
+def extract_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-s", "--stream", help="Split zip members while "
+        "extracting instead of extracting them to disk first.",
+        action="store_true")
+    parser.add_argument("-j", "--jobs", help="Number of processes splitting "
+        "files at once (default %d with -j alone)." % util.SPLIT_WORKERS,
+        type=int, nargs="?", const=util.SPLIT_WORKERS, default=1)
+    return parser
+
+def load_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-n", "--native", help="Post data to sMAP directly "
+        "instead of running smap-load-csv.", action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of files to load at "
+        "once (default %d with -w alone)." % util.LOAD_WORKERS, type=int,
+        nargs="?", const=util.LOAD_WORKERS, default=1)
+    parser.add_argument("-c", "--check", help="Validate files before loading "
+        "them and skip invalid ones (needs NumPy).", action="store_true")
+    return parser
+
+def force_options():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-F", "--force", help="Extract, split and load files "
+        "even if the ledger shows their content was handled before.",
+        action="store_true")
+    return parser
+
+def build_parser():
+    """
+    Returns the argument parser, with one subparser per command.
+    """
+
+    parser = argparse.ArgumentParser(epilog=epilog())
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND",
+        help="One of %s (default run)." % ", ".join(COMMANDS))
+    commands.add_parser("fetch", parents=[ fetch_options() ],
+        help="Export data from Lucid into the data directory.")
+    commands.add_parser("extract", parents=[ extract_options(),
+                                            force_options() ],
+        help="Extract and split the downloaded zip files.")
+    commands.add_parser("load", parents=[ load_options(), force_options() ],
+        help="Load the split files into sMAP.")
+    run = commands.add_parser("run", epilog=epilog(),
+        parents=[ fetch_options(), extract_options(), load_options(),
+                  force_options() ],
+        help="Fetch, extract and load (the default).")
+    run.add_argument("-p", "--pipeline", help="Extract and load files as "
+        "soon as they are ready instead of one stage at a time.",
+        action="store_true")
+    run.add_argument("-d", "--daemon", help="Run the jobs of a jobs file "
+        "on schedule, with one Lucid session kept logged in (default %s)."
+        % util.JOBS, nargs="?", const=util.JOBS, metavar="JOBS")
+    commands.add_parser("status", help="Show the files waiting for each "
+        "step and the state of the meter catalog.")
+    return parser
+
+def parse_args(argv):
+    """
+    Parses the command line ARGV, running the run command if no command is
+    given (as before there were commands).
+    """
+
+    if not argv or argv[0] not in COMMANDS + ("-h", "--help"):
+        argv = [ "run" ] + argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.pipeline and args.jobs > 1:
+        parser.error("-j cannot be used with -p, which splits each file as "
+                     "soon as it is extracted")
+    if args.command == "run" and args.daemon and args.pipeline:
+        parser.error("-p cannot be used with -d, which runs each job one "
+                     "stage at a time")
+    if args.command == "run" and args.daemon and args.fetchers > 1:
+        parser.error("-f cannot be used with -d, which keeps one session "
+                     "logged in")
+    return args
+
+def prepare(args):
+    """
+    Checks the login options and expires the meter catalog if asked to.
+    """
+
+    if args.auto and not (util.USER and util.PASS):
+        print("[ERROR] Environment variables for Lucid login incorrect.")
+        exit(1)
+    if args.refresh:
+        import meter_catalog
+        meter_catalog.expire()
+
+def fetch(args):
+    prepare(args)
+    fetch_data(args)
+
+def fetch_data(args):
+    if args.fetchers > 1:
+        import fetch_pool
+        fetch_pool.main(not args.auto, args.browserless, args.fetchers)
+    elif args.browserless:
+        import lucid_client
+        lucid_client.main(not args.auto)
+    else:
+        import get_data
+        get_data.main(not args.auto)
+
+def extract(args):
+    import extract_data
+    extract_data.main(args.stream, args.jobs)
+
+def load(args):
+    import load_data
+    load_data.main(args.native, args.workers, args.check)
+
+def run(args):
+    """
+    Runs the whole process: as a daemon or a pipeline if asked to, one step
+    at a time otherwise.
+    """
+
+    prepare(args)
+    if args.daemon:
+        import daemon
+        daemon.main(args.daemon, args.browserless, args.stream, args.native,
+                    args.workers, args.check, split_workers=args.jobs)
+        exit(0)
+    if args.pipeline:
+        import pipeline
+        ok = pipeline.main(not args.auto, True, args.stream, args.native,
+                           args.workers, args.browserless, args.check,
+                           args.fetchers)
+        exit(0 if ok else 1)
+    fetch_data(args)
+    extract(args)
+    load(args)
+
+def count_files(directory, extensions):
+    if not os.path.isdir(directory):
+        return 0
+    return len([ filename for filename in os.listdir(directory)
+                 if filename.lower().endswith(extensions) ])
+
+def status(args):
+    """
+    Prints the files waiting to be extracted and loaded, the files a run
+    left unfinished, and the state of the meter catalog.
+    """
+
+    import journal
+    import meter_catalog
+
+    print("Data:     %d zip files to extract"
+          % count_files(util.DATA_PATH, (".zip",)))
+    print("Finished: %d csv files to split or load"
+          % count_files(util.FINISHED, (".csv", ".csv.gz", ".csv.zst")))
+    print("Journal:  %d unfinished files" % len(journal.unfinished()))
+    catalog = meter_catalog.read()
+    if catalog is None:
+        print("Catalog:  none")
+    elif not catalog["refreshed"]:
+        print("Catalog:  %d meters, expired" % len(catalog["meters"]))
+    else:
+        print("Catalog:  %d meters, refreshed %s (%s)"
+              % (len(catalog["meters"]), time.strftime("%Y-%m-%d %H:%M",
+                 time.localtime(catalog["refreshed"])),
+                 "fresh" if meter_catalog.is_fresh(catalog) else "stale"))
+    try:
+        util.report_dest()
+        print("sMAP:     %s" % os.getenv('SMAPPREFIX'))
+    except util.ConfigError, e:
+        print("sMAP:     %s" % e)
+
 def main():
     """
     Main function encapsulating entire process of selecting data from Lucid
     and loading it into the sMAP server.
     """
 
-    parser = argparse.ArgumentParser(epilog=epilog())
-    parser.add_argument("-a", "--auto", help="Use stored environment variables.",
-    	action="store_true")
-    args = parser.parse_args()
-
-    if args.auto:
-        if (util.USER and util.PASS):
-            get_data.main(False)
-        else:
-            print("[ERROR] Environment variables for Lucid login incorrect.")
-            exit(1)
-    else:
-     	get_data.main(True)
-    extract_data.main()
-    load_data.main()
+    args = parse_args(sys.argv[1:])
+    commands = { "fetch": fetch, "extract": extract, "load": load,
+                 "run": run, "status": status }
+    if getattr(args, "force", False):
+        util.LEDGER_FORCE = True
+    try:
+        commands[args.command](args)
+    except util.ConfigError, e:
+        print("[ERROR] %s" % e)
+        exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Columnar cache of parsed meter series, so that re-processing, validation and
+replay jobs do not have to parse the csv files again.
+
+For each per-meter csv file {name}.csv, two NumPy arrays are written next to
+it: {name}.times.npy (epoch seconds, int64, sorted) and {name}.values.npy
+(float64). They are opened memory-mapped, so reading a time range only
+touches the pages it needs. The index file util.SERIES_INDEX maps each Lucid
+meter id (see extract_data.get_meter_ids) to the names of its cached files,
+which are looked up in the finished and archived directories.
+
+The cache is written by extract_data.process when util.SERIES_CACHE is set
+(LUCIDCACHE=1). It requires NumPy.
+
+Usage (cache all csv files in the finished and archived directories that
+are not cached yet):
+
+    python series_cache.py
+"""
+
+from datetime import datetime
+import json
+import os
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import archive
+import extract_data
+import smap_publish
+import util
+
+def cache_paths(filepath):
+    """
+    Returns the (times, values) array paths for the csv file FILEPATH.
+    """
+
+    base = os.path.splitext(archive.strip(filepath))[0]
+    return tuple(base + suffix for suffix in util.CACHE_SUFFIXES)
+
+def is_cached(filepath):
+    return all(os.path.exists(path) for path in cache_paths(filepath))
+
+def read_index():
+    """
+    Returns the index: a dict of meter id to a list of csv file names.
+    """
+
+    if not os.path.exists(util.SERIES_INDEX):
+        return {}
+    with open(util.SERIES_INDEX, 'rb') as f:
+        return json.load(f)
+
+def add_to_index(meter_id, filename):
+    with util.file_lock(util.SERIES_INDEX):
+        index = read_index()
+        names = index.setdefault(meter_id, [])
+        if filename not in names:
+            names.append(filename)
+            util.atomic_write(util.SERIES_INDEX, lambda f: json.dump(index, f,
+                              indent=1, sort_keys=True))
+
+def build(filepath):
+    """
+    Parses the per-meter csv file FILEPATH and writes its cache arrays.
+    Returns the number of readings cached.
+    """
+
+    if np is None:
+        raise ImportError("the series cache requires NumPy")
+    readings = list(smap_publish.read_readings(filepath))
+    times = np.array([ t // 1000 for t, _ in readings ], dtype=np.int64)
+    values = np.array([ v for _, v in readings ], dtype=np.float64)
+    order = np.argsort(times, kind="mergesort")
+    times_path, values_path = cache_paths(filepath)
+    np.save(times_path, times[order])
+    np.save(values_path, values[order])
+    meter_id = extract_data.get_meter_ids(filepath)[1]
+    add_to_index(meter_id, os.path.basename(filepath))
+    return len(readings)
+
+def locate(filename):
+    """
+    Returns the path of the cached csv file FILENAME in the finished or
+    archived directory, None if its arrays are in neither.
+    """
+
+    for directory in (util.FINISHED, util.ARCHIVED):
+        filepath = os.path.join(directory, filename)
+        if is_cached(filepath):
+            return filepath
+    return None
+
+def open_file(filepath):
+    """
+    Returns the memory-mapped (times, values) arrays of the csv file
+    FILEPATH.
+    """
+
+    times_path, values_path = cache_paths(filepath)
+    return (np.load(times_path, mmap_mode="r"),
+            np.load(values_path, mmap_mode="r"))
+
+def epoch(t):
+    """
+    Returns T, a datetime (local time) or epoch seconds, as epoch seconds.
+    """
+
+    if isinstance(t, datetime):
+        return int(time.mktime(t.timetuple()))
+    return t
+
+def meters():
+    """
+    Returns the ids of the meters with cached series.
+    """
+
+    return sorted(read_index().keys())
+
+def series(meter_id, start=None, end=None):
+    """
+    Returns the (times, values) arrays of meter METER_ID from START
+    (inclusive) to END (exclusive), datetimes or epoch seconds, over all its
+    cached files, sorted by time. A single file's range is returned as views
+    of the memory-mapped arrays.
+    """
+
+    parts = []
+    for filename in read_index().get(meter_id, []):
+        filepath = locate(filename)
+        if filepath is None:
+            continue
+        times, values = open_file(filepath)
+        lo = 0 if start is None else np.searchsorted(times, epoch(start))
+        hi = len(times) if end is None else np.searchsorted(times, epoch(end))
+        if hi > lo:
+            parts.append((times[lo:hi], values[lo:hi]))
+    if not parts:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+    if len(parts) == 1:
+        return parts[0]
+    times = np.concatenate([ t for t, _ in parts ])
+    values = np.concatenate([ v for _, v in parts ])
+    order = np.argsort(times, kind="mergesort")
+    return (times[order], values[order])
+
+def main():
+    """
+    Main function.
+    """
+
+    count = 0
+    for directory in (util.FINISHED, util.ARCHIVED):
+        for filename in sorted(os.listdir(directory)):
+            filepath = os.path.join(directory, filename)
+            if archive.is_data_file(filename) and not is_cached(filepath):
+                print("Caching %s (%d readings)" % (filepath, build(filepath)))
+                count += 1
+    print("Cached %d files." % count)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+In-process publisher that posts the data of a processed csv file to the sMAP
+server, as an alternative to running smap-load-csv for every file.
+
+The csv file is parsed with the same settings smap-load-csv is given
+(util.LINE_SKIP and util.TIME_FORMAT) and its readings are posted as sMAP
+JSON to util.report_dest() in batches of at most util.PUBLISH_BATCH_SIZE
+readings. One keep-alive connection is reused for all batches and files.
+"""
+
+import csv
+import httplib
+import itertools
+import json
+import socket
+import time
+import urlparse
+# time.strptime imports its implementation on first use, which is not
+# thread-safe; import it up front for the concurrent loaders.
+import _strptime
+
+import archive
+import metrics
+import util
+
+class PublishError(Exception):
+    """
+    Raised when the sMAP server rejects a batch or cannot be reached.
+    """
+
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
+
+def parse_time(timestamp):
+    """
+    Returns TIMESTAMP, formatted as util.TIME_FORMAT in local time, as epoch
+    milliseconds.
+    """
+
+    return int(time.mktime(time.strptime(timestamp, util.TIME_FORMAT)) * 1000)
+
+def read_readings(filepath):
+    """
+    Returns a generator of [time, value] readings for the processed csv file
+    FILEPATH. Header lines, blank rows and rows without a numeric value are
+    skipped.
+    """
+
+    with archive.open_data(filepath) as data:
+        reader = csv.reader(data)
+        for i, row in enumerate(reader):
+            if i < util.LINE_SKIP or len(row) < 2:
+                continue
+            try:
+                yield [ parse_time(row[0]), float(row[1]) ]
+            except ValueError:
+                continue
+
+def build_payload(source_name, uid, readings):
+    """
+    Returns the sMAP JSON object that adds READINGS to the stream UID of
+    SOURCE_NAME.
+    """
+
+    return {
+        "/" + source_name: {
+            "uuid": uid,
+            "Readings": readings,
+            "Properties": {
+                "Timezone": util.TIMEZONE,
+                "ReadingType": "double",
+            },
+            "Metadata": {
+                "SourceName": source_name,
+            },
+        }
+    }
+
+class Publisher(object):
+    """
+    Posts sMAP JSON payloads to DEST over one persistent connection.
+    """
+
+    def __init__(self, dest=None, batch_size=None, timeout=60):
+        self.dest = dest or util.report_dest()
+        self.batch_size = batch_size or util.PUBLISH_BATCH_SIZE
+        self.timeout = timeout
+        url = urlparse.urlsplit(self.dest)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+        self.conn = None
+
+    def connect(self):
+        if self.scheme == "https":
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def post(self, payload):
+        """
+        Posts PAYLOAD to the server. A dropped keep-alive connection is
+        reopened once. Raises PublishError unless the server replies with a
+        2xx status.
+        """
+
+        body = json.dumps(payload)
+        headers = { "Content-Type": "application/json" }
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = self.connect()
+            try:
+                self.conn.request("POST", self.path, body, headers)
+                response = self.conn.getresponse()
+                reply = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                if attempt == 2:
+                    raise PublishError("connection failed: %s" % e)
+                metrics.incr("retries")
+        if response.getheader("connection", "").lower() == "close":
+            self.close()
+        if not 200 <= response.status < 300:
+            raise PublishError("server replied %d: %s"
+                               % (response.status, reply.strip()),
+                               response.status)
+        metrics.incr("bytes_written", len(body))
+        return reply
+
+    def publish(self, source_name, uid, readings, start=0, acked=None):
+        """
+        Posts the iterable READINGS for stream UID in batches, skipping the
+        first START readings. After each batch the server acknowledges,
+        ACKED, if given, is called with the number of readings sent so far
+        (counting the skipped ones). Returns the number of readings posted.
+        """
+
+        count = 0
+        sent = start
+        batch = []
+        for reading in itertools.islice(readings, start, None):
+            batch.append(reading)
+            if len(batch) >= self.batch_size:
+                self.post(build_payload(source_name, uid, batch))
+                count += len(batch)
+                sent += len(batch)
+                batch = []
+                if acked:
+                    acked(sent)
+        if batch:
+            self.post(build_payload(source_name, uid, batch))
+            count += len(batch)
+            sent += len(batch)
+            if acked:
+                acked(sent)
+        return count
+
+    def publish_file(self, filepath, source_name, uid, start=0, acked=None):
+        """
+        Posts the data of the processed csv file FILEPATH to stream UID of
+        SOURCE_NAME. START and ACKED are as for publish(). Returns the
+        number of readings posted.
+        """
+
+        return self.publish(source_name, uid, read_readings(filepath), start,
+                            acked)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""
+Generator of synthetic Lucid exports, for exercising the extract and load
+steps (and benchmark.py) without BuildingOS downloads. Each zip file holds
+one or more csv members laid out like a Lucid export: the facility, meter
+name, meter id and units header rows, then one row per timestamp
+(util.TIME_FORMAT) with a reading per meter. The meters are spread evenly
+over all members of all zip files; every member has all the rows.
+
+Readings are random walks, with an optional fraction of blank cells. The
+output is the same for the same seed.
+
+Usage (write to the data directory by default):
+
+    python synth_export.py [-m METERS] [-r ROWS] [-f MEMBERS] [-z ZIPS]
+                           [-i MINUTES] [-b BLANK] [-o DIR]
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import csv
+import os
+import random
+import tempfile
+import zipfile
+
+import util
+
+START = datetime(2015, 1, 1)
+UNITS = [ "kW", "kWh", "gal", "therms" ]
+
+def meter_headers(first, count):
+    """
+    Returns the four header rows (without the first column) of the meters
+    numbered FIRST to FIRST + COUNT - 1.
+    """
+
+    numbers = range(first, first + count)
+    return ([ "Building %d" % (n // 10 + 1) for n in numbers ],
+            [ "Building %d - Meter %d" % (n // 10 + 1, n) for n in numbers ],
+            [ "synth_%05d" % n for n in numbers ],
+            [ UNITS[n % len(UNITS)] for n in numbers ])
+
+def write_member(output, first, count, rows, start, interval, blank, rng):
+    """
+    Writes a Lucid csv export of the meters numbered FIRST to
+    FIRST + COUNT - 1 with ROWS readings each, INTERVAL minutes apart from
+    the datetime START, to the open file OUTPUT. A fraction BLANK of the
+    readings is left blank. RNG is the random.Random to draw from.
+    """
+
+    writer = csv.writer(output)
+    labels = [ "Facility", "Meter", "Timestamp", "Units" ]
+    for label, row in zip(labels, meter_headers(first, count)):
+        writer.writerow([ label ] + row)
+    values = [ rng.uniform(0, 100) for _ in range(count) ]
+    step = timedelta(minutes=interval)
+    t = start
+    for _ in range(rows):
+        values = [ max(0.0, v + rng.uniform(-1, 1)) for v in values ]
+        row = [ "%.2f" % v for v in values ]
+        if blank:
+            for i in range(count):
+                if rng.random() < blank:
+                    row[i] = ""
+        writer.writerow([ t.strftime(util.TIME_FORMAT) ] + row)
+        t += step
+
+def spread(total, parts):
+    """
+    Returns the (first, count) ranges that split TOTAL items into PARTS
+    nearly equal consecutive parts, leaving out empty ones.
+    """
+
+    ranges = []
+    first = 0
+    for i in range(parts):
+        count = total // parts + (i < total % parts)
+        if count:
+            ranges.append((first, count))
+        first += count
+    return ranges
+
+def generate(directory=None, meters=10, rows=96, members=1, zips=1,
+             interval=15, blank=0.0, seed=0, name="synthetic", start=None):
+    """
+    Writes ZIPS zip files of MEMBERS csv members each into DIRECTORY
+    (default util.DATA_PATH), covering METERS meters with ROWS readings
+    every INTERVAL minutes from START (default 2015-01-01). Each zip is
+    written under a .part name and renamed when complete. Returns the paths
+    of the zip files.
+    """
+
+    directory = directory or util.DATA_PATH
+    start = start or START
+    rng = random.Random(seed)
+    ranges = spread(meters, zips * members)
+    paths = []
+    for z in range(zips):
+        parts = ranges[z * members:(z + 1) * members]
+        if not parts:
+            break
+        path = os.path.join(directory, "%s_%d.zip" % (name, z + 1))
+        zf = zipfile.ZipFile(path + ".part", "w", zipfile.ZIP_DEFLATED,
+                             allowZip64=True)
+        try:
+            for m, (first, count) in enumerate(parts):
+                fd, tmp_path = tempfile.mkstemp(suffix=".csv")
+                try:
+                    with os.fdopen(fd, 'wb') as output:
+                        write_member(output, first, count, rows, start,
+                                     interval, blank, rng)
+                    zf.write(tmp_path, "%s_%d_%d.csv" % (name, z + 1, m + 1))
+                finally:
+                    os.remove(tmp_path)
+        finally:
+            zf.close()
+        os.rename(path + ".part", path)
+        paths.append(path)
+    return paths
+
+def main():
+    """
+    Main function.
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--meters", type=int, default=10,
+        help="Number of meters (default 10).")
+    parser.add_argument("-r", "--rows", type=int, default=96,
+        help="Readings per meter (default 96).")
+    parser.add_argument("-f", "--members", type=int, default=1,
+        help="Csv members per zip file (default 1).")
+    parser.add_argument("-z", "--zips", type=int, default=1,
+        help="Number of zip files (default 1).")
+    parser.add_argument("-i", "--interval", type=int, default=15,
+        help="Minutes between readings (default 15).")
+    parser.add_argument("-b", "--blank", type=float, default=0.0,
+        help="Fraction of blank readings (default 0).")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+        help="Random seed (default 0).")
+    parser.add_argument("-o", "--output", default=util.DATA_PATH,
+        help="Output directory (default %s)." % util.DATA_PATH)
+    args = parser.parse_args()
+    for path in generate(args.output, args.meters, args.rows, args.members,
+                         args.zips, args.interval, args.blank, args.seed):
+        print("Wrote %s (%d bytes)" % (path, os.path.getsize(path)))
+
+if __name__ == "__main__":
+    main()
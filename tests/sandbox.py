@@ -0,0 +1,75 @@
+"""
+Test case base class running each test in a temporary working directory, so
+that the data, finished, scratch and info directories of util.py are its
+own, with the module-level caches of the scripts reset.
+
+Run the tests from the repository root with:
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import journal
+import ledger
+import load_data
+import metrics
+import util
+import watermark
+
+def reset_caches():
+    """
+    Drops the stores and indexes the scripts keep between calls.
+    """
+
+    for module in (load_data, watermark):
+        for name in ("STORE", "MAP"):
+            store = getattr(module, name, None)
+            if store is not None and hasattr(store, "close"):
+                store.close()
+            if hasattr(module, name):
+                setattr(module, name, None)
+    publisher = getattr(load_data.LOCAL, "publisher", None)
+    if publisher is not None:
+        publisher.close()
+        load_data.LOCAL.publisher = None
+    watermark.thaw()
+    journal.reload()
+    ledger.reload()
+    metrics.TOTALS.clear()
+
+class SandboxTestCase(unittest.TestCase):
+    """
+    Runs each test in a new temporary directory, with the environment
+    variables ENV set while util.py is re-read.
+    """
+
+    ENV = {}
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.environ = dict(os.environ)
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+        os.environ.update(self.ENV)
+        reload(util)
+        for directory in (util.DATA_PATH, util.ARCHIVED, util.SCRATCH,
+                          util.INFO):
+            os.makedirs(directory)
+        reset_caches()
+
+    def tearDown(self):
+        reset_caches()
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        reload(util)
+        shutil.rmtree(self.dir)
@@ -0,0 +1,81 @@
+"""
+Export shards that fail to submit or download are retried on their own,
+while the other shards carry on.
+"""
+
+import unittest
+
+from sandbox import SandboxTestCase
+import export_planner
+import fake_lucid
+import lucid_client
+import util
+
+class FlakySession(lucid_client.LucidSession):
+    """
+    A session whose first submit and first download of the exports named in
+    FAILS raise LucidError, as an expired link or a dropped connection does.
+    """
+
+    def __init__(self, base_url, fails):
+        lucid_client.LucidSession.__init__(self, base_url)
+        self.submit_fails = set(fails)
+        self.download_fails = set(fails)
+        self.names = {}
+
+    def submit_export(self, meter_list, start_date, end_date, name,
+                      meters=None):
+        if name in self.submit_fails:
+            self.submit_fails.remove(name)
+            raise lucid_client.LucidError("submit of %s failed" % name)
+        return lucid_client.LucidSession.submit_export(self, meter_list,
+            start_date, end_date, name, meters)
+
+    def export_links(self):
+        links = lucid_client.LucidSession.export_links(self)
+        self.names.update((url, name) for name, url in links.items())
+        return links
+
+    def download(self, url, directory=None):
+        name = self.names.get(url)
+        if name in self.download_fails:
+            self.download_fails.remove(name)
+            raise lucid_client.LucidError("link of %s expired" % name)
+        return lucid_client.LucidSession.download(self, url, directory)
+
+class RunTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        util.POLL_MIN = 0.1
+        self.lucid = fake_lucid.FakeLucidServer(meters=4).start()
+
+    def tearDown(self):
+        self.lucid.stop()
+        SandboxTestCase.tearDown(self)
+
+    def jobs(self):
+        titles = [ title for _, title in self.lucid.meters ]
+        return export_planner.plan(titles, "01/01/2015", "01/03/2015", "flaky",
+                                   max_meters=2, max_days=1)
+
+    def test_failed_shards_are_retried(self):
+        jobs = self.jobs()
+        session = FlakySession(self.lucid.url(), [ jobs[1].name ])
+        self.assertTrue(session.login("user", "pass"))
+        failed = export_planner.run(session, jobs, attempts=3)
+        self.assertEqual(failed, [])
+        self.assertTrue(all(job.filepath for job in jobs))
+        self.assertEqual(jobs[1].attempts, 3)
+        self.assertEqual([ job.attempts for job in jobs[2:] ], [ 1, 1 ])
+
+    def test_out_of_attempts(self):
+        jobs = self.jobs()
+        session = FlakySession(self.lucid.url(), [ jobs[0].name ])
+        self.assertTrue(session.login("user", "pass"))
+        failed = export_planner.run(session, jobs, attempts=1)
+        self.assertEqual(failed, [ jobs[0] ])
+        self.assertTrue(all(job.filepath for job in jobs[1:]))
+
+if __name__ == "__main__":
+    unittest.main()
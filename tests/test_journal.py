@@ -0,0 +1,73 @@
+"""
+Resuming an interrupted load: extracting the files left behind again must
+keep them as they are, so that the load goes on from its last checkpoint
+instead of sending every reading again.
+"""
+
+from datetime import datetime
+import os
+import time
+import unittest
+
+from sandbox import SandboxTestCase
+import extract_data
+import fake_smap
+import journal
+import load_data
+import synth_export
+import util
+
+class ResumeTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        util.PUBLISH_BATCH_SIZE = 10
+        self.smap = fake_smap.FakeSmapServer(api_key="KEY").start()
+        os.environ["SMAPPREFIX"] = self.smap.url()
+        os.environ["SMAPAPI"] = "KEY"
+        # The first day is loaded, so the meter has a watermark.
+        synth_export.generate(util.DATA_PATH, 1, 96, name="first")
+        extract_data.main()
+        load_data.load_all(native=True)
+
+    def tearDown(self):
+        self.smap.stop()
+        SandboxTestCase.tearDown(self)
+
+    def finished(self):
+        return [ filename for filename in os.listdir(util.FINISHED)
+                 if filename.endswith(".csv") ]
+
+    def fail_after_checkpoint(self):
+        """
+        Loads the finished files, with the sMAP server failing every post
+        after the first batch is acknowledged.
+        """
+
+        checkpoint = journal.checkpoint
+        def fail(*args):
+            checkpoint(*args)
+            self.smap.fail_status = 500
+        journal.checkpoint = fail
+        try:
+            load_data.load_all(native=True)
+        finally:
+            journal.checkpoint = checkpoint
+            self.smap.fail_status = None
+
+    def test_resume_after_extract(self):
+        synth_export.generate(util.DATA_PATH, 1, 96, name="second",
+                              start=datetime(2015, 1, 2))
+        extract_data.main()
+        # Older than this second, so that any rewrite changes the stamp.
+        [ filename ] = self.finished()
+        old = time.time() - 3600
+        os.utime(os.path.join(util.FINISHED, filename), (old, old))
+        self.fail_after_checkpoint()
+        self.assertEqual(self.smap.stats()["readings"], 96 + 10)
+        journal.resume(native=True)
+        self.assertEqual(self.finished(), [])
+        self.assertEqual(self.smap.stats()["readings"], 96 * 2)
+
+if __name__ == "__main__":
+    unittest.main()
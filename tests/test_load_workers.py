@@ -0,0 +1,73 @@
+"""
+Loads with several workers sharing one map store, by load_data.py and by the
+pipeline: every stream posted to sMAP must have its UUID recorded in the map.
+"""
+
+import os
+import unittest
+
+from sandbox import SandboxTestCase
+import extract_data
+import fake_smap
+import load_data
+import map_store
+import pipeline
+import synth_export
+import util
+
+METERS = 9
+WORKERS = 3
+
+class LoadWorkersTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        self.server = fake_smap.FakeSmapServer(api_key="KEY").start()
+        os.environ["SMAPPREFIX"] = self.server.url()
+        os.environ["SMAPAPI"] = "KEY"
+        synth_export.generate(util.DATA_PATH, METERS, 20, name="workers")
+
+    def tearDown(self):
+        self.server.stop()
+        SandboxTestCase.tearDown(self)
+
+    def mapped_uuids(self, backend):
+        store = map_store.open_store(backend)
+        try:
+            return set(store.get("synth_%05d" % n) for n in range(METERS))
+        finally:
+            store.close()
+
+    def check_posted(self, backend):
+        posted = set(self.server.streams)
+        self.assertEqual(len(posted), METERS)
+        self.assertEqual(posted - self.mapped_uuids(backend), set())
+
+    def check_load(self, backend):
+        util.MAP_BACKEND = backend
+        extract_data.main()
+        results = load_data.load_all(native=True, workers=WORKERS)
+        self.assertEqual(len(results), METERS)
+        self.assertTrue(all(status for _, status in results))
+        self.check_posted(backend)
+
+    def check_pipeline(self, backend):
+        util.MAP_BACKEND = backend
+        self.assertTrue(pipeline.main(fetch=False, stream=True, native=True,
+                                      workers=WORKERS))
+        self.check_posted(backend)
+
+    def test_load_csv(self):
+        self.check_load("csv")
+
+    def test_load_sqlite(self):
+        self.check_load("sqlite")
+
+    def test_pipeline_csv(self):
+        self.check_pipeline("csv")
+
+    def test_pipeline_sqlite(self):
+        self.check_pipeline("sqlite")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+"""
+The pipeline's extract stage must leave a browser download alone until the
+fetch stage has seen it complete, and take the exports of parallel fetches
+as they are downloaded, in whatever order they complete.
+"""
+
+from datetime import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+from sandbox import SandboxTestCase
+import fake_lucid
+import fake_smap
+import fetch_pool
+import lucid_client
+import pipeline
+import polling
+import synth_export
+import util
+
+class FakeGetData(types.ModuleType):
+    """
+    Stands in for get_data.py: main() downloads the zip file SOURCE the way
+    a browser does, under a .crdownload name renamed when complete, then
+    waits for it like get_data.fetch().
+    """
+
+    def __init__(self, source):
+        types.ModuleType.__init__(self, "get_data")
+        self.source = source
+        self.found = None
+
+    def main(self, user_mode=True):
+        before = set(os.listdir(util.DATA_PATH))
+        target = os.path.join(util.DATA_PATH, os.path.basename(self.source))
+        shutil.copy(self.source, target + ".crdownload")
+        os.rename(target + ".crdownload", target)
+        self.found = polling.wait_for_download(util.DATA_PATH, before, 10)
+        return self.found
+
+class PipelineFetchTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        self.server = fake_smap.FakeSmapServer(api_key="KEY").start()
+        os.environ["SMAPPREFIX"] = self.server.url()
+        os.environ["SMAPAPI"] = "KEY"
+        self.source = synth_export.generate(tempfile.mkdtemp(dir=self.dir),
+                                            3, 20, name="download")[0]
+        self.get_data = sys.modules.get("get_data")
+        sys.modules["get_data"] = FakeGetData(self.source)
+
+    def tearDown(self):
+        if self.get_data is None:
+            del sys.modules["get_data"]
+        else:
+            sys.modules["get_data"] = self.get_data
+        self.server.stop()
+        SandboxTestCase.tearDown(self)
+
+    def test_download_is_not_taken_early(self):
+        fake = sys.modules["get_data"]
+        self.assertTrue(pipeline.main(fetch=True, native=True))
+        self.assertTrue(fake.found)
+        self.assertEqual(self.server.stats()["streams"], 3)
+
+def wait_for(check, timeout=10):
+    """
+    Waits until CHECK returns TRUE or TIMEOUT seconds have passed. Returns
+    the last result of CHECK.
+    """
+
+    deadline = time.time() + timeout
+    while not check() and time.time() < deadline:
+        time.sleep(0.05)
+    return check()
+
+class FakeFetchPool(types.ModuleType):
+    """
+    Stands in for fetch_pool.py: main() hands the zip files SHARDS on in
+    turn, each once the previous one has been loaded into SERVER.
+    """
+
+    def __init__(self, shards, server):
+        types.ModuleType.__init__(self, "fetch_pool")
+        self.shards = shards
+        self.server = server
+
+    def main(self, user_mode=True, browserless=False, sessions=None,
+             base_url=None, ready=None):
+        for n, source in enumerate(self.shards):
+            if n:
+                loaded = lambda: self.server.stats()["readings"] >= 3 * 96 * n
+                if not wait_for(loaded):
+                    raise AssertionError("shard %d was not loaded" % n)
+            target = os.path.join(util.DATA_PATH, os.path.basename(source))
+            shutil.copy(source, target)
+            ready(target)
+        return []
+
+class PipelineOrderTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        self.server = fake_smap.FakeSmapServer(api_key="KEY").start()
+        os.environ["SMAPPREFIX"] = self.server.url()
+        os.environ["SMAPAPI"] = "KEY"
+        directory = tempfile.mkdtemp(dir=self.dir)
+        # One day each of the same 3 meters; the later day completes first.
+        shards = [ synth_export.generate(directory, 3, 96, name=name,
+                                         start=start)[0]
+                   for name, start in (("late", datetime(2015, 1, 2)),
+                                       ("early", datetime(2015, 1, 1))) ]
+        self.fetch_pool = sys.modules.get("fetch_pool")
+        sys.modules["fetch_pool"] = FakeFetchPool(shards, self.server)
+
+    def tearDown(self):
+        sys.modules["fetch_pool"] = self.fetch_pool
+        self.server.stop()
+        SandboxTestCase.tearDown(self)
+
+    def test_later_shard_first(self):
+        self.assertTrue(pipeline.main(native=True, fetchers=2))
+        self.assertEqual(self.server.stats()["readings"], 3 * 96 * 2)
+
+class PipelineFetchersTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        util.POLL_MIN = 0.1
+        util.SHARD_METERS = 1
+        self.lucid = fake_lucid.FakeLucidServer(meters=4).start()
+        self.smap = fake_smap.FakeSmapServer(api_key="KEY").start()
+        util.URL = self.lucid.url()
+        util.USER, util.PASS = "user", "pass"
+        os.environ["SMAPPREFIX"] = self.smap.url()
+        os.environ["SMAPAPI"] = "KEY"
+        # The answers to the prompts: every meter, over two days.
+        self.prompts = (fetch_pool.get_dates, fetch_pool.get_export_name,
+                        lucid_client.select_meters)
+        fetch_pool.get_dates = lambda: ("01/01/2015", "01/03/2015")
+        fetch_pool.get_export_name = lambda: "parallel"
+        lucid_client.select_meters = lambda meters: [ title
+                                                      for _, title in meters ]
+
+    def tearDown(self):
+        (fetch_pool.get_dates, fetch_pool.get_export_name,
+         lucid_client.select_meters) = self.prompts
+        self.lucid.stop()
+        self.smap.stop()
+        SandboxTestCase.tearDown(self)
+
+    def test_fetchers(self):
+        self.assertTrue(pipeline.main(user_mode=False, native=True,
+                                      browserless=True, fetchers=2))
+        self.assertEqual(self.smap.stats()["streams"], 4)
+        self.assertEqual(os.listdir(util.DATA_PATH), [])
+
+    def test_later_shard_completes_first(self):
+        util.SHARD_METERS = 4
+        util.SHARD_DAYS = 1
+        smap = self.smap
+        new_session = fetch_pool.new_session
+
+        class LateSession(lucid_client.LucidSession):
+            # The first day's export completes once the second day's is
+            # loaded.
+            def export(self, meter_list, start_date, *args, **kwargs):
+                if start_date == "01/01/2015":
+                    wait_for(lambda: smap.stats()["readings"] >= 4 * 24)
+                return lucid_client.LucidSession.export(
+                    self, meter_list, start_date, *args, **kwargs)
+
+        def late_session(browserless, directory, base_url=None):
+            return LateSession(base_url, directory)
+
+        fetch_pool.new_session = late_session
+        try:
+            self.assertTrue(pipeline.main(user_mode=False, native=True,
+                                          browserless=True, fetchers=2))
+        finally:
+            fetch_pool.new_session = new_session
+        self.assertEqual(self.smap.stats()["readings"], 4 * 24 * 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Rollups written at extract time, from the split files: compaction of the
+split files must not change them, and neither they nor the split files are
+rolled up or compacted again when a failed load leaves them behind.
+"""
+
+import csv
+import os
+import unittest
+import zipfile
+
+from sandbox import SandboxTestCase
+import extract_data
+import synth_export
+import util
+
+class ExtractRollupTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        util.ROLLUPS = [ "hourly" ]
+        util.COMPACT = True
+        os.environ["LUCIDCOMPACTTOL"] = "1000"
+        # Two whole days of 15 minute readings.
+        self.zip_path = synth_export.generate(util.DATA_PATH, 3, 192,
+                                              blank=0.1, name="rollup")[0]
+
+    def expected_sums(self):
+        """
+        Returns a dict of (meter id, hour) to the sum of the readings of the
+        export.
+        """
+
+        zf = zipfile.ZipFile(self.zip_path)
+        rows = list(csv.reader(zf.open(zf.namelist()[0])))
+        zf.close()
+        ids = rows[2][1:]
+        sums = {}
+        for row in rows[util.LINE_SKIP:]:
+            for meter, cell in zip(ids, row[1:]):
+                if cell:
+                    key = (meter, row[0][:13])
+                    sums[key] = sums.get(key, 0.0) + float(cell)
+        return sums
+
+    def hourly_sums(self):
+        """
+        Returns a dict of (meter id, hour) to the sum in the hourly_sum
+        rollup files in the finished directory.
+        """
+
+        found = {}
+        for filename in os.listdir(util.FINISHED):
+            if not filename.endswith("_hourly_sum.csv"):
+                continue
+            with open(os.path.join(util.FINISHED, filename), 'rb') as f:
+                rows = list(csv.reader(f))
+            meter = rows[2][1][:-len("_hourly_sum")]
+            for row in rows[util.LINE_SKIP:]:
+                found[(meter, row[0][:13])] = float(row[1])
+        return found
+
+    def test_rollups_of_compacted_export(self):
+        expected = self.expected_sums()
+        extract_data.main()
+        found = self.hourly_sums()
+        self.assertEqual(sorted(found), sorted(expected))
+        for key in expected:
+            self.assertAlmostEqual(found[key], expected[key], 6)
+
+    def test_extract_again(self):
+        # The files of a load that failed are extracted again next time.
+        extract_data.main()
+        found = self.hourly_sums()
+        files = sorted(os.listdir(util.FINISHED))
+        extract_data.main()
+        self.assertEqual(self.hourly_sums(), found)
+        self.assertEqual(sorted(os.listdir(util.FINISHED)), files)
+
+if __name__ == "__main__":
+    unittest.main()
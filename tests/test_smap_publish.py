@@ -0,0 +1,91 @@
+"""
+The native publisher's error paths: a batch the sMAP server does not accept
+with a 2xx status raises PublishError, and a dropped keep-alive connection
+is reopened once before the batch is given up on.
+"""
+
+import socket
+import unittest
+
+from sandbox import SandboxTestCase
+import fake_smap
+import smap_publish
+
+READINGS = [ [ 1420070400000 + 900000 * i, float(i) ] for i in range(25) ]
+
+def unused_port():
+    """
+    Returns a local port nothing listens on.
+    """
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class PublisherTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        self.server = fake_smap.FakeSmapServer(api_key="KEY").start()
+        self.publisher = smap_publish.Publisher(self.server.url("KEY"),
+                                                batch_size=10)
+
+    def tearDown(self):
+        self.publisher.close()
+        self.server.stop()
+        SandboxTestCase.tearDown(self)
+
+    def publish(self):
+        return self.publisher.publish("meter", "uid", iter(READINGS))
+
+    def test_publish(self):
+        self.assertEqual(self.publish(), 25)
+        self.assertEqual(self.server.stats(), { "requests": 3, "streams": 1,
+                                                "readings": 25 })
+
+    def test_server_error(self):
+        self.server.fail_status = 500
+        with self.assertRaises(smap_publish.PublishError) as raised:
+            self.publish()
+        self.assertEqual(raised.exception.status, 500)
+        # A reply is not a dropped connection: the batch is not sent again.
+        self.assertEqual(self.server.stats()["requests"], 1)
+
+    def test_wrong_api_key(self):
+        self.publisher = smap_publish.Publisher(self.server.url("WRONG"))
+        with self.assertRaises(smap_publish.PublishError) as raised:
+            self.publish()
+        self.assertEqual(raised.exception.status, 403)
+        self.assertEqual(self.server.stats()["readings"], 0)
+
+    def test_checkpoints_stop_at_failure(self):
+        acked = []
+        def ack(sent):
+            acked.append(sent)
+            self.server.fail_status = 503
+        with self.assertRaises(smap_publish.PublishError):
+            self.publisher.publish("meter", "uid", iter(READINGS), 0, ack)
+        self.assertEqual(acked, [ 10 ])
+        self.assertEqual(self.server.stats()["readings"], 10)
+
+    def test_dropped_connection(self):
+        self.publisher.post(smap_publish.build_payload("meter", "uid",
+                                                       READINGS[:1]))
+        # The keep-alive connection is dropped between two batches.
+        self.publisher.conn.sock.close()
+        self.assertEqual(self.publish(), 25)
+        self.assertEqual(self.server.stats()["readings"], 26)
+
+    def test_unreachable(self):
+        self.publisher = smap_publish.Publisher("http://127.0.0.1:%d/add/KEY"
+                                                % unused_port())
+        with self.assertRaises(smap_publish.PublishError) as raised:
+            self.publish()
+        self.assertEqual(raised.exception.status, None)
+        self.assertTrue(str(raised.exception).startswith("connection failed"))
+        self.assertEqual(self.publisher.conn, None)
+
+if __name__ == "__main__":
+    unittest.main()
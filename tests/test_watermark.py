@@ -0,0 +1,71 @@
+"""
+Incremental syncs: after a load, an export of the same meters, selected by
+title like the exporters do, starts at the day of their watermark, also
+when the meter catalog was scraped from the browser.
+"""
+
+import os
+import unittest
+
+from sandbox import SandboxTestCase
+import extract_data
+import fake_lucid
+import fake_smap
+import load_data
+import lucid_client
+import meter_catalog
+import util
+import watermark
+
+class ClipStartTest(SandboxTestCase):
+
+    def setUp(self):
+        SandboxTestCase.setUp(self)
+        util.POLL_MIN = 0.1
+        self.lucid = fake_lucid.FakeLucidServer(meters=3).start()
+        self.smap = fake_smap.FakeSmapServer(api_key="KEY").start()
+        os.environ["SMAPPREFIX"] = self.smap.url()
+        os.environ["SMAPAPI"] = "KEY"
+        self.session = lucid_client.LucidSession(self.lucid.url())
+        self.assertTrue(self.session.login("user", "pass"))
+        self.meters = meter_catalog.get(self.session.list_meters)
+        self.titles = meter_catalog.titles(self.meters)
+
+    def tearDown(self):
+        self.lucid.stop()
+        self.smap.stop()
+        SandboxTestCase.tearDown(self)
+
+    def load(self, start_date, end_date):
+        self.session.export(self.titles, start_date, end_date, "sync",
+                            self.meters)
+        extract_data.main()
+        load_data.load_all(native=True)
+
+    def test_ids(self):
+        self.assertEqual(meter_catalog.ids(self.titles + [ "unknown" ]),
+                         [ "1000", "1001", "1002", "unknown" ])
+
+    def test_no_watermark(self):
+        self.assertEqual(watermark.clip_start(self.titles, "01/01/2015",
+                                              "01/31/2015"), "01/01/2015")
+
+    def test_clip_by_title(self):
+        self.load("01/01/2015", "01/03/2015")
+        self.assertEqual(watermark.clip_start(self.titles, "01/01/2015",
+                                              "01/31/2015"), "01/02/2015")
+
+    def test_clip_by_scraped_title(self):
+        # The browser's picker lists titles only; the ids are learned from
+        # the loaded files, and kept when the picker is scraped again.
+        scrape = lambda: [ (None, title) for title in self.titles ]
+        meter_catalog.refresh(scrape)
+        self.load("01/01/2015", "01/03/2015")
+        meter_catalog.refresh(scrape)
+        self.assertEqual(meter_catalog.ids(self.titles),
+                         [ "1000", "1001", "1002" ])
+        self.assertEqual(watermark.clip_start(self.titles, "01/01/2015",
+                                              "01/31/2015"), "01/02/2015")
+
+if __name__ == "__main__":
+    unittest.main()
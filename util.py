@@ -1,18 +1,25 @@
 """
-Utility functions for the following scripts:
+Settings and utility functions for the scripts and the modules they use:
 
+    run.py
     get_data.py
     extract_data.py
-    process_data.py
+    load_data.py
 """
 
+from contextlib import contextmanager
+import fcntl
+import multiprocessing
 import os
+import tempfile
 
 # Directories
 cwd = os.getcwd()
 DATA_PATH = os.path.join(cwd, "data")
 FINISHED = os.path.join(cwd, "finished")
 ARCHIVED = os.path.join(FINISHED, "archived")
+# Working directories of smap-load-csv runs
+SCRATCH = os.path.join(cwd, "scratch")
 INFO = os.path.join(cwd, "info")
 
 # For get_data.py
@@ -25,19 +32,193 @@ PASS = os.getenv('LUCIDPASS')
 DATA_WAIT_PERIOD = 15               # Refresh every 15 seconds
 MAX_RETRIES = 20                    # Maximum wait time
 
+# Export link polling (see polling.py): the delay starts at POLL_MIN seconds
+# and grows by POLL_BACKOFF up to POLL_MAX, +/- POLL_JITTER, until the export
+# has taken EXPORT_DEADLINE seconds (LUCIDDEADLINE).
+POLL_MIN = 2
+POLL_MAX = 30
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.25
+EXPORT_DEADLINE = int(os.getenv('LUCIDDEADLINE',
+                                DATA_WAIT_PERIOD * MAX_RETRIES))
+
+# Export planner (export_planner.py): exports of at most SHARD_METERS meters
+# and SHARD_DAYS days, SHARD_CONCURRENCY pending at once, each submitted at
+# most SHARD_ATTEMPTS times.
+SHARD_METERS = 25
+SHARD_DAYS = 31
+SHARD_CONCURRENCY = 4
+SHARD_ATTEMPTS = 3
+
+# Parallel fetch (fetch_pool.py): logged-in sessions exporting at once with -f.
+FETCH_SESSIONS = 4
+
+# Download completion: the file must keep its size for DOWNLOAD_STABLE_CHECKS
+# checks, DOWNLOAD_CHECK_PERIOD seconds apart, within DOWNLOAD_DEADLINE
+# seconds.
+DOWNLOAD_CHECK_PERIOD = 0.5
+DOWNLOAD_STABLE_CHECKS = 2
+DOWNLOAD_DEADLINE = 600
+
+# For lucid_client.py (browserless exports)
+EXPORT_PATH = "/exports/create"     # Data export form
+EXPORT_LIST_PATH = "/exports/"      # Export download links, if not redirected
+EXPORT_POINTS = "points"            # Name of the meter select of the form
+HTTP_TIMEOUT = 60                   # Seconds
+
+# Meter catalog (meter_catalog.py): the cached meter list is refreshed once it
+# is older than CATALOG_TTL seconds (LUCIDCATALOGTTL).
+CATALOG = os.path.join(INFO, "meters.json")
+CATALOG_TTL = int(os.getenv('LUCIDCATALOGTTL', 24 * 3600))
+PICKER_TIMEOUT = 30                 # Seconds to wait for the meter picker
+
+# For daemon.py: the job specs file (LUCIDJOBS), seconds between schedule
+# checks, and minutes before a failed job is retried.
+JOBS = os.getenv('LUCIDJOBS', os.path.join(INFO, "jobs.json"))
+DAEMON_TICK = 30
+DAEMON_RETRY = 15
+
+# For pipeline.py
+
+PIPELINE_QUEUE_SIZE = 64            # Files waiting between two stages
+
+# For extract_data.py
+
+MAX_OPEN_FILES = 256                # Per-meter files open at once to split
+SPLIT_WORKERS = multiprocessing.cpu_count()     # Files split at once with -j
+
 
 # For load_data.py
 
-# sMAP info
-API = os.getenv('SMAPAPI')
-DEST_PREFIX = os.getenv('SMAPPREFIX')
+LOAD_WORKERS = 4                    # Files loaded at once with -w
+
+# sMAP info: the server's add URL prefix (SMAPPREFIX) and API key (SMAPAPI)
+# are read when data is loaded (see report_dest()), so that the other steps
+# run without them.
 
 # smap-load-csv parameter values:
 LINE_SKIP = 4
-REPORT_DEST = DEST_PREFIX + API
 TIME_FORMAT = "%Y-%m-%d %H:%M"
 
+# Validation (validate.py): an interval longer than GAP_FACTOR times the usual
+# one is reported as a gap.
+GAP_FACTOR = 2
+
+# Native publisher (smap_publish.py) settings:
+PUBLISH_BATCH_SIZE = 5000           # Readings per POST
+TIMEZONE = "America/Los_Angeles"
+
 # The location of the map file. This file provides a 1 to 1 mapping of
 # internal source name to UUID.
 MAP = os.path.join(INFO, "map.csv")
 
+# Backend for the map (see map_store.py): "csv" uses MAP, "sqlite" uses MAP_DB.
+MAP_BACKEND = os.getenv('LUCIDMAP', "csv")
+MAP_DB = os.path.join(INFO, "map.db")
+
+# Latest timestamp loaded per stream UUID (see watermark.py).
+WATERMARKS = os.path.join(INFO, "watermarks.json")
+
+# Archive compression (see archive.py): "gzip", "zstd" or none (LUCIDARCHIVE).
+ARCHIVE_COMPRESSION = os.getenv('LUCIDARCHIVE', "")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+# Write-ahead journal of the extract and load steps (see journal.py).
+JOURNAL = os.path.join(INFO, "journal.jsonl")
+
+# Ledger of the content digests of the files already extracted, split and
+# loaded (see ledger.py). With LUCIDFORCE set (run.py -F), files are handled
+# even if the ledger has seen their content.
+LEDGER = os.path.join(INFO, "ledger.jsonl")
+LEDGER_FORCE = bool(os.getenv('LUCIDFORCE'))
+
+# Run metrics (see metrics.py): per-file events as JSON lines (LUCIDMETRICS)
+# and the Prometheus textfile collector file (LUCIDPROM).
+METRICS_LOG = os.getenv('LUCIDMETRICS', os.path.join(INFO, "metrics.jsonl"))
+METRICS_PROM = os.getenv('LUCIDPROM', os.path.join(INFO, "lucid.prom"))
+
+# Compaction of the split files before they are loaded (see compact.py),
+# enabled by LUCIDCOMPACT. Runs of readings within LUCIDCOMPACTTOL of each
+# other are collapsed (see compact_tolerance()); unset, unchanged readings
+# are all kept.
+COMPACT = bool(os.getenv('LUCIDCOMPACT'))
+
+# Rollups published next to the raw streams (see rollup.py): a comma-separated
+# list of "hourly", "daily" and "monthly" (LUCIDROLLUPS); unset, none are.
+ROLLUPS = [ r for r in os.getenv('LUCIDROLLUPS', "").split(",") if r ]
+
+# Columnar cache of parsed series (see series_cache.py), enabled by LUCIDCACHE.
+SERIES_CACHE = bool(os.getenv('LUCIDCACHE'))
+SERIES_INDEX = os.path.join(INFO, "series.json")
+
+# Files kept next to a data file and archived with it: its cached series
+# (series_cache.py) and its validation report (validate.py).
+CACHE_SUFFIXES = (".times.npy", ".values.npy")
+REPORT_SUFFIX = ".report.json"
+
+class ConfigError(Exception):
+    """
+    Raised when a setting the requested step needs is missing.
+    """
+
+def report_dest():
+    """
+    Returns the URL data is posted to: SMAPPREFIX followed by SMAPAPI. Raises
+    ConfigError if either is unset.
+    """
+
+    prefix = os.getenv('SMAPPREFIX')
+    api = os.getenv('SMAPAPI')
+    if not (prefix and api):
+        raise ConfigError("SMAPPREFIX and SMAPAPI must be set to load data.")
+    return prefix + api
+
+def compact_tolerance():
+    """
+    Returns the compaction tolerance, LUCIDCOMPACTTOL, as a float, None if it
+    is unset. Raises ConfigError if it is not a number.
+    """
+
+    tolerance = os.getenv('LUCIDCOMPACTTOL')
+    if tolerance is None:
+        return None
+    try:
+        return float(tolerance)
+    except ValueError:
+        raise ConfigError("LUCIDCOMPACTTOL must be a number, not %r."
+                          % tolerance)
+
+@contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on the file PATH.lock for the duration of the
+    block, so that processes sharing the file PATH take turns updating it.
+    """
+
+    with open(path + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def atomic_write(path, write):
+    """
+    Replaces the file PATH with the output of WRITE, which is called with a
+    temporary file open for writing. Readers see either the old or the new
+    file, never a partial one.
+    """
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix="." + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            write(tmp)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""
+Batched validation of per-meter csv files before they are loaded.
+
+The timestamp column of a file is parsed as a whole with NumPy against
+util.TIME_FORMAT, the values are coerced to floats, and the file is checked
+for unparsable timestamps, timestamps that go backwards, duplicate
+timestamps and gaps (intervals longer than util.GAP_FACTOR times the usual
+interval). The findings are written to {name}.report.json next to the file.
+A file is valid if all its timestamps parse and are in order.
+
+Requires NumPy.
+
+Usage (validate all csv files in the finished directory):
+
+    python validate.py
+"""
+
+from datetime import datetime
+import csv
+import json
+import os
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import archive
+import util
+
+# strftime formats that NumPy can parse directly once the date and time are
+# joined with a "T", and the datetime64 unit they resolve to.
+ISO_FORMATS = {
+    "%Y-%m-%d %H:%M": "m",
+    "%Y-%m-%d %H:%M:%S": "s",
+    "%Y-%m-%dT%H:%M": "m",
+    "%Y-%m-%dT%H:%M:%S": "s",
+    "%Y-%m-%d": "D",
+}
+
+MAX_LISTED = 20                     # Problems listed per kind in a report
+
+def report_path(filepath):
+    """
+    Returns the path of the validation report for the csv file FILEPATH.
+    """
+
+    return os.path.splitext(archive.strip(filepath))[0] + util.REPORT_SUFFIX
+
+def read_columns(filepath):
+    """
+    Returns the timestamp and value columns of the data rows of the csv file
+    FILEPATH as two lists of strings, and the list of their line numbers.
+    Blank rows are skipped.
+    """
+
+    stamps = []
+    values = []
+    lines = []
+    with archive.open_data(filepath) as data:
+        reader = csv.reader(data)
+        for i, row in enumerate(reader):
+            if i < util.LINE_SKIP or not row:
+                continue
+            stamps.append(row[0].strip())
+            values.append(row[1].strip() if len(row) > 1 else "")
+            lines.append(reader.line_num)
+    return stamps, values, lines
+
+def parse_times(stamps, time_format=None):
+    """
+    Parses the array of timestamp strings STAMPS, formatted as TIME_FORMAT
+    (default util.TIME_FORMAT), into a datetime64[s] array. Unparsable
+    timestamps become NaT.
+    """
+
+    time_format = time_format or util.TIME_FORMAT
+    unit = ISO_FORMATS.get(time_format)
+    if unit is None:
+        # No vectorized parser for this format; fall back to strptime.
+        return np.array([ strptime(stamp, time_format) for stamp in stamps ],
+                        dtype="datetime64[s]")
+    width = len(datetime(2000, 1, 1).strftime(time_format))
+    iso = np.char.replace(stamps, " ", "T")
+    good = np.char.str_len(iso) == width
+    times = np.empty(len(stamps), dtype="datetime64[s]")
+    times[:] = np.datetime64("NaT")
+    try:
+        times[good] = iso[good].astype("datetime64[%s]" % unit)
+    except ValueError:
+        # At least one timestamp is malformed; find it element by element.
+        for i in np.nonzero(good)[0]:
+            try:
+                times[i] = np.datetime64(iso[i], unit)
+            except ValueError:
+                pass
+    return times
+
+def strptime(stamp, time_format):
+    try:
+        return datetime.strptime(stamp, time_format)
+    except ValueError:
+        return None
+
+def parse_values(values):
+    """
+    Coerces the array of value strings VALUES to a float64 array. Blank and
+    non-numeric values become NaN. Returns (floats, indices of non-numeric
+    values).
+    """
+
+    blank = np.char.str_len(values) == 0
+    floats = np.empty(len(values), dtype=np.float64)
+    floats[:] = np.nan
+    try:
+        floats[~blank] = values[~blank].astype(np.float64)
+        bad = np.empty(0, dtype=np.intp)
+    except ValueError:
+        bad = []
+        for i in np.nonzero(~blank)[0]:
+            try:
+                floats[i] = float(values[i])
+            except ValueError:
+                bad.append(i)
+        bad = np.array(bad, dtype=np.intp)
+    return floats, bad
+
+def check(stamps, values, lines=None):
+    """
+    Validates the timestamp and value string lists STAMPS and VALUES, read
+    from the line numbers LINES. Returns the report dict.
+    """
+
+    if lines is None:
+        lines = range(util.LINE_SKIP + 1, util.LINE_SKIP + 1 + len(stamps))
+
+    stamps = np.array(stamps, dtype=str)
+    values = np.array(values, dtype=str)
+    if not len(stamps):
+        times = np.empty(0, dtype="datetime64[s]")
+    else:
+        times = parse_times(stamps)
+    if not len(values):
+        floats, bad_values = np.empty(0), np.empty(0, dtype=np.intp)
+    else:
+        floats, bad_values = parse_values(values)
+    bad_times = np.nonzero(np.isnat(times))[0]
+
+    t = times[~np.isnat(times)].astype(np.int64)
+    rows = np.nonzero(~np.isnat(times))[0]
+    diffs = np.diff(t)
+    backwards = rows[1:][diffs < 0]
+    duplicates = rows[1:][diffs == 0]
+    # The usual interval is the most common one.
+    steps, counts = np.unique(diffs[diffs > 0], return_counts=True)
+    interval = int(steps[np.argmax(counts)]) if len(steps) else None
+    gaps = []
+    if interval:
+        for i in np.nonzero(diffs > util.GAP_FACTOR * interval)[0]:
+            gaps.append({ "after": stamps[rows[i]],
+                          "before": stamps[rows[i + 1]],
+                          "missing": int(diffs[i] // interval) - 1 })
+
+    def listed(indices):
+        return [ { "line": lines[i], "timestamp": stamps[i],
+                   "value": values[i] } for i in indices[:MAX_LISTED] ]
+
+    return {
+        "ok": not len(bad_times) and not len(backwards),
+        "rows": len(stamps),
+        "first": stamps[rows[0]] if len(rows) else None,
+        "last": stamps[rows[-1]] if len(rows) else None,
+        "interval_seconds": interval,
+        "null_values": int(np.isnan(floats).sum()) - len(bad_values),
+        "bad_timestamps": len(bad_times),
+        "bad_timestamp_rows": listed(bad_times),
+        "bad_values": len(bad_values),
+        "bad_value_rows": listed(bad_values),
+        "out_of_order": len(backwards),
+        "out_of_order_rows": listed(backwards),
+        "duplicates": len(duplicates),
+        "duplicate_rows": listed(duplicates),
+        "gaps": len(gaps),
+        "gap_list": gaps[:MAX_LISTED],
+    }
+
+def validate(filepath):
+    """
+    Validates the per-meter csv file FILEPATH and writes its report next to
+    it. Returns the report dict.
+    """
+
+    if np is None:
+        raise ImportError("validation requires NumPy")
+    stamps, values, lines = read_columns(filepath)
+    report = check(stamps, values, lines)
+    report["file"] = os.path.basename(filepath)
+    util.atomic_write(report_path(filepath), lambda f: json.dump(report, f,
+                      indent=1, sort_keys=True))
+    if not report["ok"]:
+        print("[INVALID] %s: %d bad timestamps, %d out of order"
+              % (filepath, report["bad_timestamps"], report["out_of_order"]))
+    return report
+
+def validate_all():
+    """
+    Validates all csv files in the finished directory. Returns the list of
+    invalid files.
+    """
+
+    invalid = []
+    for filename in sorted(os.listdir(util.FINISHED)):
+        filepath = os.path.join(util.FINISHED, filename)
+        if os.path.isfile(filepath) and archive.is_data_file(filename):
+            if not validate(filepath)["ok"]:
+                invalid.append(filepath)
+    return invalid
+
+def main():
+    """
+    Main function.
+    """
+
+    invalid = validate_all()
+    print("%d invalid files." % len(invalid))
+    if invalid:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Per-meter high-water marks for incremental syncs.
+
+After a successful load, the latest timestamp loaded for the stream is
+recorded under its UUID in util.WATERMARKS. The exporters then start the
+requested date range at the watermark (when every selected meter has one),
+and the extract step drops any rows at or before it, so the data sent to the
+sMAP server never overlaps with what is already there.
+
+A run whose loads overlap its extracts (the pipeline) freezes the watermarks
+when it starts, so that its files are trimmed against the marks from before
+the run: its exports can load out of date order, and a later one loaded first
+must not trim away an earlier one.
+
+Meters are matched to their UUIDs through the map store, by source name
+(the Lucid meter id). The exporters select meters by title, which are
+resolved to ids through the meter catalog; a catalog scraped from the
+browser has no ids, and learns them from the files that are loaded.
+"""
+
+from datetime import datetime
+import csv
+import json
+import os
+
+import archive
+import map_store
+import meter_catalog
+import util
+
+STORE = None
+MAP = None
+FROZEN = None               # UUID to watermark, from freeze() until thaw()
+
+def parse_time(timestamp):
+    """
+    Returns the datetime for TIMESTAMP, formatted as util.TIME_FORMAT, or
+    None if it is not a timestamp (e.g. a header cell).
+    """
+
+    try:
+        return datetime.strptime(timestamp, util.TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+class WatermarkStore(object):
+    """
+    UUID to latest loaded timestamp, kept as a JSON object in the file at
+    PATH. Updates are made under an exclusive lock and written atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.marks = {}
+        self.stamp = None
+
+    def reload(self):
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.marks = {}
+        if stamp:
+            with open(self.path, 'rb') as f:
+                self.marks = json.load(f)
+        self.stamp = stamp
+
+    def get(self, uid):
+        """
+        Returns the latest timestamp loaded for stream UID as a datetime, None
+        if there is none.
+        """
+
+        self.reload()
+        return parse_time(self.marks.get(uid))
+
+    def update(self, uid, timestamp):
+        """
+        Records the datetime TIMESTAMP as the watermark of stream UID, unless
+        the stream already has a later one.
+        """
+
+        with util.file_lock(self.path):
+            self.reload()
+            current = parse_time(self.marks.get(uid))
+            if current and current >= timestamp:
+                return
+            self.marks[uid] = timestamp.strftime(util.TIME_FORMAT)
+            util.atomic_write(self.path, lambda f: json.dump(self.marks, f,
+                              indent=1, sort_keys=True))
+            self.stamp = None
+
+def get_store():
+    """
+    Returns the watermark store, opening it on first use.
+    """
+
+    global STORE
+    if STORE is None:
+        STORE = WatermarkStore(util.WATERMARKS)
+    return STORE
+
+def get_map():
+    global MAP
+    if MAP is None:
+        MAP = map_store.open_store()
+    return MAP
+
+def since(source_name):
+    """
+    Returns the watermark of the stream of SOURCE_NAME as a datetime (as it
+    was at freeze() if the watermarks are frozen), None if the meter has no
+    stream or no watermark.
+    """
+
+    uid = get_map().get(source_name)
+    if not uid:
+        return None
+    if FROZEN is not None:
+        return parse_time(FROZEN.get(uid))
+    return get_store().get(uid)
+
+def freeze():
+    """
+    Makes since() return the watermarks as they are now until thaw(), while
+    loads keep advancing the store.
+    """
+
+    global FROZEN
+    store = get_store()
+    store.reload()
+    FROZEN = dict(store.marks)
+
+def thaw():
+    global FROZEN
+    FROZEN = None
+
+def file_high(filepath):
+    """
+    Returns the latest timestamp in the processed csv file FILEPATH, None if
+    it has no data rows.
+    """
+
+    high = None
+    with archive.open_data(filepath) as data:
+        for row in csv.reader(data):
+            if row:
+                t = parse_time(row[0])
+                if t and (high is None or t > high):
+                    high = t
+    return high
+
+def record(uid, filepath):
+    """
+    Advances the watermark of stream UID to the latest timestamp of the
+    loaded file FILEPATH.
+    """
+
+    high = file_high(filepath)
+    if high:
+        get_store().update(uid, high)
+
+def clip_start(meter_list, start_date, end_date):
+    """
+    Returns the start date (MM/DD/YYYY) to request for the meters titled
+    METER_LIST: the day of the earliest watermark among them if it is later
+    than START_DATE and before END_DATE, otherwise START_DATE. Meters without
+    a watermark need the whole range.
+    """
+
+    marks = [ since(meter) for meter in meter_catalog.ids(meter_list) ]
+    if not marks or None in marks:
+        return start_date
+    low = min(marks).replace(hour=0, minute=0, second=0, microsecond=0)
+    start = datetime.strptime(start_date, "%m/%d/%Y")
+    end = datetime.strptime(end_date, "%m/%d/%Y")
+    if start < low < end:
+        new_start = low.strftime("%m/%d/%Y")
+        print("Data up to %s is already loaded; starting at %s."
+              % (min(marks).strftime(util.TIME_FORMAT), new_start))
+        return new_start
+    return start_date